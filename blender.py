@@ -1,6 +1,8 @@
+import textwrap
 import numpy as np
 from scipy.spatial.transform import Rotation
 import json
+from file_cache import FileCache, file_content_hash
 
 
 class Blender():
@@ -41,13 +43,34 @@ class Blender():
             str: script
         """
         
+        script = self.get_blender_camera_script(R, K)
+
+        if R_sun is None:   
+            return script
+
+        script += self.get_blender_sun_script(R_sun)
+
+        return script
+
+
+    def get_blender_camera_script(self, R, K):
+        """Python script to position the camera and set the output of the render
+
+        Args:
+            R (3x3 or 2x3 np.array): Extrinsics of the camera
+            K (): Intrinsics of the camera
+
+        Returns:
+            str: script
+        """
+        
         L = np.min(self.image_xy_size)
         
         if R.shape[0]==2:
             R_last_row =  np.cross(R[0,:], R[1,:] )
             R_3x3 = np.vstack((R,R_last_row))
         else:
-            R_3x3 = R
+            R_3x3 = R.copy()
     
         # invert y and z axes for Blender
         R_3x3[1,:] *= -1
@@ -96,7 +119,12 @@ class Blender():
         #OUTPUT
         script += 'bpy.context.scene.render.resolution_x = {}'.format(self.image_xy_size[0])
         script += '\n'
-        script += 'bpy.context.scene.render.resolution_y = {}'.format(self.image_xy_size[1]) 
+        script += 'bpy.context.scene.render.resolution_y = {}'.format(self.image_xy_size[1])
+        script += '\n'
+        # full frame (a previous tile job of a persistent Blender worker may have set a render border)
+        script += 'bpy.context.scene.render.use_border = False'
+        script += '\n'
+        script += 'bpy.context.scene.render.use_crop_to_border = False'
         script += '\n'
         script += f'bpy.context.scene.render.image_settings.file_format = "{self.image_settings_file_format}"'
         script += '\n'
@@ -104,19 +132,24 @@ class Blender():
         script += '\n'
         script += f'bpy.context.scene.render.image_settings.color_depth = "{self.image_settings_color_depth}"'
 
-        #---------------------------------------------------------------------------
-        # SUN rotation --------------------------------
+        return script
 
 
-        if R_sun is None:   
-            return script
+    def get_blender_sun_script(self, R_sun):
+        """Python script to rotate the sun in the Blender scene
+
+        Args:
+            R_sun (3x3 or 2x3 np.array): Sun rotation matrix
+
+        Returns:
+            str: script
+        """
 
-        
         if R_sun.shape[0]==2:
             R_last_row =  np.cross(R_sun[0,:], R_sun[1,:] )
             R_3x3 = np.vstack((R_sun,R_last_row))
         else:
-            R_3x3 = R_sun
+            R_3x3 = R_sun.copy()
 
         # dar vuelta los ejes y y z para blender
         R_3x3[1,:] *= -1
@@ -130,7 +163,7 @@ class Blender():
         
         # blender uses quaternion w,x,y,z
         # scipy.spatial.transform uses quaternion x,y,z,w
-        script += '\n'
+        script = '\n'
         script += '#-----------------------------';
         script += '\n'
         
@@ -168,3 +201,127 @@ class Blender():
         
         return command
 
+
+    def get_blender_command_args(self, blender_python_script_filename, blender_render_filename):
+        """Same command as get_blender_command as a list of arguments, to run Blender without a shell
+           (e.g. with asyncio.create_subprocess_exec)
+
+        Args:
+            blender_python_script_filename (str): filename of the python script to setup the camera and sun
+            blender_render_filename (str): filename for the image to be rendered
+
+        Returns:
+            list: command to run Blender and do the job
+        """
+        return ['blender', '-b', self.scene_filename,                  # execute in backgroud
+                '-P', blender_python_script_filename,                  # run the python script
+                '-o', blender_render_filename,                         # output filename with no extension
+                '-f', '1']                                             # render frame
+
+
+    def get_blender_tile_script(self, x0, y0, x1, y1):
+        """Python script to render only a tile of the image (render border cropped to the border).
+           Appended to the camera position script it renders the pixels [y0:y1, x0:x1] of the full image.
+
+        Args:
+            x0 (int): First column of the tile
+            y0 (int): First row of the tile
+            x1 (int): Last column of the tile (not included)
+            y1 (int): Last row of the tile (not included)
+
+        Returns:
+            str: script
+        """
+        W, H = self.image_xy_size
+
+        def border(p, size):
+            # blender converts the normalized borders back to pixels by truncation (border * size), so the
+            # borders are placed a quarter of pixel after the pixel boundary: float rounding (or a rounding 
+            # instead of a truncation) still gives the pixel p
+            return min((p + 0.25) / size, 1.0)
+
+        # blender borders are normalized and the y axis goes from bottom to top
+        script = '\n'
+        script += 'bpy.context.scene.render.use_border = True'
+        script += '\n'
+        script += 'bpy.context.scene.render.use_crop_to_border = True'
+        script += '\n'
+        script += f'bpy.context.scene.render.border_min_x = {border(x0, W)}'
+        script += '\n'
+        script += f'bpy.context.scene.render.border_max_x = {border(x1, W)}'
+        script += '\n'
+        script += f'bpy.context.scene.render.border_min_y = {border(H - y1, H)}'
+        script += '\n'
+        script += f'bpy.context.scene.render.border_max_y = {border(H - y0, H)}'
+        script += '\n'
+
+        return script
+
+
+    def get_blender_batch_script(self, render_jobs):
+        """Python script to render several poses of the camera and the sun in a single Blender session.
+           The scene is loaded once and each job positions the camera and sun and renders a still image.
+
+        Args:
+            render_jobs (list): List of (script, image_filename) where script positions the camera and
+                                the sun (see get_blender_camera_position_script) and image_filename is 
+                                the complete filename of the rendered image
+
+        Returns:
+            str: script
+        """
+        script = 'import bpy'
+        script += '\n'
+        
+        for i, (position_script, image_filename) in enumerate(render_jobs):
+            job_script = position_script
+            job_script += '\n'
+            job_script += f'bpy.context.scene.render.filepath = {image_filename!r}'
+            job_script += '\n'
+            job_script += 'bpy.ops.render.render(write_still=True)'
+            
+            # a failing job does not stop the rest of the batch
+            script += '\n'
+            script += f'#----------------------------- job {i}'
+            script += '\n'
+            script += 'try:'
+            script += '\n'
+            script += textwrap.indent(job_script, '    ')
+            script += '\n'
+            script += 'except Exception as e:'
+            script += '\n'
+            script += f'    print("Blender batch: job {i} failed:", e)'
+            script += '\n'
+        
+        return script
+
+
+    def get_blender_batch_command(self, blender_python_script_filename):
+        """Command to execute Blender and run a batch script (see get_blender_batch_script).
+           The batch script writes the rendered images, so no output or frame is given.
+
+        Args:
+            blender_python_script_filename (str): filename of the batch python script
+
+        Returns:
+            str: command to run Blender and do the job
+        """
+        command = 'blender -b ' + self.scene_filename + ' '          # execute in backgroud
+        command += '-P ' + blender_python_script_filename + ' '      # run the python script
+        
+        return command
+
+
+    def get_render_cache_key(self, blender_camera_script, *extra):
+        """Key of a render in a render cache (see FileCache). The key depends on the contents of the
+           scene file and on the camera position script, which sets the camera rotation, the ortho scale,
+           the resolution, the sun rotation and the output settings.
+
+        Args:
+            blender_camera_script (str): Script returned by get_blender_camera_position_script
+            *extra: Anything else that changes the rendered image
+
+        Returns:
+            str: key
+        """
+        return FileCache.key(file_content_hash(self.scene_filename), blender_camera_script, *extra)
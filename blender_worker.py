@@ -0,0 +1,52 @@
+"""
+Render worker that runs inside Blender.
+
+The worker is launched by BlenderWorkerPool as
+    blender -b <scene> -P blender_worker.py -- <port>
+It connects to the pool on localhost:<port> and keeps the scene loaded (with
+persistent render data) while it renders the jobs it receives.
+
+Protocol: one JSON object per line.
+    job:    {"script": <camera and sun script>, "filepath": <image filename>}
+            {"stop": true}  ends the worker
+    reply:  {"filepath": <image filename>, "render_time": <seconds>, "error": <traceback or null>}
+"""
+import json
+import socket
+import sys
+import time
+import traceback
+
+
+def serve(port):
+    import bpy
+
+    # keep the render data (BVH, textures...) between renders
+    bpy.context.scene.render.use_persistent_data = True
+
+    sock = socket.create_connection(('127.0.0.1', port))
+    f = sock.makefile('rw')
+    for line in f:
+        job = json.loads(line)
+        if job.get('stop'):
+            break
+
+        reply = {'filepath': job['filepath'], 'render_time': None, 'error': None}
+        try:
+            exec(job['script'], {'__name__': 'blender_worker_job'})
+            bpy.context.scene.render.filepath = job['filepath']
+            t0 = time.time()
+            bpy.ops.render.render(write_still=True)
+            reply['render_time'] = time.time() - t0
+        except Exception:
+            reply['error'] = traceback.format_exc()
+
+        f.write(json.dumps(reply) + '\n')
+        f.flush()
+
+    sock.close()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--') + 1:]
+    serve(int(argv[0]))
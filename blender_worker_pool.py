@@ -0,0 +1,177 @@
+import os
+import json
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+
+class BlenderWorkerPool():
+    """Pool of long-lived Blender processes that keep the scene loaded and render jobs on demand.
+       Each worker runs blender_worker.py inside Blender and talks to the pool through a local socket.
+    """
+    def __init__(self, blender, num_workers=1, log_dir=None, startup_timeout=300):
+        """Pool construction. The workers are launched by "start".
+
+        Args:
+            blender (Blender): Blender instance with the scene to load
+            num_workers (int, optional): Number of Blender processes. Defaults to 1.
+            log_dir (str, optional): Directory for the Blender output of each worker. Defaults to None (discarded).
+            startup_timeout (int, optional): Seconds to wait for the workers to connect. Defaults to 300.
+        """
+        self.blender = blender
+        self.num_workers = num_workers
+        self.log_dir = log_dir
+        self.startup_timeout = startup_timeout
+
+        self.worker_script_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blender_worker.py')
+        self.processes = []
+        self.log_files = []
+        self.idle_workers = queue.Queue()
+        self.num_alive_workers = 0
+        self.lock = threading.Lock()
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def get_worker_command(self, port):
+        """Command (argument list) to launch a worker
+
+        Args:
+            port (int): Port of the pool in localhost
+
+        Returns:
+            list: command
+        """
+        return ['blender', '-b', self.blender.scene_filename,
+                '-P', self.worker_script_filename,
+                '--', str(port)]
+
+
+    def start(self):
+        """Launches the workers and waits until all of them are connected
+
+        Raises:
+            RuntimeError: if a worker exits or the workers do not connect before startup_timeout
+        """
+        server = socket.create_server(('127.0.0.1', 0))
+        # short accepts to check the processes in between
+        server.settimeout(min(1, self.startup_timeout))
+        port = server.getsockname()[1]
+
+        for i in range(self.num_workers):
+            if self.log_dir is None:
+                stdout = subprocess.DEVNULL
+            else:
+                stdout = open(os.path.join(self.log_dir, f'blender_worker_{i}.log'), 'w')
+                self.log_files.append(stdout)
+            self.processes.append(subprocess.Popen(self.get_worker_command(port),
+                                                   stdout=stdout, stderr=subprocess.STDOUT))
+
+        deadline = time.monotonic() + self.startup_timeout
+        try:
+            while self.num_alive_workers < self.num_workers:
+                # a worker that exits (e.g. bad scene or Blender crash) will never connect
+                return_codes = [p.returncode for p in self.processes if p.poll() is not None]
+                if return_codes:
+                    raise RuntimeError(f'BlenderWorkerPool: {len(return_codes)} Blender worker(s) exited during '
+                                       f'startup (return codes {return_codes})')
+                if time.monotonic() > deadline:
+                    raise RuntimeError('BlenderWorkerPool: the Blender workers did not start')
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                self.idle_workers.put(conn.makefile('rw'))
+                self.num_alive_workers += 1
+        except BaseException:
+            # the workers that are not connected cannot be stopped
+            for p in self.processes:
+                if p.poll() is None:
+                    p.kill()
+            self.stop()
+            raise
+        finally:
+            server.close()
+
+
+    def stop(self):
+        """Stops the workers
+        """
+        while not self.idle_workers.empty():
+            worker = self.idle_workers.get()
+            try:
+                worker.write(json.dumps({'stop': True}) + '\n')
+                worker.flush()
+                worker.close()
+            except OSError:
+                pass
+        self.num_alive_workers = 0
+
+        for p in self.processes:
+            try:
+                p.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        self.processes = []
+
+        for f in self.log_files:
+            f.close()
+        self.log_files = []
+
+
+    def acquire_worker(self):
+        while True:
+            with self.lock:
+                if self.num_alive_workers == 0:
+                    raise RuntimeError('BlenderWorkerPool: no Blender worker is running')
+            try:
+                return self.idle_workers.get(timeout=1)
+            except queue.Empty:
+                pass
+
+
+    def render(self, script, image_filename):
+        """Renders an image in one of the workers. Blocks until a worker is available and the image
+           is rendered, so it can be called from several threads.
+
+        Args:
+            script (str): Python script to position the camera and the sun (see Blender.get_blender_camera_position_script)
+            image_filename (str): Filename of the rendered image
+
+        Raises:
+            RuntimeError: if the render fails, the image is not written or the worker dies
+
+        Returns:
+            dict: reply of the worker with keys 'filepath' and 'render_time' (seconds)
+        """
+        worker = self.acquire_worker()
+        try:
+            worker.write(json.dumps({'script': script, 'filepath': image_filename}) + '\n')
+            worker.flush()
+            line = worker.readline()
+        except OSError:
+            line = ''
+
+        if not line:
+            # the worker died
+            with self.lock:
+                self.num_alive_workers -= 1
+            raise RuntimeError(f'BlenderWorkerPool: a Blender worker died while rendering {image_filename}')
+
+        self.idle_workers.put(worker)
+
+        reply = json.loads(line)
+        if reply['error'] is not None:
+            raise RuntimeError(f'BlenderWorkerPool: render of {image_filename} failed\n{reply["error"]}')
+        if not os.path.isfile(image_filename):
+            raise RuntimeError(f'BlenderWorkerPool: Blender did not write {image_filename}')
+        return reply
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import shutil
+import threading
+
+
+# content hashes of files, keyed by (filename, size, modification time)
+_file_hashes = {}
+
+
+def file_content_hash(filename):
+    """SHA-256 of the contents of a file. The hash is remembered while the file is not modified.
+
+    Args:
+        filename (str): Filename
+
+    Returns:
+        str: hex digest
+    """
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+class FileCache():
+    """Content-addressed on-disk cache of files shared between simulations.
+       Entries are looked up by a key (a hash of everything that determines the file), the total
+       size of the cache is capped and the least recently used entries are evicted first.
+    """
+    def __init__(self, cache_dir, max_size_in_bytes=10 * 2**30):
+        """Construction
+
+        Args:
+            cache_dir (str): Directory of the cache. Created if it does not exist.
+            max_size_in_bytes (int, optional): Maximum total size of the entries. Defaults to 10 GiB.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_in_bytes = max_size_in_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def __str__(self):
+        s = 'FileCache\n'
+        s+= f'Cache directory: {self.cache_dir}\n'
+        s+= f'Max size (bytes): {self.max_size_in_bytes}'
+        return(s)
+
+
+    @staticmethod
+    def key(*parts):
+        """Key of an entry from the parts that determine it
+
+        Args:
+            *parts: str, bytes or any object with a stable repr
+
+        Returns:
+            str: hex digest
+        """
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            elif not isinstance(part, bytes):
+                part = repr(part).encode()
+            h.update(hashlib.sha256(part).digest())
+        return h.hexdigest()
+
+
+    def entry_filename(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+    def fetch(self, key, filename, link=True):
+        """Gets an entry of the cache
+
+        Args:
+            key (str): Key of the entry
+            filename (str): Destination of the file
+            link (bool, optional): Hardlink the entry instead of copying it (copies if linking fails). Defaults to True.
+
+        Returns:
+            bool: True if the entry was in the cache
+        """
+        entry_filename = self.entry_filename(key)
+        try:
+            # mark the entry as recently used
+            os.utime(entry_filename)
+        except FileNotFoundError:
+            return False
+
+        tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            self._link_or_copy(entry_filename, tmp_filename, link)
+        except FileNotFoundError:
+            # evicted meanwhile
+            return False
+        os.replace(tmp_filename, filename)
+        return True
+
+
+    def store(self, key, filename, link=True):
+        """Adds a file to the cache and evicts the least recently used entries if the cache is full.
+           The file must not be modified in place afterwards if it is linked.
+
+        Args:
+            key (str): Key of the entry
+            filename (str): File to store
+            link (bool, optional): Hardlink the file instead of copying it (copies if linking fails). Defaults to True.
+        """
+        entry_filename = self.entry_filename(key)
+        os.makedirs(os.path.dirname(entry_filename), exist_ok=True)
+
+        tmp_filename = f'{entry_filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        self._link_or_copy(filename, tmp_filename, link)
+        os.replace(tmp_filename, entry_filename)
+
+        self.evict()
+
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size_in_bytes
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, f)))
+
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, entry_filename in sorted(entries):
+            if total_size <= self.max_size_in_bytes:
+                break
+            try:
+                os.remove(entry_filename)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+    @staticmethod
+    def _link_or_copy(src, dst, link):
+        if link:
+            try:
+                os.link(src, dst)
+                return
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # e.g. different file systems
+                pass
+        shutil.copyfile(src, dst)
@@ -5,7 +5,6 @@ from scipy.spatial.transform import Rotation
 from skimage.io import imread, imsave
 
 import utils
-import utm
 
 def get_voi_mesh(aoi, altitude_range=[-100,100], 
                  horizontal_resolution=2, vertical_resolution=3 ):
@@ -52,15 +51,80 @@ def get_voi_mesh(aoi, altitude_range=[-100,100],
     easts,norths,altitudes = np.meshgrid(Eastings, Northings, Heights,indexing='ij' )
     
     #meshgrid (lon,lat)
-    zone_number = utm.latlon_to_zone_number(aoi['coordinates'][0][0][1], aoi['coordinates'][0][0][0])
-    zone_letter = utm.latitude_to_zone_letter(aoi['coordinates'][0][0][1])
-    latitudes, longitudes = utm.to_latlon(easts.ravel().copy(), norths.ravel().copy(), zone_number, zone_letter)
-    latitudes = np.reshape(latitudes, norths.shape)
-    longitudes = np.reshape(longitudes, easts.shape)
+    epsg = utils.utm_epsg_from_lonlat(aoi['coordinates'][0][0][0], aoi['coordinates'][0][0][1])
+    longitudes, latitudes = utils.transform_coords(epsg, 4326, easts, norths)
     
     return longitudes, latitudes, altitudes, easts, norths
 
 
+def sample_voi(aoi, altitude_range=[-100,100], num_samples=50000,
+               horizontal_resolution=2, vertical_resolution=3, rng=None):
+    '''
+    sample_voi
+    
+    Random points of the VOI mesh of get_voi_mesh (drawn without replacement),
+    without building the mesh. The lattice indices of the points are drawn
+    directly and only the sampled points are converted to (lon, lat), so the 
+    memory is proportional to num_samples instead of the size of the mesh.
+
+    Parameters
+    ----------
+    aoi : geojson.Polygon 
+        GeoJSON polygon representing the Area of interest.
+    altitude_range : [float,float], optional
+        List or tuple of [min_altitude, max_altitude] in meters. The default is [-100,100].
+    num_samples : int, optional
+        Number of points. The default is 50000.
+    horizontal_resolution : float, optional
+        Horizontal resolution in meters. The default is 2.
+    vertical_resolution : float, optional
+        Vertical resolution in meters. The default is 3.
+    rng : np.random.Generator, optional
+        Random generator. The default is None (a new unseeded generator).
+
+    Returns
+    -------
+    longitudes : 1D np.array
+        Longitudes of the points.
+    latitudes : 1D np.array
+        Latitudes of the points.
+    altitudes : 1D np.array
+        Altitudes of the points.
+    easts : 1D np.array
+        UTM Eastings of the points.
+    norths : 1D np.array
+        UTM Northings of the points.
+
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # same lattice as get_voi_mesh
+    min_easting,  max_easting, min_northing, max_northing = utils.utm_bounding_box_from_lonlat_aoi(aoi)
+    resolution=horizontal_resolution
+    Northings = np.arange(min_northing, max_northing+resolution, resolution)
+    Eastings = np.arange(min_easting, max_easting+resolution, resolution)
+        
+    h_min = altitude_range[0]
+    h_max = altitude_range[1]
+    Heights = np.arange(h_min, h_max+vertical_resolution ,vertical_resolution) 
+
+    # lattice indices of the samples (in the order of the 'ij' meshgrid of get_voi_mesh)
+    shape = (len(Eastings), len(Northings), len(Heights))
+    indices = rng.choice(np.prod(shape), size=num_samples, replace=False)
+    ie, in_, ih = np.unravel_index(indices, shape)
+
+    easts = Eastings[ie]
+    norths = Northings[in_]
+    altitudes = Heights[ih]
+
+    # (lon,lat) of the samples only
+    epsg = utils.utm_epsg_from_lonlat(aoi['coordinates'][0][0][0], aoi['coordinates'][0][0][1])
+    longitudes, latitudes = utils.transform_coords(epsg, 4326, easts, norths)
+
+    return longitudes, latitudes, altitudes, easts, norths
+
+
 def get_aoi_center(aoi):
     coords = np.array(aoi['coordinates'][0])
     lons = coords[:,0]
@@ -0,0 +1,247 @@
+import numpy as np
+from skimage.io import imsave
+
+
+class HeightmapRenderer():
+    """Blender-free render backend for 2.5D scenes (DSMs, height fields).
+
+       The scene is orthographically projected with the same camera (K, R) used to compute
+       the affine camera P_affine (see paffine.compute_P_affine), so the images are consistent
+       with the fitted RPCs. The surface is shaded as Lambertian and the cast shadows of the
+       sun are computed by ray marching the height field.
+
+       A render backend is any object with an "image_xy_size" attribute and a method
+       render(R, K, R_sun, image_filename) that writes the image (see Simulator).
+    """
+    def __init__(self, heights, resolution, origin_en=(0, 0), image_xy_size=(600, 600),
+                 albedo=1.0, ambient=0.1, max_value=65535):
+        """Construction
+
+        Args:
+            heights (2D np.array): Heights in meters relative to the scene origin. Rows go from north to south
+                                   and columns from west to east. NaNs are treated as holes.
+            resolution (float): Size of the cells in meters
+            origin_en (tuple, optional): Local (east, north) in meters of the center of the cell heights[0,0],
+                                         relative to the scene origin (the (0,0,0) of Blender). Defaults to (0,0).
+            image_xy_size (tuple, optional): Width and height of the images. Defaults to (600,600).
+            albedo (float or 2D np.array, optional): Albedo of the surface (scalar or per cell). Defaults to 1.0.
+            ambient (float, optional): Fraction of light that reaches the surface in shadow. Defaults to 0.1.
+            max_value (int, optional): Image value of a white surface facing the sun. Defaults to 65535.
+        """
+        self.heights = np.asarray(heights, dtype=np.float64)
+        self.resolution = resolution
+        self.origin_en = origin_en
+        self.image_xy_size = image_xy_size
+        self.albedo = albedo
+        self.ambient = ambient
+        self.max_value = max_value
+
+        self.image_settings_file_format = 'TIFF'
+        self.image_settings_color_depth = '16'
+
+
+    def __str__(self):
+        s = 'HeightmapRenderer\n'
+        s+= f'Heights shape: {self.heights.shape}\n'
+        s+= f'Resolution (m): {self.resolution}\n'
+        s+= f'Origin (e, n): {self.origin_en}\n'
+        s+= f'Image xy size: {self.image_xy_size}'
+        return(s)
+
+
+    @staticmethod
+    def from_geotiff(dsm_filename, location, image_xy_size=(600, 600), **kwargs):
+        """Creates a renderer from a north-up DSM GeoTIFF in UTM coordinates
+
+        Args:
+            dsm_filename (str): DSM filename
+            location (Location): Location of the scene, its lon_lat_alt_origin is the scene origin
+            image_xy_size (tuple, optional): Width and height of the images. Defaults to (600,600).
+            **kwargs: Other HeightmapRenderer arguments (albedo, ambient, max_value)
+
+        Returns:
+            HeightmapRenderer: the renderer
+        """
+        import rasterio
+        import utm
+
+        with rasterio.open(dsm_filename, 'r') as s:
+            heights = s.read(1, masked=True).astype(np.float64).filled(np.nan)
+            transform = s.transform
+
+        if transform.b != 0 or transform.d != 0 or abs(transform.a) != abs(transform.e):
+            raise ValueError('HeightmapRenderer: the DSM must be north-up with square cells')
+
+        lon, lat, alt = location.lon_lat_alt_origin
+        utm_origin = utm.from_latlon(lat, lon)
+
+        origin_en = (transform.c + transform.a / 2 - utm_origin[0],
+                     transform.f + transform.e / 2 - utm_origin[1])
+
+        return HeightmapRenderer(heights - alt, transform.a, origin_en, image_xy_size, **kwargs)
+
+
+    def height_at(self, e, n):
+        """Height of the surface at local (east, north) coordinates (nearest cell)
+
+        Args:
+            e (np.array): East coordinates in meters
+            n (np.array): North coordinates in meters
+
+        Returns:
+            np.array: Heights (-inf outside of the height field)
+            np.array: Row index of the cells
+            np.array: Column index of the cells
+        """
+        rows = np.rint((self.origin_en[1] - n) / self.resolution).astype(np.int64)
+        cols = np.rint((e - self.origin_en[0]) / self.resolution).astype(np.int64)
+        inside = (rows >= 0) & (rows < self._heights.shape[0]) & (cols >= 0) & (cols < self._heights.shape[1])
+        h = np.full(e.shape, -np.inf)
+        h[inside] = self._heights[rows[inside], cols[inside]]
+        return h, rows, cols
+
+
+    def prepare(self):
+        """Precomputes the height range and the normals of the surface
+        """
+        # holes never stop the rays
+        self._heights = np.where(np.isnan(self.heights), -np.inf, self.heights)
+        valid = np.isfinite(self._heights)
+        self.h_min = np.min(self._heights[valid])
+        self.h_max = np.max(self._heights[valid])
+
+        # normals of the surface (rows go from north to south)
+        filled = np.where(valid, self._heights, self.h_min)
+        dh_dn = -np.gradient(filled, self.resolution, axis=0)
+        dh_de = np.gradient(filled, self.resolution, axis=1)
+        normals = np.stack((-dh_de, -dh_dn, np.ones_like(filled)), axis=-1)
+        self._normals = normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+
+    def march(self, p0, direction, stop, step, hit_at_stop=False):
+        """Marches rays p0 + s*direction over the height field. The last point of each ray is at its stop.
+
+        Args:
+            p0 (Nx3 np.array): Starting points (e, n, u)
+            direction (3 np.array): Direction of the rays
+            stop (N np.array): Maximum value of s for each ray
+            step (float): Step in s
+            hit_at_stop (bool, optional): The rays that reach their stop over the height field (not over a hole
+                                          or outside of it) hit the surface there. Defaults to False.
+
+        Returns:
+            np.array: s at the first point below the surface (np.inf if none)
+            np.array: s of the previous point (above the surface)
+        """
+        s_hit = np.full(len(p0), np.inf)
+        s_prev = np.full(len(p0), np.inf)
+        active = np.arange(len(p0))
+        s = 0.0
+        while len(active) > 0:
+            s_active = np.minimum(s, np.maximum(stop[active], 0))
+            p = p0[active] + s_active[:, np.newaxis] * direction
+            h, _, _ = self.height_at(p[:, 0], p[:, 1])
+            at_stop = s_active >= stop[active]
+            hit = p[:, 2] <= h
+            if hit_at_stop:
+                hit |= at_stop & np.isfinite(h)
+            s_hit[active[hit]] = s_active[hit]
+            s_prev[active[hit]] = max(s - step, 0)
+            s += step
+            active = active[~hit & ~at_stop]
+        return s_hit, s_prev
+
+
+    def render_array(self, R, K, R_sun=None):
+        """Renders the scene
+
+        Args:
+            R (3x3 np.array): Extrinsics of the camera
+            K (2x2 np.array): Intrinsics of the camera
+            R_sun (3x3 np.array, optional): Sun rotation matrix. Defaults to None (sun at nadir).
+
+        Returns:
+            np.array: 16-bit image
+        """
+        if getattr(self, '_normals', None) is None:
+            self.prepare()
+        W, H = self.image_xy_size
+
+        # Rays of the camera ----------------------------------------------------
+        # pixel centers to the plane of the camera (P_affine = [K R[:2,:] | (W/2,H/2)])
+        x, y = np.meshgrid(np.arange(W) + 0.5, np.arange(H) + 0.5)
+        a = ((x - W / 2) / K[0, 0]).ravel()
+        b = ((y - H / 2) / K[1, 1]).ravel()
+        # the 3rd row of R points from the camera to the scene
+        d = R[2, :] / np.linalg.norm(R[2, :])
+        plane = a[:, np.newaxis] * R[0, :] + b[:, np.newaxis] * R[1, :]
+
+        # start the rays at the top of the scene and stop them at the bottom (at h_min they hit the surface)
+        s_top = (self.h_max - plane[:, 2]) / d[2]
+        s_bottom = (self.h_min - plane[:, 2]) / d[2]
+        p0 = plane + s_top[:, np.newaxis] * d
+        step = 0.5 * self.resolution / max(np.abs(d[2]), np.linalg.norm(d[:2]))
+        s_hit, s_prev = self.march(p0, d, s_bottom - s_top, step, hit_at_stop=True)
+
+        hit = np.isfinite(s_hit)
+        p_hit = p0[hit] + s_hit[hit, np.newaxis] * d
+        p_prev = p0[hit] + s_prev[hit, np.newaxis] * d
+
+        # refine the intersection linearly between the last point above and the first below
+        h_hit, rows, cols = self.height_at(p_hit[:, 0], p_hit[:, 1])
+        h_prev, rows_prev, cols_prev = self.height_at(p_prev[:, 0], p_prev[:, 1])
+        above = p_prev[:, 2] - np.maximum(h_prev, self.h_min)
+        below = p_hit[:, 2] - h_hit
+        t = np.clip(above / np.maximum(above - below, 1e-12), 0, 1)[:, np.newaxis]
+        p_hit = p_prev + t * (p_hit - p_prev)
+
+        # Normals ---------------------------------------------------------------
+        normals = self._normals[rows, cols]
+        # rays that enter a cell through its side see a facade
+        facade = (p_hit[:, 2] < h_hit - self.resolution / 2) & ((rows != rows_prev) | (cols != cols_prev))
+        facade_normals = np.stack((-(cols - cols_prev), rows - rows_prev, np.zeros(len(rows))), axis=-1).astype(np.float64)
+        facade_normals /= np.maximum(np.linalg.norm(facade_normals, axis=-1, keepdims=True), 1e-12)
+        normals[facade] = facade_normals[facade]
+
+        # Sun -------------------------------------------------------------------
+        if R_sun is None:
+            sun = np.array([0.0, 0.0, 1.0])
+        else:
+            sun = -R_sun[2, :] / np.linalg.norm(R_sun[2, :])
+        lambert = np.clip(normals @ sun, 0, None)
+
+        # cast shadows: march from the surface to the sun until the top of the scene
+        lit = np.ones(len(p_hit), dtype=bool)
+        if sun[2] > 0:
+            sun_step = 0.5 * self.resolution / max(sun[2], np.linalg.norm(sun[:2]))
+            start = p_hit + (sun_step + 1e-3) * sun + [0, 0, 1e-3]
+            stop = (self.h_max - start[:, 2]) / sun[2]
+            s_shadow, _ = self.march(start, sun, stop, sun_step)
+            lit = ~np.isfinite(s_shadow)
+        else:
+            lit[:] = False
+
+        # Shading ---------------------------------------------------------------
+        albedo = self.albedo
+        if np.ndim(albedo) == 2:
+            albedo = np.asarray(albedo)[rows, cols]
+        shading = albedo * (self.ambient + (1 - self.ambient) * lambert * lit)
+
+        img = np.zeros(W * H)
+        img[hit] = shading * self.max_value
+        img = np.clip(np.reshape(img, (H, W)), 0, 65535)
+
+        return img.astype(np.uint16)
+
+
+    def render(self, R, K, R_sun, image_filename):
+        """Renders the scene and saves a 16-bit TIFF (render backend interface)
+
+        Args:
+            R (3x3 np.array): Extrinsics of the camera
+            K (2x2 np.array): Intrinsics of the camera
+            R_sun (3x3 np.array): Sun rotation matrix
+            image_filename (str): Filename of the rendered image
+        """
+        img = self.render_array(R, K, R_sun)
+        imsave(image_filename, img, check_contrast=False)
@@ -1,13 +1,14 @@
 import os
 
 import numpy as np
-from skimage.io import imread, imsave
+from skimage.io import imsave
 import matplotlib.pyplot as plt
-from skimage.exposure import match_histograms
 
-import ponomarenko
+import utils
+from reference_profile import compute_reference_profile
 
-def match_image_values_and_noise(img, ref_img, ponomarenko_num_bins=10):
+def match_image_values_and_noise(img, ref_img, ponomarenko_num_bins=10, rng=None, dtype=np.float64,
+                                  noise_workers=None):
     """Adapts img to match image values frecquencies and the noise of ref_img
        by histogram matching and Ponomarenko noise estimation
 
@@ -18,29 +19,72 @@ def match_image_values_and_noise(img, ref_img, ponomarenko_num_bins=10):
         img (np.array): Source image
         ref_img (np.array): Reference image
         ponomarenko_num_bins (int, optional): Number of bins to estimate the noise. Defaults to 10.
+        rng (np.random.Generator, optional): Generator of the noise. Defaults to None (unseeded generator).
+        dtype (np.dtype, optional): Type of the matched image (np.float32 or np.float64). Defaults to np.float64.
+        noise_workers (int, optional): Estimate the noise of ref_img in this number of processes
+                                       (see noise_estimation.estimate_noise_parallel). Defaults to None (ponomarenko.estimate_noise).
 
     Returns:
         np.array: Matched image
     """
+    ref_profile = compute_reference_profile(ref_img, ponomarenko_num_bins, noise_workers=noise_workers)
+    return match_image_values_and_noise_to_profile(img, ref_profile, rng, dtype)
 
-    # Match histograms of the image and the reference image
-    matched_img = match_histograms(img, ref_img)
 
-    # Noise estimation with Ponomarenko algorithm
-    ref_pono_bins, ref_pono_noise_std = ponomarenko.estimate_noise(ref_img, num_bins=ponomarenko_num_bins)
+def match_image_values_and_noise_to_profile(img, ref_profile, rng=None, dtype=np.float64, chunk_size=1<<20):
+    """Same as "match_image_values_and_noise" with the profile of the reference image 
+       (values CDF and noise curve, see reference_profile.compute_reference_profile)
+       instead of the reference image
 
-    # Noise sigma per pixel value in reference image 
-    idxs_r = get_closest_indices(ref_pono_bins, matched_img.ravel())
-    ref_img_noise_sigma = np.reshape(ref_pono_noise_std[idxs_r], matched_img.shape)
+    Args:
+        img (np.array): Source image
+        ref_profile (dict): Profile of the reference image
+        rng (np.random.Generator, optional): Generator of the noise. Defaults to None (unseeded generator).
+        dtype (np.dtype, optional): Type of the matched image (np.float32 or np.float64). Defaults to np.float64.
+        chunk_size (int, optional): Number of pixels of noise drawn at once. Defaults to 2**20.
+
+    Returns:
+        np.array: Matched image
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if img.dtype.kind in 'ui' and img.dtype.itemsize <= 2:
+        # 8 and 16-bit images (e.g. the renders): matched value and noise sigma of each gray level
+        lookup, value_lut, sigma_lut = get_matching_luts(img, ref_profile)
+        lookup = lookup.reshape(-1)
+        value_lut = value_lut.astype(dtype)
+        sigma_lut = sigma_lut.astype(dtype)
+        output_img = np.empty(img.shape, dtype=dtype)
 
-    # matched noise
-    matched_noise = np.random.normal(0,1,img.shape) * ref_img_noise_sigma
+        def match_chunk(output, chunk):
+            lookup_chunk = lookup[chunk].astype(np.intp)
+            np.take(value_lut, lookup_chunk, out=output[chunk])
+            return np.take(sigma_lut, lookup_chunk)
+    else:
+        # Match histograms of the image and the reference image
+        output_img = match_histogram_to_profile(img, ref_profile).astype(dtype, copy=False)
 
-    output_img = matched_img + matched_noise
+        # Noise sigma per pixel value in reference image (Ponomarenko noise curve)
+        noise_std = ref_profile['noise_std'].astype(dtype)
+
+        def match_chunk(output, chunk):
+            return noise_std[get_closest_indices(ref_profile['noise_bins'], output[chunk])]
+
+    # matched noise, added in place chunk by chunk (no full size temporaries)
+    output = output_img.reshape(-1)
+    for i in range(0, output.size, chunk_size):
+        chunk = slice(i, i + chunk_size)
+        ref_img_noise_sigma = match_chunk(output, chunk)
+        matched_noise = rng.standard_normal(len(ref_img_noise_sigma), dtype=dtype)
+        matched_noise *= ref_img_noise_sigma
+        output[chunk] += matched_noise
     
     return output_img
 
-def match_image_values_and_noise_ex(img_filename, ref_img_filename, output_filename, ponomarenko_num_bins=10):
+def match_image_values_and_noise_ex(img_filename, ref_img_filename, output_filename, ponomarenko_num_bins=10,
+                                    profile_store=None, seed=None, dtype=np.float64, window_size=None,
+                                    noise_workers=None, cog=False, rpc=None):
     """ Version of "match_image_values_and_noise" with images read and written to disk
 
     Args:
@@ -48,17 +92,200 @@ def match_image_values_and_noise_ex(img_filename, ref_img_filename, output_filen
         ref_img_filename (str): Reference image filename
         output_filename (str): Matched image filename
         ponomarenko_num_bins (int, optional): Number of bins to estimate the noise. Defaults to 10.
+        profile_store (ReferenceProfileStore, optional): Store of the profiles of the reference images.
+                                                         If given, the reference image is only read
+                                                         when its profile is not in the store. Defaults to None.
+        seed (int or np.random.SeedSequence, optional): Seed of the noise. Defaults to None (unseeded).
+        dtype (np.dtype, optional): Type of the matched image (np.float32 or np.float64). Defaults to np.float64.
+        window_size (int, optional): If given, the image is matched by windows of this size without being loaded
+                                     (8 or 16-bit images, see match_image_values_and_noise_windowed). Defaults to None.
+        noise_workers (int, optional): Estimate the noise of the reference image in this number of processes
+                                       (see noise_estimation.estimate_noise_parallel). Without effect with a profile store,
+                                       which has its own. Defaults to None (ponomarenko.estimate_noise).
+        cog (bool, optional): Write a Cloud Optimized GeoTIFF (see utils.writeCOG). Defaults to False.
+        rpc (rpcm.RPCModel, optional): RPC model embedded in the COG. Defaults to None.
     """
-    img = imread(img_filename)
-    ref_img = imread(ref_img_filename)
-    
-    matched_img = match_image_values_and_noise(img, ref_img, ponomarenko_num_bins)
+    if profile_store is None:
+        ref_profile = compute_reference_profile(utils.read_raster(ref_img_filename, band=1, memmap=True),
+                                                ponomarenko_num_bins,
+                                                noise_workers=noise_workers)
+    else:
+        ref_profile = profile_store.get(ref_img_filename, ponomarenko_num_bins)
+
+    if window_size is not None:
+        if not cog:
+            match_image_values_and_noise_windowed(img_filename, ref_profile, output_filename, 
+                                                  np.random.default_rng(seed), dtype, window_size)
+            return
+        # the COG driver only copies complete datasets: the windows go to an uncompressed temporary
+        # GeoTIFF, which is compressed once by the copy to the COG
+        matched_filename = output_filename + '.matched.tif'
+        try:
+            match_image_values_and_noise_windowed(img_filename, ref_profile, matched_filename, 
+                                                  np.random.default_rng(seed), dtype, window_size, compress=None)
+            utils.writeCOG(matched_filename, output_filename, rpc)
+        finally:
+            if os.path.isfile(matched_filename):
+                os.remove(matched_filename)
+        return
+
+    # native type, memory mapped if the image is not compressed
+    img = utils.read_raster(img_filename, band=1, memmap=True)
+    matched_img = match_image_values_and_noise_to_profile(img, ref_profile, np.random.default_rng(seed), dtype)
+
+    # write a new file instead of overwriting in place (the input may be a hardlink to a cached render)
+    if cog:
+        utils.writeCOG(matched_img, output_filename, rpc)
+        return
+    tmp_filename = output_filename + '.tmp.tif'
+    imsave(tmp_filename, matched_img)
+    os.replace(tmp_filename, output_filename)
 
-    imsave(output_filename, matched_img)
+
+def match_image_values_and_noise_windowed(img_filename, ref_profile, output_filename, rng=None, dtype=np.float64,
+                                          window_size=2048, compress='deflate'):
+    """Streaming version of "match_image_values_and_noise_to_profile" for very large 8 or 16-bit images
+       (e.g. tiled renders). The image is read by windows twice: a first pass accumulates its histogram
+       (global CDF) and a second pass matches the values and adds the noise of each window, which is
+       written to a tiled GeoTIFF. The memory is bounded by the window size, not by the image size.
+
+    Args:
+        img_filename (str): Source image filename (8 or 16-bit integer type)
+        ref_profile (dict): Profile of the reference image (see reference_profile.compute_reference_profile)
+        output_filename (str): Matched image filename
+        rng (np.random.Generator, optional): Generator of the noise. Defaults to None (unseeded generator).
+        dtype (np.dtype, optional): Type of the matched image (np.float32 or np.float64). Defaults to np.float64.
+        window_size (int, optional): Side of the windows in pixels. Defaults to 2048.
+        compress (str, optional): Compression of the GeoTIFF, None to write it uncompressed. Defaults to 'deflate'.
+
+    Raises:
+        ValueError: if the image is not an 8 or 16-bit integer image
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    with rasterio.open(img_filename, 'r') as src:
+        img_dtype = np.dtype(src.dtypes[0])
+        if img_dtype.kind not in 'ui' or img_dtype.itemsize > 2:
+            raise ValueError(f'match_image_values_and_noise_windowed: unsupported image type {img_dtype}')
+        # signed images are offset by the minimum of their type (the empty gray levels do not change the CDF)
+        offset = int(np.iinfo(img_dtype).min)
+        windows = [Window(x0, y0, min(window_size, src.width - x0), min(window_size, src.height - y0))
+                   for y0 in range(0, src.height, window_size) for x0 in range(0, src.width, window_size)]
+
+        # 1st pass: histogram of the image
+        src_counts = np.zeros(1 << (8 * img_dtype.itemsize), dtype=np.int64)
+        for window in windows:
+            lookup = src.read(1, window=window).astype(np.intp).reshape(-1) - offset
+            src_counts += np.bincount(lookup, minlength=len(src_counts))
+        value_lut, sigma_lut = get_matching_luts_from_counts(src_counts, ref_profile)
+        value_lut = value_lut.astype(dtype)
+        sigma_lut = sigma_lut.astype(dtype)
+
+        # 2nd pass: matched values and noise, window by window
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', dtype=np.dtype(dtype).name, count=1, tiled=True, blockxsize=256,
+                       blockysize=256, compress=compress, BIGTIFF='IF_SAFER', nodata=None)
+        profile.pop('photometric', None)
+        if compress is None:
+            profile.pop('compress')
+        tmp_filename = output_filename + '.tmp.tif'
+        try:
+            with rasterio.open(tmp_filename, 'w', **profile) as dst:
+                for window in windows:
+                    lookup = src.read(1, window=window).astype(np.intp) - offset
+                    matched_img = np.take(value_lut, lookup)
+                    matched_noise = rng.standard_normal(lookup.shape, dtype=dtype)
+                    matched_noise *= np.take(sigma_lut, lookup)
+                    matched_img += matched_noise
+                    dst.write(matched_img, 1, window=window)
+        except BaseException:
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    # write a new file instead of overwriting in place (the input may be a hardlink to a cached render)
+    os.replace(tmp_filename, output_filename)
 
 
 
 # Auxiliary function------------------------------------
+def match_histogram_to_profile(img, ref_profile):
+    """Same as skimage.exposure.match_histograms(img, ref_img) for grayscale images, 
+       with the CDF of the reference image taken from its profile
+
+    Args:
+        img (np.array): Source image
+        ref_profile (dict): Profile of the reference image (see reference_profile.compute_reference_profile)
+
+    Returns:
+        np.array: Matched image
+    """
+    if img.dtype.kind == 'u':
+        src_lookup = img.reshape(-1)
+        src_counts = np.bincount(src_lookup)
+    else:
+        src_values, src_lookup, src_counts = np.unique(img.reshape(-1), return_inverse=True, return_counts=True)
+    src_quantiles = np.cumsum(src_counts) / img.size
+
+    interp_a_values = np.interp(src_quantiles, ref_profile['quantiles'], ref_profile['values'])
+    matched_img = interp_a_values[src_lookup].reshape(img.shape)
+
+    # float32 result for float16 or float32 images (as match_histograms)
+    if img.dtype in (np.float16, np.float32):
+        matched_img = matched_img.astype(np.float32)
+    return matched_img
+
+
+def get_matching_luts(img, ref_profile):
+    """Lookup tables of the matching of an 8 or 16-bit image: for each gray level of the image, 
+       its value after histogram matching (same as match_histogram_to_profile) and the noise
+       sigma of the reference image at that value. The matching is then a lookup per pixel.
+
+    Args:
+        img (np.array): Source image (8 or 16-bit integer type)
+        ref_profile (dict): Profile of the reference image (see reference_profile.compute_reference_profile)
+
+    Returns:
+        np.array: Index of each pixel in the tables (the image itself for unsigned images)
+        np.array: Matched value of each gray level
+        np.array: Noise sigma of each gray level
+    """
+    lookup = img
+    if img.dtype.kind == 'i':
+        lookup = img.astype(np.int64) - int(img.min())
+    # histogram by chunks (np.bincount converts its input to intp)
+    flat = lookup.reshape(-1)
+    src_counts = np.zeros(int(flat.max()) + 1 if flat.size else 1, dtype=np.int64)
+    for i in range(0, flat.size, 1<<20):
+        chunk_counts = np.bincount(flat[i:i + (1<<20)])
+        src_counts[:len(chunk_counts)] += chunk_counts
+
+    value_lut, sigma_lut = get_matching_luts_from_counts(src_counts, ref_profile)
+    return lookup, value_lut, sigma_lut
+
+
+def get_matching_luts_from_counts(src_counts, ref_profile):
+    """Lookup tables of "get_matching_luts" from the histogram of the image
+
+    Args:
+        src_counts (np.array): Number of pixels of each gray level of the image
+        ref_profile (dict): Profile of the reference image (see reference_profile.compute_reference_profile)
+
+    Returns:
+        np.array: Matched value of each gray level
+        np.array: Noise sigma of each gray level
+    """
+    src_quantiles = np.cumsum(src_counts) / np.sum(src_counts)
+
+    value_lut = np.interp(src_quantiles, ref_profile['quantiles'], ref_profile['values'])
+    sigma_lut = ref_profile['noise_std'][get_closest_indices(ref_profile['noise_bins'], value_lut)]
+    return value_lut, sigma_lut
+
+
 def get_closest_indices(array, values):
     """Searchs in array the values and returns the indices where the respective 
        closest values are found.
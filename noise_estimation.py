@@ -0,0 +1,222 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
+
+
+# number of low frequency DCT coefficients (excluding DC) for each block side (get_T of the C code)
+_LOW_FREQUENCY_T = {3: 3, 5: 5, 7: 8, 8: 9, 11: 13, 15: 17, 21: 24}
+
+
+def estimate_noise_parallel(image, w=8, p=0.005, num_bins=3, D=7, curve_filter_iterations=5, mean_method=2,
+                            max_workers=None, blocks_per_task=1<<18, executor=None):
+    """Ponomarenko noise estimation (same algorithm and parameters as ponomarenko.estimate_noise)
+       with the block statistics computed in parallel processes.
+
+       The overlapping blocks of the image are split in tasks of consecutive blocks (strips of
+       the image that overlap by w-1 rows). Each task returns the mean and the low frequency
+       variance of its blocks, 8 bytes per block instead of the w*w DCT coefficients of the C code.
+       The blocks are then sorted in bins of means and the high frequency variances are only
+       computed for the blocks of lowest variance of each bin (a fraction p of the blocks).
+       The bins without any block of lowest variance (less than 1/p blocks) are left out of the curve.
+
+       The processes are started with the 'forkserver' method ('spawn' where it is not available),
+       as forking a process that runs threads (e.g. the workers of a simulation) is not safe.
+
+    Args:
+        image (2D np.array): Image on which to estimate the noise
+        w (int, optional): Block side. Defaults to 8.
+        p (float, optional): Percentile of the blocks of lowest variance used in each bin. Defaults to 0.005.
+        num_bins (int, optional): Number of bins. Defaults to 3.
+        D (int, optional): Filtering distance of the noise curve. Defaults to 7.
+        curve_filter_iterations (int, optional): Filter curve iterations. Defaults to 5.
+        mean_method (int, optional): Mean of the bins (1: mean of means, 2: median of means). Defaults to 2.
+        max_workers (int, optional): Number of processes. Defaults to None (number of cpus).
+        blocks_per_task (int, optional): Number of blocks of each task. Defaults to 2**18.
+        executor (concurrent.futures.Executor, optional): Executor of the tasks, instead of a pool of 
+                                                          max_workers processes. Defaults to None.
+
+    Raises:
+        ValueError: if the block side is not supported or the image is too small to estimate the noise
+
+    Returns:
+        np.array: Center of the bins (mean intensity)
+        np.array: Standard deviation of the noise in each bin
+    """
+    assert image.ndim == 2, 'input must be a gray image'
+    if w not in _LOW_FREQUENCY_T:
+        raise ValueError(f'estimate_noise_parallel: unknown block side {w}')
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    Ny, Nx = image.shape
+    num_blocks = (Nx - w + 1) * (Ny - w + 1)
+    if num_blocks <= 0:
+        raise ValueError('estimate_noise_parallel: the image is smaller than a block')
+    flat = image.reshape(-1)
+    T = _LOW_FREQUENCY_T[w]
+
+    # Block statistics -------------------------------------------------------
+    means = np.empty(num_blocks, dtype=np.float32)
+    VL = np.empty(num_blocks, dtype=np.float32)
+    tasks = [(q0, min(q0 + blocks_per_task, num_blocks)) for q0 in range(0, num_blocks, blocks_per_task)]
+
+    def strip(q0, q1):
+        # pixels of the blocks q0..q1-1
+        return flat[q0:q1 - 1 + (w - 1) * Nx + w]
+
+    if executor is not None:
+        futures = [executor.submit(_block_statistics, strip(q0, q1), Nx, w, T, q1 - q0) for q0, q1 in tasks]
+        for (q0, q1), future in zip(tasks, futures):
+            means[q0:q1], VL[q0:q1] = future.result()
+    elif max_workers == 1 or len(tasks) == 1:
+        for q0, q1 in tasks:
+            means[q0:q1], VL[q0:q1] = _block_statistics(strip(q0, q1), Nx, w, T, q1 - q0)
+    else:
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+            futures = [pool.submit(_block_statistics, strip(q0, q1), Nx, w, T, q1 - q0) for q0, q1 in tasks]
+            for (q0, q1), future in zip(tasks, futures):
+                means[q0:q1], VL[q0:q1] = future.result()
+
+    # Noise of each bin ------------------------------------------------------
+    # bins with the same number of blocks, sorted by mean (CHistogram of the C code)
+    order = np.argsort(means, kind='stable')
+    samples_per_bin = -(-num_blocks // num_bins)
+    C = dct_matrix(w)
+    i, j = np.meshgrid(np.arange(w), np.arange(w))
+    high = (i + j >= T)
+
+    bin_mean = np.full(num_bins, np.nan, dtype=np.float32)
+    bin_std = np.full(num_bins, np.nan, dtype=np.float32)
+    for b in range(num_bins):
+        blocks_bin = order[b * samples_per_bin:(b + 1) * samples_per_bin]
+        K = int(np.float32(len(blocks_bin)) * np.float32(p))
+        if K == 0:
+            # no block of lowest variance, the bin is left out of the curve
+            continue
+        lowest = blocks_bin[np.argsort(VL[blocks_bin], kind='stable')[:K + 1]]
+
+        # variances of the high frequency coefficients of the K blocks of lowest variance
+        coefficients = C @ get_blocks(flat, Nx, w, lowest[:K]) @ C.T
+        VH = np.sum(coefficients[:, high].astype(np.float64)**2, axis=0) / K
+        bin_std[b] = np.sqrt(np.median(VH.astype(np.float32)))
+
+        if mean_method == 1:
+            bin_mean[b] = np.mean(means[lowest])
+        elif mean_method == 2:
+            bin_mean[b] = np.median(means[lowest])
+        else:
+            raise ValueError(f'estimate_noise_parallel: unknown mean method {mean_method}')
+
+    valid = ~np.isnan(bin_std)
+    if not np.any(valid):
+        raise ValueError(f'estimate_noise_parallel: the image is too small to estimate the noise ({num_blocks} blocks)')
+    bin_mean, bin_std = bin_mean[valid], bin_std[valid]
+
+    # Filter the noise curve -------------------------------------------------
+    for filter_iteration in range(curve_filter_iterations):
+        filter_noise_curve(bin_mean, bin_std, D, allow_up=(filter_iteration < 3))
+
+    return bin_mean, bin_std
+
+
+def dct_matrix(w):
+    """Matrix of the orthonormal DCT-II of size w (the 2D DCT of a block B is C @ B @ C.T)
+
+    Args:
+        w (int): Size
+
+    Returns:
+        np.array: wxw float32 matrix
+    """
+    k, j = np.meshgrid(np.arange(w), np.arange(w), indexing='ij')
+    C = np.sqrt(2 / w) * np.cos(np.pi * (j + 0.5) * k / w)
+    C[0] /= np.sqrt(2)
+    return C.astype(np.float32)
+
+
+def get_blocks(flat, Nx, w, addresses):
+    """Blocks of an image starting at the given pixels. As in the C code, the pixels are linear
+       addresses and the blocks near the right border continue on the next rows.
+
+    Args:
+        flat (np.array): Flattened image (or strip of the image)
+        Nx (int): Width of the image
+        w (int): Block side
+        addresses (np.array or slice): Linear address of the first pixel of each block
+
+    Returns:
+        np.array: Nxwxw blocks
+    """
+    s = flat.strides[0]
+    num_blocks = len(flat) - (w - 1) * Nx - w + 1
+    all_blocks = as_strided(flat, shape=(num_blocks, w, w), strides=(s, Nx * s, s), writeable=False)
+    return all_blocks[addresses]
+
+
+def filter_noise_curve(mus, stds, D, allow_up):
+    """One iteration of the filter of the noise curve of the C code (filter_curve), in place.
+       As in the C code, the filtered stds of the first bins are used for the next ones.
+
+    Args:
+        mus (np.array): Center of the bins
+        stds (np.array): Standard deviation of the noise in each bin
+        D (int): Filtering distance
+        allow_up (bool): Allow the filter to increase the stds
+    """
+    N = len(mus)
+    if N < 2:
+        return
+    for b in range(N):
+        mu_current, std_current = mus[b], stds[b]
+        left, right = mu_current - np.float32(D), mu_current + np.float32(D)
+        if left < mus[0]:
+            dist = mus[b] - mus[0]
+            left, right = mu_current - dist, mu_current + dist
+        elif right > mus[N - 1]:
+            dist = mus[N - 1] - mus[b]
+            left, right = mu_current - dist, mu_current + dist
+
+        # interval sampled every 0.05 (in float, as in the C code)
+        samples = []
+        mu = float(left)
+        while mu <= right:
+            samples.append(mu)
+            mu = float(np.float32(mu + 0.05))
+        samples = np.array(samples, dtype=np.float32)
+
+        # linear interpolation (extrapolation) of the curve between the nearest control points
+        nearest = np.argmin(np.abs(mus[np.newaxis, :] - samples[:, np.newaxis]), axis=1)
+        i1 = np.where(samples < mus[nearest], np.maximum(nearest, 1) - 1, np.minimum(nearest, N - 2))
+        m1, m2, s1, s2 = mus[i1], mus[i1 + 1], stds[i1], stds[i1 + 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = np.where(np.abs(m1 - m2) < 1e-6, np.float32(0), (s1 - s2) / (m1 - m2))
+        std_new = np.mean((samples - m2) * slope + s2, dtype=np.float32)
+
+        stds[b] = std_new if allow_up else min(std_new, std_current)
+
+
+def _block_statistics(strip, Nx, w, T, num_blocks, chunk_size=1<<16):
+    # means and low frequency variances (VL) of the blocks of a strip of the image
+    C = dct_matrix(w)
+    theta = sum(max(0, min(w, T - u)) for u in range(w)) - 1
+
+    means = np.empty(num_blocks, dtype=np.float32)
+    VL = np.empty(num_blocks, dtype=np.float32)
+    for q in range(0, num_blocks, chunk_size):
+        n = min(chunk_size, num_blocks - q)
+        # DCT of the rows of w pixels (shared by the w overlapping blocks that contain them), then of the columns
+        rows = sliding_window_view(strip[q:q + n + (w - 1) * Nx + w - 1], w) @ C.T
+        coefficients = np.tensordot(C, np.stack([rows[r * Nx:r * Nx + n] for r in range(w)]), axes=(1, 0))
+
+        # DC coefficient = w * mean
+        means[q:q + n] = coefficients[0, :, 0] / w
+        low_energy = np.zeros(n, dtype=np.float32)
+        for u in range(min(w, T)):
+            low_energy += np.sum(coefficients[u, :, (1 if u == 0 else 0):T - u]**2, axis=1)
+        VL[q:q + n] = low_energy / theta
+    return means, VL
@@ -0,0 +1,210 @@
+import os
+import threading
+
+import numpy as np
+
+import ponomarenko
+import utils
+from file_cache import FileCache, file_content_hash
+from noise_estimation import estimate_noise_parallel
+
+
+def compute_reference_profile(ref_img, ponomarenko_num_bins=10, noise_img=None, max_cdf_size=None,
+                              noise_workers=None):
+    """Profile of a reference image: the cumulative distribution of its values (as used by
+       skimage.exposure.match_histograms) and its Ponomarenko noise curve
+
+    Args:
+        ref_img (np.array): Reference image (or a subsampled version of it for the CDF)
+        ponomarenko_num_bins (int, optional): Number of bins to estimate the noise. Defaults to 10.
+        noise_img (np.array, optional): Full resolution image (or crops) to estimate the noise.
+                                        Defaults to None (ref_img).
+        max_cdf_size (int, optional): Maximum number of points of the CDF. Images with more distinct
+                                      values keep max_cdf_size points of their CDF. Defaults to None (all).
+        noise_workers (int, optional): Estimate the noise with noise_estimation.estimate_noise_parallel in this
+                                       number of processes instead of ponomarenko.estimate_noise. 
+                                       Defaults to None (ponomarenko.estimate_noise).
+
+    Returns:
+        dict: Profile with 'values' and 'quantiles' (CDF), 'noise_bins' and 'noise_std' (noise curve)
+    """
+    if noise_img is None:
+        noise_img = ref_img
+
+    # same CDF as skimage.exposure.match_histograms
+    if ref_img.dtype.kind == 'u':
+        counts = np.bincount(ref_img.reshape(-1))
+        values = np.nonzero(counts)[0]
+        counts = counts[values]
+    else:
+        values, counts = np.unique(ref_img.reshape(-1), return_counts=True)
+    quantiles = np.cumsum(counts) / ref_img.size
+
+    if max_cdf_size is not None and len(values) > max_cdf_size:
+        keep = np.unique(np.linspace(0, len(values) - 1, max_cdf_size).round().astype(np.int64))
+        values = values[keep]
+        quantiles = quantiles[keep]
+
+    if noise_workers is None:
+        noise_bins, noise_std = ponomarenko.estimate_noise(noise_img, num_bins=ponomarenko_num_bins)
+    else:
+        noise_bins, noise_std = estimate_noise_parallel(noise_img, num_bins=ponomarenko_num_bins,
+                                                        max_workers=noise_workers)
+
+    return {'values': np.asarray(values, dtype=np.float64),
+            'quantiles': np.asarray(quantiles, dtype=np.float64),
+            'noise_bins': np.asarray(noise_bins),
+            'noise_std': np.asarray(noise_std)}
+
+
+def read_reference_image(ref_img_filename, max_pixels=None, window_size=256):
+    """Reads a reference image to compute its profile. Images with more than max_pixels pixels
+       are not read completely: the CDF is computed on a decimated read (the overviews of the
+       file are used if it has them) and the noise on a mosaic of full resolution windows spread
+       over the image, since decimation would change the noise.
+
+    Args:
+        ref_img_filename (str): Reference image filename
+        max_pixels (int, optional): Maximum number of pixels read for the CDF and for the noise.
+                                    Defaults to None (the whole image).
+        window_size (int, optional): Side of the windows of the noise mosaic. Defaults to 256.
+
+    Returns:
+        np.array: Image for the CDF
+        np.array: Image for the noise
+    """
+    import rasterio
+
+    with rasterio.open(ref_img_filename, 'r') as f:
+        H, W = f.height, f.width
+    if max_pixels is None or H * W <= max_pixels:
+        # native type, memory mapped if the image is not compressed
+        img = utils.read_raster(ref_img_filename, band=1, memmap=True)
+        return img, img
+
+    # decimated read for the CDF
+    factor = np.sqrt(H * W / max_pixels)
+    out_shape = (max(1, int(H / factor)), max(1, int(W / factor)))
+    cdf_img = utils.read_raster(ref_img_filename, band=1, out_shape=out_shape)
+
+    # grid of full resolution windows for the noise
+    window_size = min(window_size, H, W)
+    n = max(1, int(np.sqrt(max_pixels) // window_size))
+    rows = np.linspace(0, H - window_size, n).astype(np.int64)
+    cols = np.linspace(0, W - window_size, n).astype(np.int64)
+    noise_img = np.block([[utils.read_raster(ref_img_filename, band=1, memmap=True,
+                                             window=((r, r + window_size), (c, c + window_size))) for c in cols]
+                          for r in rows])
+
+    return cdf_img, noise_img
+
+
+def save_reference_profile(profile, filename):
+    """Saves a profile (see compute_reference_profile) in a .npz file
+
+    Args:
+        profile (dict): Profile
+        filename (str): Filename
+    """
+    with open(filename, 'wb') as f:
+        np.savez(f, **profile)
+
+
+def load_reference_profile(filename):
+    """Loads a profile saved with save_reference_profile
+
+    Args:
+        filename (str): Filename
+
+    Returns:
+        dict: Profile
+    """
+    with np.load(filename) as data:
+        return {k: data[k] for k in data.files}
+
+
+class ReferenceProfileStore():
+    """Persistent store of the profiles of reference images (see compute_reference_profile).
+       The profiles are kept in a FileCache, keyed by the content hash of the reference image,
+       the number of noise bins and the read parameters, and in memory once loaded. The reference
+       image is read only the first time its profile is needed.
+    """
+    def __init__(self, cache_dir, max_size_in_bytes=2**30, max_pixels=None, max_cdf_size=65536,
+                 noise_workers=None):
+        """Construction
+
+        Args:
+            cache_dir (str): Directory of the store. Created if it does not exist.
+            max_size_in_bytes (int, optional): Maximum total size of the profiles. Defaults to 1 GiB.
+            max_pixels (int, optional): Maximum number of pixels read from large reference images
+                                        (see read_reference_image). Defaults to None (whole image).
+            max_cdf_size (int, optional): Maximum number of points of the stored CDFs (see 
+                                          compute_reference_profile). Defaults to 65536.
+            noise_workers (int, optional): Number of processes of the noise estimation (see 
+                                           compute_reference_profile). Defaults to None (ponomarenko).
+        """
+        self.cache = FileCache(cache_dir, max_size_in_bytes)
+        self.max_pixels = max_pixels
+        self.max_cdf_size = max_cdf_size
+        self.noise_workers = noise_workers
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+
+    def __str__(self):
+        s = 'ReferenceProfileStore\n'
+        s+= f'Cache directory: {self.cache.cache_dir}\n'
+        s+= f'Max pixels: {self.max_pixels}'
+        return(s)
+
+
+    def key(self, ref_img_filename, ponomarenko_num_bins=10):
+        """Key of the profile of a reference image
+
+        Args:
+            ref_img_filename (str): Reference image filename
+            ponomarenko_num_bins (int, optional): Number of bins to estimate the noise. Defaults to 10.
+
+        Returns:
+            str: key
+        """
+        parts = ['reference profile', file_content_hash(ref_img_filename),
+                 ponomarenko_num_bins, self.max_pixels, self.max_cdf_size]
+        if self.noise_workers is not None:
+            # the estimators agree up to float rounding, the number of processes does not change the profile
+            parts.append('noise_estimation.estimate_noise_parallel')
+        return FileCache.key(*parts)
+
+
+    def get(self, ref_img_filename, ponomarenko_num_bins=10):
+        """Profile of a reference image, computed and stored if it is not in the store
+
+        Args:
+            ref_img_filename (str): Reference image filename
+            ponomarenko_num_bins (int, optional): Number of bins to estimate the noise. Defaults to 10.
+
+        Returns:
+            dict: Profile (see compute_reference_profile)
+        """
+        key = self.key(ref_img_filename, ponomarenko_num_bins)
+        with self.lock:
+            if key in self.profiles:
+                return self.profiles[key]
+
+        tmp_filename = os.path.join(self.cache.cache_dir, f'{key}.{os.getpid()}.{threading.get_ident()}.npz.tmp')
+        try:
+            if self.cache.fetch(key, tmp_filename, link=False):
+                profile = load_reference_profile(tmp_filename)
+            else:
+                cdf_img, noise_img = read_reference_image(ref_img_filename, self.max_pixels)
+                profile = compute_reference_profile(cdf_img, ponomarenko_num_bins, noise_img, self.max_cdf_size,
+                                                    self.noise_workers)
+                save_reference_profile(profile, tmp_filename)
+                self.cache.store(key, tmp_filename, link=False)
+        finally:
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+
+        with self.lock:
+            self.profiles[key] = profile
+        return profile
@@ -0,0 +1,292 @@
+#
+# Vectorized evaluation and validation of RPC models
+#
+import numpy as np
+import rpcm
+
+import utils
+from grid_util import get_aoi_center
+
+
+def rpc_monomials(x, y, z, out=None):
+    '''
+    Monomials of degree <= 3 of (x, y, z) in the order of the RPC
+    coefficients (see rpcm.rpc_model.apply_poly), so a polynomial is a
+    product of the monomials by its 20 coefficients.
+
+    Parameters
+    ----------
+    x, y, z : 1D np.array
+        Normalized coordinates of the points.
+    out : 20xN np.array, optional
+        Array where the monomials are written. The default is None (new array).
+
+    Returns
+    -------
+    20xN np.array
+        Monomials of each point (one row per monomial, so each row is 
+        contiguous in memory).
+
+    '''
+    if out is None:
+        out = np.empty((20, len(x)))
+    out[0] = 1
+    out[1] = y
+    out[2] = x
+    out[3] = z
+    np.multiply(y, x, out=out[4])
+    np.multiply(y, z, out=out[5])
+    np.multiply(x, z, out=out[6])
+    np.multiply(y, y, out=out[7])
+    np.multiply(x, x, out=out[8])
+    np.multiply(z, z, out=out[9])
+    np.multiply(out[4], z, out=out[10])
+    np.multiply(out[7], y, out=out[11])
+    np.multiply(out[8], y, out=out[12])
+    np.multiply(out[9], y, out=out[13])
+    np.multiply(out[7], x, out=out[14])
+    np.multiply(out[8], x, out=out[15])
+    np.multiply(out[9], x, out=out[16])
+    np.multiply(out[7], z, out=out[17])
+    np.multiply(out[8], z, out=out[18])
+    np.multiply(out[9], z, out=out[19])
+    return out
+
+
+class RPCEvaluator():
+    '''
+    Vectorized projection and localization of an RPC model. The numerators
+    and denominators are stacked in one matrix of coefficients, so each chunk
+    of points is evaluated with one product by its monomials (see
+    rpc_monomials) and the memory is bounded by the chunk size.
+
+    Parameters
+    ----------
+    rpc : rpcm.RPCModel
+        RPC model.
+    chunk_size : int, optional
+        Number of points evaluated at once. The default is 100000.
+    '''
+    def __init__(self, rpc, chunk_size=100000):
+        self.rpc = rpc
+        self.chunk_size = chunk_size
+        # rows: col_num, col_den, row_num, row_den
+        self.projection_coefficients = np.array([rpc.col_num, rpc.col_den,
+                                                 rpc.row_num, rpc.row_den], dtype=np.float64)
+        if getattr(rpc, 'lat_num', None) is not None:
+            # rows: lon_num, lon_den, lat_num, lat_den
+            self.localization_coefficients = np.array([rpc.lon_num, rpc.lon_den,
+                                                       rpc.lat_num, rpc.lat_den], dtype=np.float64)
+        else:
+            self.localization_coefficients = None
+
+
+    @staticmethod
+    def from_rpc_file(rpc_filename, chunk_size=100000):
+        '''
+        Evaluator of an RPC file (see rpcm.rpc_from_rpc_file)
+        '''
+        return RPCEvaluator(rpcm.rpc_from_rpc_file(rpc_filename), chunk_size)
+
+
+    def _apply(self, coefficients, x, y, z):
+        # rational functions of the normalized points, in chunks
+        x, y, z = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64).ravel() for v in (x, y, z)))
+        out_u = np.empty(len(x))
+        out_v = np.empty(len(x))
+        monomials = np.empty((20, min(self.chunk_size, len(x))))
+        for i in range(0, len(x), self.chunk_size):
+            s = slice(i, i + self.chunk_size)
+            m = rpc_monomials(x[s], y[s], z[s], out=monomials[:, :len(x[s])])
+            values = coefficients @ m
+            np.divide(values[0], values[1], out=out_u[s])
+            np.divide(values[2], values[3], out=out_v[s])
+        return out_u, out_v
+
+
+    def projection(self, lon, lat, alt):
+        '''
+        Image coordinates of 3D points (same as rpcm.RPCModel.projection)
+
+        Parameters
+        ----------
+        lon, lat, alt : np.array
+            Geodetic coordinates of the points.
+
+        Returns
+        -------
+        col : 1D np.array
+            Column (x) of the points in the image.
+        row : 1D np.array
+            Row (y) of the points in the image.
+
+        '''
+        rpc = self.rpc
+        nlon = (np.asarray(lon) - rpc.lon_offset) / rpc.lon_scale
+        nlat = (np.asarray(lat) - rpc.lat_offset) / rpc.lat_scale
+        nalt = (np.asarray(alt) - rpc.alt_offset) / rpc.alt_scale
+        col, row = self._apply(self.projection_coefficients, nlat, nlon, nalt)
+        return col * rpc.col_scale + rpc.col_offset, row * rpc.row_scale + rpc.row_offset
+
+
+    def localization(self, col, row, alt, tol=1e-10, max_iter=20):
+        '''
+        Geodetic coordinates of image points at given altitudes (same as
+        rpcm.RPCModel.localization). If the RPC has no localization
+        coefficients, the projection is inverted with Newton iterations.
+
+        Parameters
+        ----------
+        col, row : np.array
+            Image coordinates of the points.
+        alt : np.array
+            Altitudes of the points.
+        tol : float, optional
+            Tolerance in pixels of the Newton iterations. The iterations also 
+            stop when the error does not decrease (at the resolution of the 
+            float coordinates). The default is 1e-10.
+        max_iter : int, optional
+            Maximum number of Newton iterations. The default is 20.
+
+        Returns
+        -------
+        lon : 1D np.array
+            Longitudes of the points.
+        lat : 1D np.array
+            Latitudes of the points.
+
+        '''
+        rpc = self.rpc
+        col, row, alt = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64).ravel() for v in (col, row, alt)))
+        if self.localization_coefficients is not None:
+            ncol = (col - rpc.col_offset) / rpc.col_scale
+            nrow = (row - rpc.row_offset) / rpc.row_scale
+            nalt = (alt - rpc.alt_offset) / rpc.alt_scale
+            lon, lat = self._apply(self.localization_coefficients, nrow, ncol, nalt)
+            return lon * rpc.lon_scale + rpc.lon_offset, lat * rpc.lat_scale + rpc.lat_offset
+
+        # Newton iterations from the center of the RPC domain (the Jacobian by finite differences)
+        lon = np.full(len(col), float(rpc.lon_offset))
+        lat = np.full(len(col), float(rpc.lat_offset))
+        d_lon = 1e-6 * rpc.lon_scale
+        d_lat = 1e-6 * rpc.lat_scale
+        error_prev = np.inf
+        for n_iter in range(max_iter):
+            c0, r0 = self.projection(lon, lat, alt)
+            dc, dr = c0 - col, r0 - row
+            error = np.max(np.hypot(dc, dr))
+            if error < tol or error >= error_prev:
+                break
+            error_prev = error
+            c1, r1 = self.projection(lon + d_lon, lat, alt)
+            c2, r2 = self.projection(lon, lat + d_lat, alt)
+            a, b = (c1 - c0) / d_lon, (c2 - c0) / d_lat
+            c, d = (r1 - r0) / d_lon, (r2 - r0) / d_lat
+            det = a * d - b * c
+            lon = lon - (d * dc - b * dr) / det
+            lat = lat - (a * dr - c * dc) / det
+        return lon, lat
+
+
+def validate_rpc(rpc, P_affine, aoi, altitude_range, lon_lat_alt_origin=None,
+                 num_points=1000000, num_altitude_slices=10, chunk_size=100000,
+                 localization=True, seed=0):
+    '''
+    Errors of an RPC with respect to the affine camera it was fitted to, over
+    num_points random points of the VOI (uniform in the UTM bounding box of
+    the AOI and the altitude range, not restricted to the mesh of the fit).
+    The points are generated and evaluated in chunks, so the memory does not
+    depend on num_points.
+
+    Parameters
+    ----------
+    rpc : rpcm.RPCModel or str
+        RPC model or RPC filename.
+    P_affine : 2x4 np.array
+        Local affine camera model.
+    aoi : geojson Polygon
+        Area of interest.
+    altitude_range : list
+        Minimum and maximum altitudes.
+    lon_lat_alt_origin : 3-tuple or list, optional
+        Origin of the local coordinates. If None, then the center of the AOI
+        and altitude=0  are used
+    num_points : int, optional
+        Number of points. The default is 1000000.
+    num_altitude_slices : int, optional
+        Number of slices of the altitude range of the per slice errors. The default is 10.
+    chunk_size : int, optional
+        Number of points evaluated at once. The default is 100000.
+    localization : bool, optional
+        Also compute the localization errors (in meters, at the altitude of
+        the points). The default is True.
+    seed : int, optional
+        Seed of the points. The default is 0.
+
+    Returns
+    -------
+    dict
+        Report with the number of points, the RMSE and maximum projection
+        errors in pixels (distance between the projections), the same errors
+        for each altitude slice and, if localization, the RMSE and maximum
+        localization errors in meters.
+
+    '''
+    evaluator = RPCEvaluator.from_rpc_file(rpc, chunk_size) if isinstance(rpc, str) else RPCEvaluator(rpc, chunk_size)
+    P_affine = np.asarray(P_affine, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+
+    if lon_lat_alt_origin is None:
+        lon, lat = get_aoi_center(aoi)
+        lon_lat_alt_origin = [lon, lat, 0]
+    utm_origin = utils.utm_from_lonlat([lon_lat_alt_origin[0]], [lon_lat_alt_origin[1]])
+    e0, n0, u0 = utm_origin[0][0], utm_origin[1][0], lon_lat_alt_origin[2]
+
+    min_easting, max_easting, min_northing, max_northing = utils.utm_bounding_box_from_lonlat_aoi(aoi)
+    epsg = utils.utm_epsg_from_lonlat(aoi['coordinates'][0][0][0], aoi['coordinates'][0][0][1])
+    h_min, h_max = altitude_range
+    slice_edges = np.linspace(h_min, h_max, num_altitude_slices + 1)
+
+    # accumulated errors: sum of squares and maximum (overall and per slice)
+    slice_counts = np.zeros(num_altitude_slices, dtype=np.int64)
+    slice_sq = np.zeros(num_altitude_slices)
+    slice_max = np.zeros(num_altitude_slices)
+    loc_sq = 0.0
+    loc_max = 0.0
+    for i in range(0, num_points, chunk_size):
+        n = min(chunk_size, num_points - i)
+        easts = rng.uniform(min_easting, max_easting, n)
+        norths = rng.uniform(min_northing, max_northing, n)
+        alts = rng.uniform(h_min, h_max, n)
+        lons, lats = utils.transform_coords(epsg, 4326, easts, norths)
+
+        locs_enu = np.vstack((easts - e0, norths - n0, alts - u0)).T
+        target = locs_enu @ P_affine[:, :3].T + P_affine[:, 3]
+        col, row = evaluator.projection(lons, lats, alts)
+        errors = np.hypot(col - target[:, 0], row - target[:, 1])
+
+        slices = np.clip(np.searchsorted(slice_edges, alts, side='right') - 1, 0, num_altitude_slices - 1)
+        slice_counts += np.bincount(slices, minlength=num_altitude_slices)
+        slice_sq += np.bincount(slices, weights=errors**2, minlength=num_altitude_slices)
+        np.maximum.at(slice_max, slices, errors)
+
+        if localization:
+            # ground truth: the point of the VOI seen at the target pixel (the affine camera is exact)
+            loc_lons, loc_lats = evaluator.localization(target[:, 0], target[:, 1], alts)
+            loc_easts, loc_norths = utils.transform_coords(4326, epsg, loc_lons, loc_lats)
+            loc_errors = np.hypot(loc_easts - easts, loc_norths - norths)
+            loc_sq += np.sum(loc_errors**2)
+            loc_max = max(loc_max, float(np.max(loc_errors)))
+
+    report = {'num_points': int(num_points),
+              'rmse': float(np.sqrt(np.sum(slice_sq) / num_points)),
+              'max_error': float(np.max(slice_max)),
+              'altitude_slices': [{'altitude_range': [float(slice_edges[k]), float(slice_edges[k+1])],
+                                   'num_points': int(slice_counts[k]),
+                                   'rmse': float(np.sqrt(slice_sq[k] / slice_counts[k])) if slice_counts[k] else None,
+                                   'max_error': float(slice_max[k]) if slice_counts[k] else None}
+                                  for k in range(num_altitude_slices)]}
+    if localization:
+        report.update(localization_rmse_meters=float(np.sqrt(loc_sq / num_points)),
+                      localization_max_error_meters=loc_max)
+    return report
@@ -2,13 +2,25 @@ import os
 import paffine
 from satellite import Satellite
 from blender import Blender
+from blender_worker_pool import BlenderWorkerPool
 from location import Location
 import paffine
 import rpcfit_util
+import rpcm
+import utils
 
+import asyncio
 import copy
+import hashlib
+import queue
 import subprocess
+import threading
 import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio.windows import Window
 from util import save_txt
 
 import pickle
@@ -19,10 +31,43 @@ from  matching import match_image_values_and_noise_ex
 class Simulator():
     """Manager for the simulation.
     """ 
+    # Blender workers (see start_blender_workers). Not persisted with the simulation.
+    blender_worker_pool = None
+    # Render backend used instead of Blender. Not persisted with the simulation.
+    render_backend = None
+    # Render cache shared between simulations (see FileCache). Not persisted with the simulation.
+    render_cache = None
+    # RPC cache shared between simulations (see FileCache). Not persisted with the simulation.
+    rpc_cache = None
+    # Solver of the RPC fits (see rpcfit_util.compute_rpcs_from_affine_cameras). Not persisted with the simulation.
+    rpc_solver = 'rpcfit'
+    # Fits of the session used to warm start the RPC fits (see rpcfit_util.RPCFitRegistry). Not persisted with the simulation.
+    rpc_fit_registry = None
+    # Number of points of the validation reports of the RPCs (see rpcfit_util.compute_rpcs_from_affine_cameras). Not persisted with the simulation.
+    rpc_validation_points = 100000
+    # Profiles of the target images shared between simulations (see ReferenceProfileStore). Not persisted with the simulation.
+    reference_profile_store = None
+    # Seed of the noise added to the matched images (see match_view_image). Not persisted with the simulation.
+    noise_seed = None
+    # Write the images as Cloud Optimized GeoTIFFs with their RPC (see finish_view_image). Not persisted with the simulation.
+    cog_output = False
+    # Type of the matched images (see match_view_image). Not persisted with the simulation.
+    match_dtype = np.float64
+
     def __init__(self, base_dir:str, 
                  satellite:Satellite=None, 
                  blender:Blender=None,
                  location:Location=None,
+                 render_backend=None,
+                 render_cache=None,
+                 rpc_cache=None,
+                 rpc_solver='rpcfit',
+                 warm_start_rpc_fits=False,
+                 rpc_validation_points=100000,
+                 reference_profile_store=None,
+                 noise_seed=None,
+                 cog_output=False,
+                 match_dtype=np.float64,
                  ):
         """ Construction
             Simulator(base_dir)   for an existing sim
@@ -33,6 +78,35 @@ class Simulator():
             satellite (Satellite, optional): Satellite instance. Defaults to None.
             blender (Blender, optional): Blender instance. Defaults to None.
             location (Location, optional): Location instance. Defaults to None.
+            render_backend (optional): Renders the images instead of Blender. Any object with an "image_xy_size"
+                                       attribute and a method render(R, K, R_sun, image_filename), for instance
+                                       a HeightmapRenderer. If given, blender is not required. Defaults to None.
+            render_cache (FileCache, optional): Cache of Blender renders shared between simulations. The renders
+                                                of the same scene and view found in the cache are hardlinked
+                                                (or copied) instead of rendered. Defaults to None.
+            rpc_cache (FileCache, optional): Cache of fitted RPCs shared between simulations. The RPCs of the
+                                             same camera and location found in the cache are not fitted again.
+                                             Defaults to None.
+            rpc_solver (str, optional): Solver of the RPC fits: 'rpcfit', 'linear' or 'fast' (see 
+                                        rpcfit_util.compute_rpcs_from_affine_cameras). Defaults to 'rpcfit'.
+            warm_start_rpc_fits (bool, optional): Warm start the 'rpcfit' fits from the nearest view already
+                                                  fitted in the session (faster for sweeps of close views, the
+                                                  RPCs differ from a full fit by ~1e-7 pixels). Defaults to False.
+            rpc_validation_points (int, optional): Number of VOI points where each RPC is compared to its affine
+                                                   camera. The errors are saved next to the RPC (RPCFIT/<view>.json).
+                                                   None disables the validation. Defaults to 100000.
+            reference_profile_store (ReferenceProfileStore, optional): Store of the value distributions and
+                                                   noise curves of the target images. The target images are
+                                                   only read the first time they are used. Defaults to None.
+            noise_seed (int, optional): Seed of the noise added to the matched images. Each view has its own
+                                        random stream derived from the seed and its image filename, so the
+                                        images are reproducible whatever the order or the parallelism of
+                                        the simulation. Defaults to None (not reproducible).
+            cog_output (bool, optional): Write the images as Cloud Optimized GeoTIFFs (tiled, compressed, with 
+                                         overviews) with the RPC of the view embedded in their RPC metadata. 
+                                         The RPC files are still written. Defaults to False.
+            match_dtype (np.dtype, optional): Type of the images matched to a target image, np.float64 or 
+                                              np.float32 (half the memory and disk). Defaults to np.float64.
 
         Raises:
             ValueError: if trying to overwrite an existing sim or trying to read an unexisting sim
@@ -42,6 +116,16 @@ class Simulator():
         self.satellite = satellite
         self.blender = blender
         self.location = location
+        self.render_backend = render_backend
+        self.render_cache = render_cache
+        self.rpc_cache = rpc_cache
+        self.rpc_solver = rpc_solver
+        self.rpc_fit_registry = rpcfit_util.RPCFitRegistry() if warm_start_rpc_fits else None
+        self.rpc_validation_points = rpc_validation_points
+        self.reference_profile_store = reference_profile_store
+        self.noise_seed = noise_seed
+        self.cog_output = cog_output
+        self.match_dtype = match_dtype
         
         
         self.init_directorynames_and_filenames()
@@ -57,16 +141,17 @@ class Simulator():
             else:
                 raise ValueError('Simulator: base directory exists but is NOT VALID!')
         else:
-            if self.satellite is None or self.blender is None:
+            if self.satellite is None or (self.blender is None and self.render_backend is None):
                 print('Simulator: base directory does not exist. Satellite and or Blender NOT VALID')
                 exit(2)
             else:
                 self.init_directories()
 
-                # save blender model in the simulation tree
-                shutil.copy(blender.scene_filename,  self.blender_model_dir)
-                # update the blender scene filename
-                blender.scene_filename = os.path.join(self.blender_model_dir, os.path.basename(blender.scene_filename))
+                if blender is not None:
+                    # save blender model in the simulation tree
+                    shutil.copy(blender.scene_filename,  self.blender_model_dir)
+                    # update the blender scene filename
+                    blender.scene_filename = os.path.join(self.blender_model_dir, os.path.basename(blender.scene_filename))
                 
                 # persist the Simulation configuration
                 self.serialize()
@@ -94,6 +179,22 @@ class Simulator():
         os.makedirs(self.rpcfit_dir)
         
     
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('blender_worker_pool', None)
+        state.pop('render_backend', None)
+        state.pop('render_cache', None)
+        state.pop('rpc_cache', None)
+        state.pop('rpc_solver', None)
+        state.pop('rpc_fit_registry', None)
+        state.pop('rpc_validation_points', None)
+        state.pop('reference_profile_store', None)
+        state.pop('noise_seed', None)
+        state.pop('cog_output', None)
+        state.pop('match_dtype', None)
+        return state
+
+
     def serialize(self):
         """Save the simulator as a pickle
         """
@@ -143,53 +244,1032 @@ class Simulator():
         """
         
         # Filenames ---------------------------------------------------------------
-        view_and_sun_name = f'view_ze_{zenith_in_degrees:05.1f}_view_az_{azimuth_in_degrees:05.1f}_sun_ze_{sun_zenith_in_degrees:05.1f}_sun_az_{sun_azimuth_in_degrees:05.1f}'
-        view_name = f'view_ze_{zenith_in_degrees:05.1f}_view_az_{azimuth_in_degrees:05.1f}' 
+        filenames = self.get_view_filenames(zenith_in_degrees, azimuth_in_degrees,
+                                            sun_zenith_in_degrees, sun_azimuth_in_degrees)
         # (a) the filename that will output the blender rendering
-        image_filename = os.path.join(self.images_dir, f'{view_and_sun_name}_0001.tif')
-        # (b) the filename we will tell to blender in order to finally get (a) 
-        image_filename_for_blender = image_filename[:-8] 
-        # (c) the filename of the python camera script for blender
-        blender_camera_script_filename = os.path.join(self.blender_camera_dir, f'blender_camera_{view_and_sun_name}.py')
-        # (d) the filename of the shell script that will run Blender
-        blender_command_filename = os.path.join(self.blender_command_dir, f'blender_command_{view_and_sun_name}.sh')
-        # (e) the filename for the rpc model
-        rpcfit_filename = os.path.join(self.rpcfit_dir, f'rpcfit_{view_name}.txt')
+        image_filename = filenames['image']
+        # (b) the filename for the rpc model
+        rpcfit_filename = filenames['rpcfit']
         
         
         # Create the image and the rpc---------------------------------------------
         if (not os.path.isfile(image_filename) or not os.path.isfile(rpcfit_filename)) or overwrite:
             
-            # Compute affine projection matrix from orientation
-            P_affine, K, R, t = \
-            paffine.compute_P_affine(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees, self.blender.image_xy_size,
-                                    self.satellite.view_pixels_per_meter(zenith_in_degrees))
-            
-            # Conpute the rpc from the affine projection matrix. Saves result in Ikonos format
-            rpcfit_util.compute_rpc_from_affine_camera(P_affine, self.location.aoi, self.location.altitude_range, 
-                                                       rpcfit_filename, lon_lat_alt_origin=self.location.lon_lat_alt_origin)
+            # Compute affine projection matrix from orientation and fit the rpc
+            P_affine, K, R = self.compute_view_camera_and_rpc(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees,
+                                                              rpcfit_filename)
             
             # sun rotation from sun_zenith, sun_azimuth
             R_sun = paffine.camera_rotation_matrix_from_view_angles(sun_zenith_in_degrees, sun_azimuth_in_degrees)
             
-            # Get the blender_camera_script
-            blender_camera_script = self.blender.get_blender_camera_position_script(R, K, R_sun)
-            
-            # Get the blender command. 
-            blender_command = self.blender.get_blender_command(blender_camera_script_filename, image_filename_for_blender)
-            
-            #save scripts
-            save_txt(blender_camera_script_filename, blender_camera_script)
-            save_txt(blender_command_filename, blender_command)
-            
-            # run Blender
-            subprocess.call(blender_command, shell=True)
+            # Render the image
+            self.render_view(R, K, R_sun, filenames)
 
-            if not target_img_filename is None:
-                match_image_values_and_noise_ex(image_filename, target_img_filename, 
-                                                 output_filename=image_filename)
+            self.finish_view_image(image_filename, rpcfit_filename, target_img_filename)
 
                 
 
         return image_filename, rpcfit_filename
-    
\ No newline at end of file
+
+
+    def simulate_sun_positions(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees=None,
+                               sun_positions=None,
+                               target_img_filename=None,
+                               overwrite=False,
+                               ):
+        """Generates the images of a view for several sun positions and the RPC of the view.
+        The camera is set up and the RPC is fitted once. All the images are rendered in a single 
+        Blender session (or by the Blender workers if they were started), only the sun changes 
+        between renders.
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double, optional): Reserved for future use, not implemented yet. Defaults to None.
+            sun_positions (list, optional): List of (sun_zenith, sun_azimuth) in degrees. 
+                                            Defaults to None (sun at nadir, [(0, 0)]).
+            target_img_filename (str, optional): Filename of image to match values and noise. Defaults to None
+            overwrite (bool, optional): Regenerate existing images and RPC. Defaults to False.
+
+        Raises:
+            ValueError: if sun_positions is empty
+            RuntimeError: if some image could not be rendered
+
+        Returns:
+            list: One (image_filename, rpcfit_filename) tuple per sun position
+        """
+        if sun_positions is None:
+            sun_positions = [(0, 0)]
+        if len(sun_positions) == 0:
+            raise ValueError('Simulator: simulate_sun_positions needs at least one sun position')
+
+        filenames = [self.get_view_filenames(zenith_in_degrees, azimuth_in_degrees, sun_zenith, sun_azimuth)
+                     for sun_zenith, sun_azimuth in sun_positions]
+        rpcfit_filename = filenames[0]['rpcfit']
+
+        # Camera and rpc (once for all the sun positions) -------------------------
+        if not os.path.isfile(rpcfit_filename) or overwrite:
+            P_affine, K, R = self.compute_view_camera_and_rpc(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees,
+                                                              rpcfit_filename)
+        else:
+            P_affine, K, R = self.compute_view_camera(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees)
+
+        # Images ------------------------------------------------------------------
+        pending = [i for i in range(len(sun_positions)) if not os.path.isfile(filenames[i]['image']) or overwrite]
+
+        R_suns = {i: paffine.camera_rotation_matrix_from_view_angles(*sun_positions[i]) for i in pending}
+
+        if self.render_backend is not None or self.blender_worker_pool is not None:
+            for i in pending:
+                self.render_view(R, K, R_suns[i], filenames[i])
+        elif pending:
+            blender_camera_script = self.blender.get_blender_camera_script(R, K)
+            position_scripts = {i: blender_camera_script + self.blender.get_blender_sun_script(R_suns[i]) for i in pending}
+
+            # renders of the view found in the render cache
+            to_render = [i for i in pending if not self.fetch_render_from_cache(position_scripts[i], filenames[i]['image'])]
+            if to_render:
+                # the camera is positioned by the first job, the following jobs only rotate the sun
+                render_jobs = []
+                for n, i in enumerate(to_render):
+                    script = position_scripts[i] if n == 0 else position_scripts[i][len(blender_camera_script):]
+                    render_jobs.append((script, filenames[i]['image']))
+                    if os.path.isfile(filenames[i]['image']):
+                        os.remove(filenames[i]['image'])
+
+                view_name = os.path.splitext(os.path.basename(rpcfit_filename))[0][len('rpcfit_'):]
+                blender_batch_script_filename = os.path.join(self.blender_camera_dir, f'blender_suns_{view_name}.py')
+                blender_command_filename = os.path.join(self.blender_command_dir, f'blender_command_suns_{view_name}.sh')
+
+                blender_batch_script = self.blender.get_blender_batch_script(render_jobs)
+                blender_command = self.blender.get_blender_batch_command(blender_batch_script_filename)
+                save_txt(blender_batch_script_filename, blender_batch_script)
+                save_txt(blender_command_filename, blender_command)
+
+                return_code = subprocess.call(blender_command, shell=True)
+                failed = [filenames[i]['image'] for i in to_render if not os.path.isfile(filenames[i]['image'])]
+                if failed:
+                    raise RuntimeError(f'Simulator: Blender failed to render {failed} (return code {return_code})')
+
+                for i in to_render:
+                    self.store_render_in_cache(position_scripts[i], filenames[i]['image'])
+
+        for i in pending:
+            self.finish_view_image(filenames[i]['image'], rpcfit_filename, target_img_filename)
+
+        return [(f['image'], f['rpcfit']) for f in filenames]
+
+
+    def simulate_image_and_rpcfit_tiled(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees=None, 
+                                        sun_zenith_in_degrees=0, sun_azimuth_in_degrees=0,
+                                        target_img_filename=None,
+                                        overwrite=False,
+                                        tile_size=2048,
+                                        max_workers=None,
+                                        ):
+        """Version of "simulate_image_and_rpcfit" for very large images. The image is split in tiles
+        (Blender render borders) that are rendered by parallel Blender processes (or by the Blender
+        workers if they were started). The tiles are streamed into a tiled GeoTIFF as they are 
+        rendered, so the full image is never held in memory. The tiles are placed at their position
+        in the full frame, so the RPC of the view is valid for the mosaic. The mosaic is also matched
+        to the target image by windows of the tile size.
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double, optional): Reserved for future use, not implemented yet. Defaults to None.
+            sun_zenith_in_degrees (double, optional): Zenith angle of the sun. Defaults to 0.
+            sun_azimuth_in_degrees (double, optional): Azimuth angle of the sun. Defaults to 0.
+            target_img_filename(str, optional): Filename of image to match values and noise. Defaults to None
+            overwrite (bool, optional): Regenerate existing image and RPC. Defaults to False.
+            tile_size (int, optional): Size of the tiles in pixels. Defaults to 2048.
+            max_workers (int, optional): Maximum number of tiles rendered at the same time. Defaults to None (number of cpus).
+
+        Raises:
+            ValueError: if a render backend is used (only Blender renders tiles) or the image frame is empty
+            RuntimeError: if a tile could not be rendered or does not have the size of its window
+
+        Returns:
+            str: Filename of the image
+            str: Filename of the RPC
+        """
+        if self.render_backend is not None:
+            raise ValueError('Simulator: tiled rendering is only available with Blender')
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        filenames = self.get_view_filenames(zenith_in_degrees, azimuth_in_degrees,
+                                            sun_zenith_in_degrees, sun_azimuth_in_degrees)
+        image_filename = filenames['image']
+        rpcfit_filename = filenames['rpcfit']
+
+        if os.path.isfile(image_filename) and os.path.isfile(rpcfit_filename) and not overwrite:
+            return image_filename, rpcfit_filename
+
+        # Camera and rpc of the full frame ----------------------------------------
+        P_affine, K, R = self.compute_view_camera_and_rpc(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees,
+                                                          rpcfit_filename)
+        R_sun = paffine.camera_rotation_matrix_from_view_angles(sun_zenith_in_degrees, sun_azimuth_in_degrees)
+        blender_camera_script = self.blender.get_blender_camera_position_script(R, K, R_sun)
+
+        if self.fetch_render_from_cache(blender_camera_script, image_filename, 'tiled'):
+            self.finish_view_image(image_filename, rpcfit_filename, target_img_filename, window_size=tile_size)
+            return image_filename, rpcfit_filename
+
+        # Tiles -------------------------------------------------------------------
+        W, H = self.blender.image_xy_size
+        tiles = [(x0, y0, min(x0 + tile_size, W), min(y0 + tile_size, H)) 
+                 for y0 in range(0, H, tile_size) for x0 in range(0, W, tile_size)]
+        if not tiles:
+            raise ValueError(f'Simulator: empty image frame {W}x{H}, there is no tile to render')
+        tiles_dir = os.path.join(self.images_dir, 'TILES_' + os.path.basename(filenames['image_for_blender']).rstrip('_'))
+        os.makedirs(tiles_dir, exist_ok=True)
+
+        def render_tile(tile):
+            x0, y0, x1, y1 = tile
+            tile_name = f'tile_{y0:06d}_{x0:06d}'
+            tile_script = blender_camera_script + self.blender.get_blender_tile_script(x0, y0, x1, y1)
+            tile_script_filename = os.path.join(tiles_dir, f'blender_camera_{tile_name}.py')
+            tile_filename = os.path.join(tiles_dir, f'{tile_name}_0001.tif')
+            save_txt(tile_script_filename, tile_script)
+
+            if self.blender_worker_pool is not None:
+                self.blender_worker_pool.render(tile_script, tile_filename)
+            else:
+                blender_command = self.blender.get_blender_command(tile_script_filename, tile_filename[:-8])
+                save_txt(os.path.join(tiles_dir, f'blender_command_{tile_name}.sh'), blender_command)
+                self.run_blender(blender_command, tile_filename)
+            return tile_filename
+
+        # Render the tiles in parallel and stream them to the mosaic -------------
+        tmp_filename = image_filename + '.tmp.tif'
+        mosaic = None
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(render_tile, tile): tile for tile in tiles}
+                try:
+                    for future in as_completed(futures):
+                        x0, y0, x1, y1 = futures[future]
+                        tile_filename = future.result()
+                        with rasterio.open(tile_filename, 'r') as t:
+                            tile_img = t.read(1)
+                        # the borders of the tile script are on pixel boundaries (see get_blender_tile_script)
+                        if tile_img.shape != (y1 - y0, x1 - x0):
+                            raise RuntimeError(f'Simulator: tile {tile_filename} has shape {tile_img.shape} '
+                                               f'instead of {(y1 - y0, x1 - x0)}')
+                        if mosaic is None:
+                            mosaic = rasterio.open(tmp_filename, 'w', driver='GTiff', width=W, height=H, count=1,
+                                                   dtype=tile_img.dtype, tiled=True, blockxsize=256, blockysize=256,
+                                                   compress='deflate', BIGTIFF='IF_SAFER')
+                        mosaic.write(tile_img, 1, window=Window(x0, y0, x1 - x0, y1 - y0))
+                        os.remove(tile_filename)
+                except BaseException:
+                    # do not render the pending tiles (only the running ones are waited for)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        except BaseException:
+            if mosaic is not None:
+                mosaic.close()
+                os.remove(tmp_filename)
+            raise
+        finally:
+            # the tiles of a failed render are removed too
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+        if mosaic is not None:
+            mosaic.close()
+
+        os.replace(tmp_filename, image_filename)
+        self.store_render_in_cache(blender_camera_script, image_filename, 'tiled')
+
+        self.finish_view_image(image_filename, rpcfit_filename, target_img_filename, window_size=tile_size)
+
+        return image_filename, rpcfit_filename
+
+
+    def get_view_filenames(self, zenith_in_degrees, azimuth_in_degrees,
+                           sun_zenith_in_degrees=0, sun_azimuth_in_degrees=0):
+        """Filenames of the files generated for a view and sun position
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            sun_zenith_in_degrees (double, optional): Zenith angle of the sun. Defaults to 0.
+            sun_azimuth_in_degrees (double, optional): Azimuth angle of the sun. Defaults to 0.
+
+        Returns:
+            dict: filenames with keys 'image', 'image_for_blender', 'blender_camera_script',
+                  'blender_command' and 'rpcfit'
+        """
+        view_and_sun_name = f'view_ze_{zenith_in_degrees:05.1f}_view_az_{azimuth_in_degrees:05.1f}_sun_ze_{sun_zenith_in_degrees:05.1f}_sun_az_{sun_azimuth_in_degrees:05.1f}'
+        view_name = f'view_ze_{zenith_in_degrees:05.1f}_view_az_{azimuth_in_degrees:05.1f}' 
+
+        image_filename = os.path.join(self.images_dir, f'{view_and_sun_name}_0001.tif')
+        filenames = {
+            # the filename that will output the blender rendering
+            'image': image_filename,
+            # the filename we tell to blender in order to get the image (blender appends the frame number)
+            'image_for_blender': image_filename[:-8],
+            # the python camera script for blender
+            'blender_camera_script': os.path.join(self.blender_camera_dir, f'blender_camera_{view_and_sun_name}.py'),
+            # the shell script that runs Blender
+            'blender_command': os.path.join(self.blender_command_dir, f'blender_command_{view_and_sun_name}.sh'),
+            # the rpc model (it only depends on the view)
+            'rpcfit': os.path.join(self.rpcfit_dir, f'rpcfit_{view_name}.txt'),
+        }
+        return filenames
+
+
+    def compute_view_camera(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees=None):
+        """Computes the affine camera of a view
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double, optional): Reserved for future use, not implemented yet. Defaults to None.
+
+        Returns:
+            np.array: P_affine, the 2x4 affine projection matrix
+            np.array: K, the intrinsics of the camera
+            np.array: R, the extrinsics of the camera
+        """
+        if self.render_backend is not None:
+            image_xy_size = self.render_backend.image_xy_size
+        else:
+            image_xy_size = self.blender.image_xy_size
+
+        P_affine, K, R, t = \
+        paffine.compute_P_affine(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees, image_xy_size,
+                                self.satellite.view_pixels_per_meter(zenith_in_degrees))
+        return P_affine, K, R
+
+
+    def compute_view_camera_and_rpc(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees, rpcfit_filename):
+        """Computes the affine camera of a view and fits its RPC
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double): Reserved for future use, not implemented yet.
+            rpcfit_filename (str): Filename for the RPC (Ikonos format)
+
+        Returns:
+            np.array: P_affine, the 2x4 affine projection matrix
+            np.array: K, the intrinsics of the camera
+            np.array: R, the extrinsics of the camera
+        """
+        # Compute affine projection matrix from orientation
+        P_affine, K, R = self.compute_view_camera(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees)
+        
+        # Conpute the rpc from the affine projection matrix. Saves result in Ikonos format
+        rpcfit_util.compute_rpc_from_affine_camera(P_affine, self.location.aoi, self.location.altitude_range, 
+                                                   rpcfit_filename, lon_lat_alt_origin=self.location.lon_lat_alt_origin,
+                                                   rpc_cache=self.rpc_cache, solver=self.rpc_solver,
+                                                   warm_start=self.rpc_fit_registry,
+                                                   validation_points=self.rpc_validation_points)
+        
+        return P_affine, K, R
+
+
+    def compute_view_camera_and_missing_rpc(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees, 
+                                            rpcfit_filename, overwrite=False):
+        """Computes the affine camera of a view and fits its RPC only if the RPC file does not exist
+        (see compute_view_camera_and_rpc)
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double): Reserved for future use, not implemented yet.
+            rpcfit_filename (str): Filename for the RPC (Ikonos format)
+            overwrite (bool, optional): Fit the RPC even if the file exists. Defaults to False.
+
+        Returns:
+            np.array: P_affine, the 2x4 affine projection matrix
+            np.array: K, the intrinsics of the camera
+            np.array: R, the extrinsics of the camera
+        """
+        if not os.path.isfile(rpcfit_filename) or overwrite:
+            return self.compute_view_camera_and_rpc(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees,
+                                                    rpcfit_filename)
+        return self.compute_view_camera(zenith_in_degrees, azimuth_in_degrees, roll_in_degrees)
+
+
+    def group_views_by_rpc(self, views, filenames, indices):
+        """Groups views by RPC: the views that only differ by the sun position share their RPC, which 
+        is fitted once for the group. When the RPC fits are warm started (see warm_start_rpc_fits) the 
+        groups are ordered by proximity of their cameras, so that each fit starts from the previous one.
+
+        Args:
+            views (list): List of view specs (zenith, azimuth, sun_zenith, sun_azimuth[, target_img_filename])
+            filenames (list): Filenames of each view (see get_view_filenames)
+            indices (list): Indices of the views to group
+
+        Returns:
+            list: One list of view indices per RPC
+        """
+        groups = {}
+        for i in indices:
+            groups.setdefault(filenames[i]['rpcfit'], []).append(i)
+        groups = list(groups.values())
+
+        if self.rpc_fit_registry is not None and len(groups) > 1:
+            P_affines = [self.compute_view_camera(views[group[0]][0], views[group[0]][1])[0] for group in groups]
+            groups = [groups[k] for k in rpcfit_util.order_cameras_by_proximity(P_affines)]
+
+        return groups
+
+
+    def compute_view_cameras_and_rpcs(self, view_angles, rpcfit_filenames, errors=None):
+        """Computes the affine cameras of several views and fits their RPCs together. The VOI
+        samples are built once and shared by all the fits (see rpcfit_util.compute_rpcs_from_affine_cameras).
+
+        Args:
+            view_angles (list): List of (zenith, azimuth, roll) in degrees
+            rpcfit_filenames (list): Filename for the RPC of each view (Ikonos format)
+            errors (dict, optional): If given, the error of a view whose camera or RPC fails is stored in
+                                     errors[k] (k the index of the view), its camera is None and the other
+                                     views are still fitted. Errors shared by all the fits (e.g. the VOI 
+                                     samples) are raised. Defaults to None (the first error is raised).
+
+        Returns:
+            list: One (P_affine, K, R) tuple per view
+        """
+        cameras = []
+        for k, angles in enumerate(view_angles):
+            try:
+                cameras.append(self.compute_view_camera(*angles))
+            except Exception as e:
+                if errors is None:
+                    raise
+                errors[k] = e
+                cameras.append(None)
+
+        # views with the same rpc (e.g. several sun positions) are fitted once
+        P_affines = {}
+        for rpcfit_filename, camera in zip(rpcfit_filenames, cameras):
+            if camera is not None:
+                P_affines[rpcfit_filename] = camera[0]
+        fit_errors = None if errors is None else {}
+        if P_affines:
+            rpcfit_util.compute_rpcs_from_affine_cameras(list(P_affines.values()), self.location.aoi, 
+                                                         self.location.altitude_range, list(P_affines.keys()),
+                                                         lon_lat_alt_origin=self.location.lon_lat_alt_origin,
+                                                         rpc_cache=self.rpc_cache, solver=self.rpc_solver,
+                                                         warm_start=self.rpc_fit_registry,
+                                                         validation_points=self.rpc_validation_points,
+                                                         errors=fit_errors)
+        if fit_errors:
+            failed = {list(P_affines.keys())[j]: e for j, e in fit_errors.items()}
+            for k, rpcfit_filename in enumerate(rpcfit_filenames):
+                if rpcfit_filename in failed:
+                    errors[k] = failed[rpcfit_filename]
+                    cameras[k] = None
+        return cameras
+
+
+    def render_view(self, R, K, R_sun, filenames):
+        """Renders the image of a view. The image is rendered by the render backend if there is one,
+        by the Blender workers if they were started (see start_blender_workers), otherwise Blender 
+        is launched for the view. Blender renders are taken from the render cache if it has them.
+
+        Args:
+            R (3x3 np.array): Extrinsics of the camera
+            K (2x2 np.array): Intrinsics of the camera
+            R_sun (3x3 np.array): Sun rotation matrix
+            filenames (dict): Filenames of the view (see get_view_filenames)
+
+        Returns:
+            dict: Reply of the worker with the 'filepath' and the 'render_time', None if no workers are used
+                  or the image was in the render cache.
+        """
+        # the previous image may be a hardlink to a cached render, never overwrite it in place
+        if os.path.isfile(filenames['image']):
+            os.remove(filenames['image'])
+
+        if self.render_backend is not None:
+            self.render_backend.render(R, K, R_sun, filenames['image'])
+            return None
+
+        # Get the blender_camera_script
+        blender_camera_script = self.blender.get_blender_camera_position_script(R, K, R_sun)
+        save_txt(filenames['blender_camera_script'], blender_camera_script)
+
+        if self.fetch_render_from_cache(blender_camera_script, filenames['image']):
+            return None
+
+        if self.blender_worker_pool is not None:
+            reply = self.blender_worker_pool.render(blender_camera_script, filenames['image'])
+        else:
+            # Get the blender command. 
+            blender_command = self.blender.get_blender_command(filenames['blender_camera_script'], filenames['image_for_blender'])
+            save_txt(filenames['blender_command'], blender_command)
+            self.run_blender(blender_command, filenames['image'])
+            reply = None
+
+        self.store_render_in_cache(blender_camera_script, filenames['image'])
+        return reply
+
+
+    def fetch_render_from_cache(self, blender_camera_script, image_filename, *extra):
+        """Gets a render from the render cache
+
+        Args:
+            blender_camera_script (str): Script that positions the camera and the sun for the render
+            image_filename (str): Filename of the image
+            *extra: Anything else that changes the rendered image (see Blender.get_render_cache_key)
+
+        Returns:
+            bool: True if the image was in the cache (False if there is no render cache)
+        """
+        if self.render_cache is None:
+            return False
+        key = self.blender.get_render_cache_key(blender_camera_script, *extra)
+        return self.render_cache.fetch(key, image_filename)
+
+
+    def store_render_in_cache(self, blender_camera_script, image_filename, *extra):
+        """Adds a render to the render cache (if there is one)
+
+        Args:
+            blender_camera_script (str): Script that positioned the camera and the sun for the render
+            image_filename (str): Filename of the rendered image
+            *extra: Anything else that changes the rendered image (see Blender.get_render_cache_key)
+        """
+        if self.render_cache is None:
+            return
+        key = self.blender.get_render_cache_key(blender_camera_script, *extra)
+        self.render_cache.store(key, image_filename)
+
+
+    def finish_view_image(self, image_filename, rpcfit_filename, target_img_filename=None, window_size=None):
+        """Last step of the simulation of an image: matches its values and noise to the target image
+        if there is one (see match_view_image) and, with cog_output, rewrites it as a Cloud Optimized
+        GeoTIFF with the RPC of the view (in the same pass as the matching).
+
+        Args:
+            image_filename (str): Filename of the rendered image
+            rpcfit_filename (str): Filename of the RPC of the view
+            target_img_filename (str, optional): Filename of image to match values and noise. Defaults to None.
+            window_size (int, optional): Match the image by windows of this size (see match_view_image). Defaults to None.
+        """
+        rpc = rpcm.rpc_from_rpc_file(rpcfit_filename) if self.cog_output else None
+        if target_img_filename is not None:
+            self.match_view_image(image_filename, target_img_filename, window_size, rpc)
+        elif self.cog_output:
+            utils.writeCOG(image_filename, image_filename, rpc)
+
+
+    def match_view_image(self, image_filename, target_img_filename, window_size=None, rpc=None):
+        """Matches the values and the noise of a rendered image to a target image (in place).
+        The profile of the target image is taken from the reference profile store if there is one.
+        With a noise seed, the noise of each view is drawn from its own stream (seed, image name).
+
+        Args:
+            image_filename (str): Filename of the rendered image
+            target_img_filename (str): Filename of image to match values and noise
+            window_size (int, optional): Match the image by windows of this size, without loading it 
+                                         (see matching.match_image_values_and_noise_windowed). Defaults to None.
+            rpc (rpcm.RPCModel, optional): If given, the image is written as a Cloud Optimized GeoTIFF with 
+                                           this RPC (see utils.writeCOG). Defaults to None.
+        """
+        seed = None
+        if self.noise_seed is not None:
+            seed = np.random.SeedSequence([self.noise_seed, zlib.crc32(os.path.basename(image_filename).encode())])
+        match_image_values_and_noise_ex(image_filename, target_img_filename, output_filename=image_filename,
+                                        profile_store=self.reference_profile_store, seed=seed, dtype=self.match_dtype,
+                                        window_size=window_size, cog=rpc is not None, rpc=rpc)
+
+
+    def start_blender_workers(self, num_workers=1):
+        """Starts persistent Blender processes that keep the scene loaded. While they run, the
+        images are rendered by the workers instead of launching Blender for each view.
+
+        Args:
+            num_workers (int, optional): Number of Blender processes. Defaults to 1.
+        """
+        if self.blender_worker_pool is not None:
+            self.stop_blender_workers()
+        pool = BlenderWorkerPool(self.blender, num_workers, log_dir=self.blender_command_dir)
+        pool.start()
+        self.blender_worker_pool = pool
+
+
+    def stop_blender_workers(self):
+        """Stops the Blender workers started with start_blender_workers
+        """
+        if self.blender_worker_pool is not None:
+            self.blender_worker_pool.stop()
+            self.blender_worker_pool = None
+
+
+    def run_blender(self, blender_command, image_filename):
+        """Runs a Blender command and checks that the rendered image was produced
+
+        Args:
+            blender_command (str): Command returned by Blender.get_blender_command
+            image_filename (str): Filename of the image that Blender should render
+
+        Raises:
+            RuntimeError: if Blender fails or the image is not rendered
+        """
+        return_code = subprocess.call(blender_command, shell=True)
+        if return_code != 0 or not os.path.isfile(image_filename):
+            raise RuntimeError(f'Simulator: Blender failed to render {image_filename} (return code {return_code})')
+
+
+    def simulate_batch(self, views, max_workers=None, overwrite=False):
+        """Simulates a list of views concurrently.
+
+        Each view runs the same steps as "simulate_image_and_rpcfit". The Blender renders run as 
+        separate processes and the RPC fits and value matchings are NumPy heavy, so a pool of 
+        max_workers jobs keeps the cores busy. Views that only differ by the sun position share 
+        their RPC, which is fitted once before their renders start. A failing view does not stop 
+        the batch, its error is reported in the results.
+
+        Args:
+            views (list): List of view specs (zenith, azimuth, sun_zenith, sun_azimuth[, target_img_filename])
+                          with angles in degrees. The target image filename is optional.
+            max_workers (int, optional): Maximum number of concurrent jobs. Defaults to None (number of cpus).
+            overwrite (bool, optional): Regenerate existing images and RPCs. Defaults to False.
+
+        Returns:
+            list: One (image_filename, rpcfit_filename, error) tuple per view, in the order of views.
+                  error is None if the view was simulated, otherwise the raised exception.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        views = [tuple(view[:4]) + (view[4] if len(view) > 4 else None,) for view in views]
+        filenames = [self.get_view_filenames(*view[:4]) for view in views]
+        errors = [None] * len(views)
+
+        # views whose image or rpc is missing, grouped by rpc
+        pending = [i for i in range(len(views)) 
+                   if (not os.path.isfile(filenames[i]['image']) or not os.path.isfile(filenames[i]['rpcfit'])) or overwrite]
+        groups = self.group_views_by_rpc(views, filenames, pending)
+
+        def fit(i):
+            # camera of the view and its rpc (if missing), once for the views of the rpc
+            return self.compute_view_camera_and_missing_rpc(views[i][0], views[i][1], None, filenames[i]['rpcfit'], 
+                                                            overwrite)
+
+        def run(i, camera):
+            P_affine, K, R = camera
+            R_sun = paffine.camera_rotation_matrix_from_view_angles(views[i][2], views[i][3])
+            self.render_view(R, K, R_sun, filenames[i])
+            self.finish_view_image(filenames[i]['image'], filenames[i]['rpcfit'], views[i][4])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fits = {executor.submit(fit, group[0]): group for group in groups}
+            runs = {}
+            # the renders of the views of an rpc start as soon as it is fitted
+            for future in as_completed(fits):
+                error = future.exception()
+                for i in fits[future]:
+                    if error is None:
+                        runs[executor.submit(run, i, future.result())] = i
+                    else:
+                        errors[i] = error
+            for future, i in runs.items():
+                errors[i] = future.exception()
+
+        return [(f['image'], f['rpcfit'], error) for f, error in zip(filenames, errors)]
+
+
+    def simulate_batch_single_session(self, views, max_workers=None, overwrite=False):
+        """Simulates a list of views rendering all of them in a single Blender session.
+
+        Blender is launched once, so the startup and the load of the scene are paid once for 
+        the whole batch instead of once per view. The missing RPCs are fitted together on the same
+        VOI samples, each one once, and the value matchings run on a pool of max_workers threads. 
+        If a render backend or the Blender workers are used, they render the images instead of the 
+        single Blender session.
+
+        Args:
+            views (list): List of view specs (zenith, azimuth, sun_zenith, sun_azimuth[, target_img_filename])
+                          with angles in degrees. The target image filename is optional.
+            max_workers (int, optional): Maximum number of concurrent renders and matchings. 
+                                         Defaults to None (number of cpus).
+            overwrite (bool, optional): Regenerate existing images and RPCs. Defaults to False.
+
+        Returns:
+            list: One (image_filename, rpcfit_filename, error) tuple per view, in the order of views.
+                  error is None if the view was simulated, otherwise the raised exception.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        views = [tuple(view[:4]) + (view[4] if len(view) > 4 else None,) for view in views]
+        filenames = [self.get_view_filenames(*view[:4]) for view in views]
+        errors = [None] * len(views)
+
+        # views whose image or rpc is missing
+        pending = [i for i in range(len(views)) 
+                   if (not os.path.isfile(filenames[i]['image']) or not os.path.isfile(filenames[i]['rpcfit'])) or overwrite]
+
+        def match(i):
+            self.finish_view_image(filenames[i]['image'], filenames[i]['rpcfit'], views[i][4])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # (1) cameras and rpcs (the missing rpcs are fitted together, a failing fit only fails its views)
+            cameras = {}
+            rendered = []
+            view_cameras = {}
+            to_fit = self.group_views_by_rpc(views, filenames, [i for i in pending 
+                                                                if not os.path.isfile(filenames[i]['rpcfit']) or overwrite])
+            if to_fit:
+                fit_errors = {}
+                try:
+                    fitted = self.compute_view_cameras_and_rpcs([(views[group[0]][0], views[group[0]][1], None) for group in to_fit],
+                                                                [filenames[group[0]]['rpcfit'] for group in to_fit], fit_errors)
+                except Exception as e:
+                    # error shared by all the fits (e.g. the VOI samples)
+                    fit_errors = {k: e for k in range(len(to_fit))}
+                for k, group in enumerate(to_fit):
+                    for i in group:
+                        if k in fit_errors:
+                            errors[i] = fit_errors[k]
+                        else:
+                            view_cameras[i] = fitted[k]
+            for i in pending:
+                if errors[i] is not None:
+                    continue
+                if i not in view_cameras:
+                    # the rpc exists, only the camera is needed
+                    try:
+                        view_cameras[i] = self.compute_view_camera(views[i][0], views[i][1])
+                    except Exception as e:
+                        errors[i] = e
+                        continue
+                P_affine, K, R = view_cameras[i]
+                R_sun = paffine.camera_rotation_matrix_from_view_angles(views[i][2], views[i][3])
+                cameras[i] = (R, K, R_sun)
+                rendered.append(i)
+            
+            if self.render_backend is not None or self.blender_worker_pool is not None:
+                # (2) the backend or the workers render the images
+                futures = {i: executor.submit(self.render_view, *cameras[i], filenames[i]) for i in rendered}
+                for i, future in futures.items():
+                    errors[i] = future.exception()
+
+            elif rendered:
+                # (2) a single Blender session renders all the images that are not in the render cache
+                position_scripts = {i: self.blender.get_blender_camera_position_script(*cameras[i]) for i in rendered}
+                for i in rendered:
+                    if os.path.isfile(filenames[i]['image']):
+                        os.remove(filenames[i]['image'])
+                to_render = [i for i in rendered if not self.fetch_render_from_cache(position_scripts[i], filenames[i]['image'])]
+                if to_render:
+                    render_jobs = [(position_scripts[i], filenames[i]['image']) for i in to_render]
+                    batch_name = hashlib.sha1(''.join(filenames[i]['image'] for i in to_render).encode()).hexdigest()[:12]
+                    blender_batch_script_filename = os.path.join(self.blender_camera_dir, f'blender_batch_{batch_name}.py')
+                    blender_command_filename = os.path.join(self.blender_command_dir, f'blender_command_batch_{batch_name}.sh')
+
+                    blender_batch_script = self.blender.get_blender_batch_script(render_jobs)
+                    blender_command = self.blender.get_blender_batch_command(blender_batch_script_filename)
+                    save_txt(blender_batch_script_filename, blender_batch_script)
+                    save_txt(blender_command_filename, blender_command)
+
+                    return_code = subprocess.call(blender_command, shell=True)
+                    for i in to_render:
+                        if not os.path.isfile(filenames[i]['image']):
+                            errors[i] = RuntimeError(f'Simulator: Blender failed to render {filenames[i]["image"]} (return code {return_code})')
+                        else:
+                            self.store_render_in_cache(position_scripts[i], filenames[i]['image'])
+
+            # (3) match values and noise
+            futures = {i: executor.submit(match, i) for i in rendered 
+                       if errors[i] is None and (views[i][4] is not None or self.cog_output)}
+            for i, future in futures.items():
+                errors[i] = future.exception()
+
+        return [(f['image'], f['rpcfit'], error) for f, error in zip(filenames, errors)]
+
+
+    def simulate_pipeline(self, views, fit_workers=1, render_workers=1, match_workers=1, 
+                          queue_size=2, overwrite=False):
+        """Simulates a list of views in a pipeline of three stages: camera and RPC fit, render and
+        value matching. Each stage has its own workers and the views go from one stage to the next
+        through bounded queues, so the fit and the matching of some views run while others are
+        rendered and the batch takes about as long as its slowest stage. Views that only differ by the 
+        sun position share their RPC, which the fit stage fits once (only if it does not exist, unless 
+        overwrite).
+
+        The render stage uses the render backend or the Blender workers if there are any (see 
+        start_blender_workers), otherwise each render worker launches Blender for its views.
+
+        Args:
+            views (list): List of view specs (zenith, azimuth, sun_zenith, sun_azimuth[, target_img_filename])
+                          with angles in degrees. The target image filename is optional.
+            fit_workers (int, optional): Number of threads fitting the RPCs. Defaults to 1.
+            render_workers (int, optional): Number of concurrent renders. Defaults to 1.
+            match_workers (int, optional): Number of threads matching values and noise. Defaults to 1.
+            queue_size (int, optional): Maximum number of views waiting between two stages. Defaults to 2.
+            overwrite (bool, optional): Regenerate existing images and RPCs. Defaults to False.
+
+        Returns:
+            list: One (image_filename, rpcfit_filename, error) tuple per view, in the order of views.
+                  error is None if the view was simulated, otherwise the raised exception.
+        """
+        views = [tuple(view[:4]) + (view[4] if len(view) > 4 else None,) for view in views]
+        filenames = [self.get_view_filenames(*view[:4]) for view in views]
+        errors = [None] * len(views)
+        cameras = {}
+
+        # views whose image or rpc is missing
+        pending = [i for i in range(len(views)) 
+                   if (not os.path.isfile(filenames[i]['image']) or not os.path.isfile(filenames[i]['rpcfit'])) or overwrite]
+
+        def fit(group):
+            # the views of an rpc share their camera, the rpc is fitted once (if missing)
+            i = group[0]
+            P_affine, K, R = self.compute_view_camera_and_missing_rpc(views[i][0], views[i][1], None, 
+                                                                      filenames[i]['rpcfit'], overwrite)
+            for i in group:
+                R_sun = paffine.camera_rotation_matrix_from_view_angles(views[i][2], views[i][3])
+                cameras[i] = (R, K, R_sun)
+
+        def render(group):
+            for i in group:
+                self.render_view(*cameras[i], filenames[i])
+
+        def match(group):
+            for i in group:
+                self.finish_view_image(filenames[i]['image'], filenames[i]['rpcfit'], views[i][4])
+
+        stages = [(fit, fit_workers), (render, render_workers), (match, match_workers)]
+        # input queue of each stage (groups of views of the same rpc for the fit, single views after), None ends a worker
+        queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+        def work(k):
+            step, _ = stages[k]
+            while True:
+                group = queues[k].get()
+                if group is None:
+                    break
+                try:
+                    step(group)
+                except Exception as e:
+                    # the views leave the pipeline
+                    for i in group:
+                        errors[i] = e
+                    continue
+                if k + 1 < len(stages):
+                    for i in group:
+                        queues[k + 1].put([i])
+
+        threads = [[threading.Thread(target=work, args=(k,), daemon=True) for _ in range(num_workers)]
+                   for k, (_, num_workers) in enumerate(stages)]
+        for stage_threads in threads:
+            for t in stage_threads:
+                t.start()
+
+        for group in self.group_views_by_rpc(views, filenames, pending):
+            queues[0].put(group)
+        for k, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[k].put(None)
+            for t in stage_threads:
+                t.join()
+
+        return [(f['image'], f['rpcfit'], error) for f, error in zip(filenames, errors)]
+
+
+    async def run_blender_async(self, blender_command_args, image_filename):
+        """Runs Blender without blocking the event loop and checks that the rendered image was produced.
+        If the coroutine is cancelled (e.g. by a timeout) the Blender process is killed.
+
+        Args:
+            blender_command_args (list): Command returned by Blender.get_blender_command_args
+            image_filename (str): Filename of the image that Blender should render
+
+        Raises:
+            RuntimeError: if Blender fails or the image is not rendered
+        """
+        process = await asyncio.create_subprocess_exec(*blender_command_args)
+        try:
+            return_code = await process.wait()
+        except BaseException:
+            # cancelled, do not leave Blender running
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        if return_code != 0 or not os.path.isfile(image_filename):
+            raise RuntimeError(f'Simulator: Blender failed to render {image_filename} (return code {return_code})')
+
+
+    async def render_view_async(self, R, K, R_sun, filenames, executor=None):
+        """Same as render_view without blocking the event loop. Blender runs as an asyncio subprocess,
+        the render backend and the Blender workers run in the executor.
+
+        Args:
+            R (3x3 np.array): Extrinsics of the camera
+            K (2x2 np.array): Intrinsics of the camera
+            R_sun (3x3 np.array): Sun rotation matrix
+            filenames (dict): Filenames of the view (see get_view_filenames)
+            executor (concurrent.futures.Executor, optional): Executor of the blocking calls. 
+                                                             Defaults to None (default executor of the loop).
+
+        Returns:
+            dict: Reply of the worker with the 'filepath' and the 'render_time', None if no workers are used
+                  or the image was in the render cache.
+        """
+        loop = asyncio.get_running_loop()
+
+        if self.render_backend is not None or self.blender_worker_pool is not None:
+            return await loop.run_in_executor(executor, self.render_view, R, K, R_sun, filenames)
+
+        # the previous image may be a hardlink to a cached render, never overwrite it in place
+        if os.path.isfile(filenames['image']):
+            os.remove(filenames['image'])
+
+        blender_camera_script = self.blender.get_blender_camera_position_script(R, K, R_sun)
+        save_txt(filenames['blender_camera_script'], blender_camera_script)
+
+        if await loop.run_in_executor(executor, self.fetch_render_from_cache, blender_camera_script, filenames['image']):
+            return None
+
+        blender_command = self.blender.get_blender_command(filenames['blender_camera_script'], filenames['image_for_blender'])
+        save_txt(filenames['blender_command'], blender_command)
+        await self.run_blender_async(self.blender.get_blender_command_args(filenames['blender_camera_script'], 
+                                                                           filenames['image_for_blender']),
+                                     filenames['image'])
+
+        await loop.run_in_executor(executor, self.store_render_in_cache, blender_camera_script, filenames['image'])
+        return None
+
+
+    async def simulate_image_and_rpcfit_async(self, zenith_in_degrees, azimuth_in_degrees, roll_in_degrees=None, 
+                                              sun_zenith_in_degrees=0, sun_azimuth_in_degrees=0,
+                                              target_img_filename=None,
+                                              overwrite=False,
+                                              executor=None,
+                                              timeout=None,
+                                              ):
+        """Same as simulate_image_and_rpcfit as a coroutine. Blender runs as an asyncio subprocess
+        and the RPC fit and the value matching run in the executor, so the event loop is never blocked.
+
+        Cancellation and timeouts kill the Blender process. An RPC fit or a matching already running 
+        in the executor cannot be interrupted, it finishes in the background.
+
+        Args:
+            zenith_in_degrees (double): Zenith angle of the view
+            azimuth_in_degrees (double): Azimuth angle of the view
+            roll_in_degrees (double, optional): Reserved for future use, not implemented yet. Defaults to None.
+            sun_zenith_in_degrees (double, optional): Zenith angle of the sun. Defaults to 0.
+            sun_azimuth_in_degrees (double, optional): Azimuth angle of the sun. Defaults to 0.
+            target_img_filename(str, optional): Filename of image to match values and noise. Defaults to None
+            overwrite (bool, optional): Regenerate existing images and RPCs. Defaults to False.
+            executor (concurrent.futures.Executor, optional): Executor of the CPU-bound steps. 
+                                                             Defaults to None (default executor of the loop).
+            timeout (float, optional): Seconds to simulate the view. Defaults to None (no timeout).
+
+        Raises:
+            asyncio.TimeoutError: if the simulation takes more than timeout
+
+        Returns:
+            str: Filename of the image
+            str: Filename of the RPC
+        """
+        filenames = self.get_view_filenames(zenith_in_degrees, azimuth_in_degrees,
+                                            sun_zenith_in_degrees, sun_azimuth_in_degrees)
+        loop = asyncio.get_running_loop()
+
+        if (not os.path.isfile(filenames['image']) or not os.path.isfile(filenames['rpcfit'])) or overwrite:
+            # Compute affine projection matrix from orientation and fit the rpc (if missing)
+            fit = loop.run_in_executor(executor, self.compute_view_camera_and_missing_rpc,
+                                       zenith_in_degrees, azimuth_in_degrees, roll_in_degrees, 
+                                       filenames['rpcfit'], overwrite)
+            await asyncio.wait_for(self.render_and_finish_view_async(fit, sun_zenith_in_degrees, sun_azimuth_in_degrees,
+                                                                     filenames, target_img_filename, executor),
+                                   timeout)
+
+        return filenames['image'], filenames['rpcfit']
+
+
+    async def render_and_finish_view_async(self, fit, sun_zenith_in_degrees, sun_azimuth_in_degrees, filenames,
+                                           target_img_filename=None, executor=None):
+        """Renders the image of a view and matches it once its camera is computed (see 
+        simulate_image_and_rpcfit_async)
+
+        Args:
+            fit (asyncio.Future): Future of the (P_affine, K, R) of the view. It can be shared by the views of 
+                                  the same RPC, cancelling a view does not cancel it.
+            sun_zenith_in_degrees (double): Zenith angle of the sun
+            sun_azimuth_in_degrees (double): Azimuth angle of the sun
+            filenames (dict): Filenames of the view (see get_view_filenames)
+            target_img_filename (str, optional): Filename of image to match values and noise. Defaults to None
+            executor (concurrent.futures.Executor, optional): Executor of the CPU-bound steps. 
+                                                             Defaults to None (default executor of the loop).
+        """
+        loop = asyncio.get_running_loop()
+        P_affine, K, R = await asyncio.shield(fit)
+
+        # sun rotation from sun_zenith, sun_azimuth
+        R_sun = paffine.camera_rotation_matrix_from_view_angles(sun_zenith_in_degrees, sun_azimuth_in_degrees)
+
+        # Render the image
+        await self.render_view_async(R, K, R_sun, filenames, executor)
+
+        await loop.run_in_executor(executor, self.finish_view_image, filenames['image'], filenames['rpcfit'],
+                                   target_img_filename)
+
+
+    async def simulate_batch_async(self, views, max_concurrency=None, overwrite=False, executor=None, timeout=None):
+        """Simulates a list of views concurrently in the event loop (see simulate_image_and_rpcfit_async).
+        At most max_concurrency views are simulated at the same time. Views that only differ by the sun 
+        position share their RPC, which is fitted once. A failing or timed out view does not stop the batch, 
+        its error is reported in the results. Cancelling the batch cancels all its views.
+
+        Args:
+            views (list): List of view specs (zenith, azimuth, sun_zenith, sun_azimuth[, target_img_filename])
+                          with angles in degrees. The target image filename is optional.
+            max_concurrency (int, optional): Maximum number of views simulated at the same time. 
+                                             Defaults to None (number of cpus).
+            overwrite (bool, optional): Regenerate existing images and RPCs. Defaults to False.
+            executor (concurrent.futures.Executor, optional): Executor of the CPU-bound steps. 
+                                                             Defaults to None (default executor of the loop).
+            timeout (float, optional): Seconds to simulate each view. Defaults to None (no timeout).
+
+        Returns:
+            list: One (image_filename, rpcfit_filename, error) tuple per view, in the order of views.
+                  error is None if the view was simulated, otherwise the raised exception.
+        """
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count() or 1
+        semaphore = asyncio.Semaphore(max_concurrency)
+        loop = asyncio.get_running_loop()
+
+        views = [tuple(view[:4]) + (view[4] if len(view) > 4 else None,) for view in views]
+        filenames = [self.get_view_filenames(*view[:4]) for view in views]
+        # future of the camera of each rpc, shared by its views
+        fits = {}
+
+        async def run(i):
+            zenith, azimuth, sun_zenith, sun_azimuth, target_img_filename = views[i]
+            image_filename, rpcfit_filename = filenames[i]['image'], filenames[i]['rpcfit']
+            async with semaphore:
+                try:
+                    if (not os.path.isfile(image_filename) or not os.path.isfile(rpcfit_filename)) or overwrite:
+                        if rpcfit_filename not in fits:
+                            fits[rpcfit_filename] = loop.run_in_executor(executor, self.compute_view_camera_and_missing_rpc,
+                                                                         zenith, azimuth, None, rpcfit_filename, overwrite)
+                        await asyncio.wait_for(self.render_and_finish_view_async(fits[rpcfit_filename], sun_zenith, 
+                                                                                 sun_azimuth, filenames[i], 
+                                                                                 target_img_filename, executor),
+                                               timeout)
+                    return image_filename, rpcfit_filename, None
+                except Exception as e:
+                    return image_filename, rpcfit_filename, e
+
+        # the views are started group by group (see group_views_by_rpc)
+        pending = [i for i in range(len(views)) 
+                   if (not os.path.isfile(filenames[i]['image']) or not os.path.isfile(filenames[i]['rpcfit'])) or overwrite]
+        order = [i for group in self.group_views_by_rpc(views, filenames, pending) for i in group]
+        started = set(order)
+        order += [i for i in range(len(views)) if i not in started]
+
+        results = [None] * len(views)
+        for i, result in zip(order, await asyncio.gather(*(run(i) for i in order))):
+            results[i] = result
+        return results
@@ -0,0 +1,55 @@
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('scipy')
+
+from blender import Blender
+
+
+class FakeBpy(types.ModuleType):
+    # records the filepath of each render
+    def __init__(self):
+        super().__init__('bpy')
+        self.rendered = []
+        self.context = types.SimpleNamespace(scene=types.SimpleNamespace(render=types.SimpleNamespace(filepath=None)))
+        self.ops = types.SimpleNamespace(render=types.SimpleNamespace(render=self.render))
+
+    def render(self, write_still=False):
+        assert write_still
+        self.rendered.append(self.context.scene.render.filepath)
+
+
+def run_script(script, monkeypatch):
+    bpy = FakeBpy()
+    monkeypatch.setitem(sys.modules, 'bpy', bpy)
+    exec(compile(script, 'blender_batch.py', 'exec'), {})
+    return bpy
+
+
+def test_batch_script_renders_the_jobs_in_order(monkeypatch):
+    blender = Blender('scene.blend', (100, 80))
+    jobs = [('bpy.context.scene.frame_current = 1', '/tmp/a_0001.tif'),
+            ('x = 1\nraise RuntimeError("bad job")', "/tmp/it's_0001.tif"),
+            ('bpy.context.scene.frame_current = 1', '/tmp/c_0001.tif')]
+    bpy = run_script(blender.get_blender_batch_script(jobs), monkeypatch)
+    # a failing job does not stop the batch
+    assert bpy.rendered == ['/tmp/a_0001.tif', '/tmp/c_0001.tif']
+
+    command = blender.get_blender_batch_command('batch.py')
+    assert command.split() == ['blender', '-b', 'scene.blend', '-P', 'batch.py']
+
+
+@pytest.mark.parametrize('size', [(100, 80), (4096, 3000), (12345, 9876)])
+def test_tile_borders_are_the_pixels_of_the_tile(monkeypatch, size):
+    blender = Blender('scene.blend', size)
+    W, H = size
+    for x0, y0, x1, y1 in [(0, 0, W, H), (0, 0, 37, 21), (37, 21, W, H), (W // 3, H // 7, W // 2, H // 5)]:
+        # the tile script is appended to the camera script, which imports bpy
+        bpy = run_script('import bpy' + blender.get_blender_tile_script(x0, y0, x1, y1), monkeypatch)
+        render = bpy.context.scene.render
+        assert render.use_border and render.use_crop_to_border
+        # blender truncates the normalized borders to pixels, with y going up
+        assert (int(render.border_min_x * W), int(render.border_max_x * W)) == (x0, x1)
+        assert (int(render.border_min_y * H), int(render.border_max_y * H)) == (H - y1, H - y0)
@@ -0,0 +1,87 @@
+import os
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('scipy')
+
+from blender import Blender
+from blender_worker_pool import BlenderWorkerPool
+
+
+# worker speaking the protocol of blender_worker.py without Blender: the script "skip" does not write 
+# the image, "fail" fails the render and "exit" kills the worker
+FAKE_WORKER = textwrap.dedent('''
+    import json, os, socket, sys
+    f = socket.create_connection(('127.0.0.1', int(sys.argv[sys.argv.index('--') + 1]))).makefile('rw')
+    for line in f:
+        job = json.loads(line)
+        if job.get('stop'):
+            break
+        if job['script'] == 'exit':
+            os._exit(1)
+        if job['script'] not in ('skip', 'fail'):
+            with open(job['filepath'], 'w') as image:
+                image.write(str(os.getpid()))
+        error = 'Traceback: bad script' if job['script'] == 'fail' else None
+        f.write(json.dumps({'filepath': job['filepath'], 'render_time': 0.0, 'error': error}) + '\\n')
+        f.flush()
+''')
+
+
+def fake_pool(tmp_path, monkeypatch, num_workers=2, worker=FAKE_WORKER, **options):
+    script_filename = tmp_path / 'fake_worker.py'
+    script_filename.write_text(worker)
+    pool = BlenderWorkerPool(Blender('scene.blend', (100, 80)), num_workers, **options)
+    monkeypatch.setattr(pool, 'get_worker_command', lambda port: [sys.executable, str(script_filename), '--', str(port)])
+    return pool
+
+
+def test_worker_command_runs_the_worker_script():
+    pool = BlenderWorkerPool(Blender('scene.blend', (100, 80)))
+    command = pool.get_worker_command(1234)
+    assert command[:3] == ['blender', '-b', 'scene.blend'] and command[-2:] == ['--', '1234']
+    assert os.path.isfile(command[command.index('-P') + 1])
+
+
+def test_workers_render_the_jobs_of_several_threads(tmp_path, monkeypatch):
+    with fake_pool(tmp_path, monkeypatch, 2) as pool:
+        filenames = [str(tmp_path / f'image_{i}.tif') for i in range(8)]
+        replies = [None] * len(filenames)
+        def render(i):
+            replies[i] = pool.render('ok', filenames[i])
+        threads = [threading.Thread(target=render, args=(i,)) for i in range(len(filenames))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [r['filepath'] for r in replies] == filenames
+        assert len({open(f).read() for f in filenames}) <= 2
+
+        with pytest.raises(RuntimeError, match='failed'):
+            pool.render('fail', str(tmp_path / 'failed.tif'))
+        with pytest.raises(RuntimeError, match='did not write'):
+            pool.render('skip', str(tmp_path / 'skipped.tif'))
+        # the workers are still available
+        pool.render('ok', filenames[0])
+
+        with pytest.raises(RuntimeError, match='died'):
+            pool.render('exit', str(tmp_path / 'exit.tif'))
+        pool.render('ok', filenames[0])
+        with pytest.raises(RuntimeError, match='died'):
+            pool.render('exit', str(tmp_path / 'exit.tif'))
+        with pytest.raises(RuntimeError, match='no Blender worker'):
+            pool.render('ok', filenames[0])
+    assert pool.processes == []
+
+
+def test_start_fails_fast_when_a_worker_exits(tmp_path, monkeypatch):
+    pool = fake_pool(tmp_path, monkeypatch, 2, worker='import sys\nsys.exit(3)', startup_timeout=60)
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError, match='exited during startup'):
+        pool.start()
+    assert time.monotonic() - t0 < 30
+    assert pool.processes == []
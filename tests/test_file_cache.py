@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from file_cache import FileCache, file_content_hash
+
+
+def write(filename, content):
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return filename
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_miss_then_hit(tmp_path):
+    cache = FileCache(str(tmp_path / 'cache'))
+    key = FileCache.key('scene', 'camera script')
+    output = str(tmp_path / 'out.tif')
+
+    assert not cache.fetch(key, output)
+    assert not os.path.exists(output)
+
+    cache.store(key, write(str(tmp_path / 'render.tif'), b'render'))
+    assert cache.fetch(key, output)
+    assert read(output) == b'render'
+    assert not cache.fetch(FileCache.key('scene', 'another camera script'), output)
+
+
+@pytest.mark.parametrize('link', [True, False])
+def test_fetch_links_or_copies(tmp_path, link):
+    cache = FileCache(str(tmp_path / 'cache'))
+    cache.store('k' * 64, write(str(tmp_path / 'render.tif'), b'render'), link=link)
+    output = str(tmp_path / 'out.tif')
+    assert cache.fetch('k' * 64, output, link=link)
+    assert os.path.samefile(output, cache.entry_filename('k' * 64)) == link
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = FileCache(str(tmp_path / 'cache'), max_size_in_bytes=250)
+    keys = [FileCache.key(i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.store(key, write(str(tmp_path / f'{i}.bin'), bytes(100)), link=False)
+        os.utime(cache.entry_filename(key), (i, i))
+
+    # the first entry is used, so the second one is the least recently used
+    assert cache.fetch(keys[0], str(tmp_path / 'out.bin'))
+    cache.store(keys[2], write(str(tmp_path / '2.bin'), bytes(100)), link=False)
+
+    assert os.path.isfile(cache.entry_filename(keys[0]))
+    assert not os.path.isfile(cache.entry_filename(keys[1]))
+    assert os.path.isfile(cache.entry_filename(keys[2]))
+    assert not cache.fetch(keys[1], str(tmp_path / 'out.bin'))
+
+
+def test_keys_depend_on_every_part():
+    assert FileCache.key('a', 'b') == FileCache.key('a', 'b')
+    assert FileCache.key('a', 'b') != FileCache.key('b', 'a')
+    assert FileCache.key('ab') != FileCache.key('a', 'b')
+    assert FileCache.key(b'a', 1.5) == FileCache.key('a', 1.5)
+
+
+def test_file_content_hash_follows_the_contents(tmp_path):
+    filename = write(str(tmp_path / 'scene.blend'), b'scene')
+    h = file_content_hash(filename)
+    assert file_content_hash(write(str(tmp_path / 'copy.blend'), b'scene')) == h
+    write(filename, b'modified scene')
+    assert file_content_hash(filename) != h
+
+
+def test_render_cache_key(tmp_path):
+    pytest.importorskip('scipy')
+    from blender import Blender
+
+    scene_filename = write(str(tmp_path / 'scene.blend'), b'scene')
+    blender = Blender(scene_filename, (100, 80))
+    K = np.diag([2.0, 2.0, 1.0])
+    script = blender.get_blender_camera_position_script(np.eye(3), K)
+    key = blender.get_render_cache_key(script)
+
+    assert blender.get_render_cache_key(script) == key
+    assert blender.get_render_cache_key(script, 'tiled') != key
+    assert blender.get_render_cache_key(blender.get_blender_camera_position_script(np.eye(3), 2 * K)) != key
+    # same scene in another file, then a modified scene
+    assert Blender(write(str(tmp_path / 'copy.blend'), b'scene'), (100, 80)).get_render_cache_key(script) == key
+    write(scene_filename, b'modified scene')
+    assert blender.get_render_cache_key(script) != key
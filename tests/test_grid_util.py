@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('rpcm')
+
+from grid_util import get_voi_mesh, sample_voi
+
+
+AOI = {'coordinates': [[[-58.58923437034032, -34.49059476958225], [-58.58923437034032, -34.4891885066768],
+                        [-58.58733243810684, -34.4891885066768], [-58.58733243810684, -34.49059476958225],
+                        [-58.58923437034032, -34.49059476958225]]], 'type': 'Polygon'}
+ALTITUDE_RANGE = [-20, 30]
+
+
+def mesh_points(*coordinates):
+    # rows (easting, northing, altitude, lon, lat) of the points
+    return np.stack([np.ravel(c) for c in coordinates], axis=1)
+
+
+def test_samples_are_distinct_points_of_the_mesh():
+    longitudes, latitudes, altitudes, easts, norths = get_voi_mesh(AOI, ALTITUDE_RANGE, 10, 5)
+    mesh = mesh_points(easts, norths, altitudes, longitudes, latitudes)
+    mesh_index = {tuple(p[:3]): p[3:] for p in mesh}
+
+    lon, lat, alt, e, n = sample_voi(AOI, ALTITUDE_RANGE, 3000, 10, 5, np.random.default_rng(0))
+    samples = mesh_points(e, n, alt, lon, lat)
+    assert len(samples) == 3000
+    assert len({tuple(p[:3]) for p in samples}) == 3000
+    for p in samples:
+        np.testing.assert_allclose(mesh_index[tuple(p[:3])], p[3:], rtol=0, atol=1e-12)
+
+
+def test_all_the_samples_are_the_mesh():
+    longitudes, latitudes, altitudes, easts, norths = get_voi_mesh(AOI, ALTITUDE_RANGE, 20, 10)
+    mesh = mesh_points(easts, norths, altitudes)
+    lon, lat, alt, e, n = sample_voi(AOI, ALTITUDE_RANGE, len(mesh), 20, 10)
+    samples = mesh_points(e, n, alt)
+    assert sorted(map(tuple, samples)) == sorted(map(tuple, mesh))
+
+    with pytest.raises(ValueError):
+        sample_voi(AOI, ALTITUDE_RANGE, len(mesh) + 1, 20, 10)
+
+
+def test_seeded_samples():
+    a = sample_voi(AOI, ALTITUDE_RANGE, 100, rng=np.random.default_rng(1))
+    b = sample_voi(AOI, ALTITUDE_RANGE, 100, rng=np.random.default_rng(1))
+    for x, y in zip(a, b):
+        np.testing.assert_array_equal(x, y)
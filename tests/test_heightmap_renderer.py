@@ -0,0 +1,51 @@
+import numpy as np
+
+import paffine
+from heightmap_renderer import HeightmapRenderer
+
+
+def flat_with_box(size=200, resolution=0.5, box_height=10.0):
+    # flat ground at 0 with a box in the middle, centered on the scene origin
+    heights = np.zeros((size, size))
+    heights[size//2 - 20:size//2 + 20, size//2 - 20:size//2 + 20] = box_height
+    half = size * resolution / 2
+    return HeightmapRenderer(heights, resolution, origin_en=(-half + resolution/2, half - resolution/2),
+                             image_xy_size=(120, 120))
+
+
+def camera(zenith, azimuth, renderer, pixels_per_meter=2):
+    P_affine, K, R, t = paffine.compute_P_affine(zenith, azimuth, None, renderer.image_xy_size, pixels_per_meter)
+    return R, K
+
+
+def test_flat_ground_and_box_have_no_empty_pixels():
+    renderer = flat_with_box()
+    for zenith, azimuth in [(0, 0), (20, 0), (20, 135), (35, 250)]:
+        R, K = camera(zenith, azimuth, renderer)
+        R_sun = paffine.camera_rotation_matrix_from_view_angles(30, 100)
+        img = renderer.render_array(R, K, R_sun)
+        assert img.shape == (120, 120)
+        assert np.count_nonzero(img == 0) == 0, (zenith, azimuth)
+
+
+def test_flat_ground_is_uniform_and_the_box_casts_a_shadow():
+    renderer = flat_with_box()
+    R, K = camera(0, 0, renderer)
+    # sun at nadir: no shadows, the ground and the top of the box face the sun (not the edges of the box)
+    img = renderer.render_array(R, K, None)
+    assert np.all(img[:30] == renderer.max_value) and np.all(img[55:65, 55:65] == renderer.max_value)
+
+    R_sun = paffine.camera_rotation_matrix_from_view_angles(45, 90)
+    img = renderer.render_array(R, K, R_sun)
+    shadow = int(round(renderer.ambient * renderer.max_value))
+    assert np.count_nonzero(np.abs(img.astype(np.int64) - shadow) <= 1) > 0
+
+
+def test_holes_and_outside_of_the_height_field_are_empty():
+    renderer = flat_with_box(size=60)
+    renderer.heights[:10, :] = np.nan
+    R, K = camera(0, 0, renderer)
+    img = renderer.render_array(R, K, None)
+    # the height field covers 30 m, the image 60 m
+    assert img[0, 0] == 0 and img[60, 60] > 0
+    assert np.count_nonzero(img == 0) > 0
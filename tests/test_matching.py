@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('ponomarenko')
+pytest.importorskip('rpcm')
+exposure = pytest.importorskip('skimage.exposure')
+rasterio = pytest.importorskip('rasterio')
+
+import matching
+from reference_profile import compute_reference_profile
+
+
+def render(dtype=np.uint16, shape=(200, 240), seed=0):
+    # smooth image with few gray levels, as the renders
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    img = 300 * np.sin(x / 30) * np.cos(y / 45) + 20 * rng.standard_normal(shape)
+    if np.dtype(dtype).kind == 'u':
+        img += 400
+    if np.dtype(dtype).kind in 'ui':
+        img = img.clip(np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return img.round().astype(dtype)
+
+
+def reference(shape=(300, 300), seed=1):
+    rng = np.random.default_rng(seed)
+    # unsigned, as match_histograms only accepts unsigned references for unsigned images
+    return (800 + 200 * rng.standard_normal(shape)).clip(0).astype(np.uint16)
+
+
+@pytest.fixture(scope='module')
+def profile():
+    return compute_reference_profile(reference(), 5, noise_workers=1)
+
+
+def noiseless(profile):
+    return dict(profile, noise_std=np.zeros_like(profile['noise_std']))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.float32, np.float64])
+def test_histogram_matching_is_match_histograms(profile, dtype):
+    img = render(dtype)
+    expected = exposure.match_histograms(img, reference())
+    np.testing.assert_allclose(matching.match_histogram_to_profile(img, profile), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16])
+def test_luts_give_the_histogram_matching(profile, dtype):
+    img = render(dtype)
+    lookup, value_lut, sigma_lut = matching.get_matching_luts(img, profile)
+    np.testing.assert_allclose(value_lut[lookup], matching.match_histogram_to_profile(img, profile), rtol=1e-12)
+    np.testing.assert_array_equal(
+        sigma_lut[lookup], profile['noise_std'][matching.get_closest_indices(profile['noise_bins'], value_lut[lookup])])
+
+    # without noise the LUT matching is match_histograms
+    matched = matching.match_image_values_and_noise_to_profile(img, noiseless(profile))
+    np.testing.assert_allclose(matched, exposure.match_histograms(img, reference()), rtol=1e-6)
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_matched_type(profile, dtype):
+    img = render(dtype)
+    assert matching.match_image_values_and_noise_to_profile(img, profile).dtype == np.float64
+    assert matching.match_image_values_and_noise_to_profile(img, profile, dtype=np.float32).dtype == np.float32
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_seeded_noise_does_not_depend_on_the_chunks(profile, dtype):
+    img = render()
+    matched = matching.match_image_values_and_noise_to_profile(img, profile, np.random.default_rng(3), dtype)
+    np.testing.assert_array_equal(
+        matching.match_image_values_and_noise_to_profile(img, profile, np.random.default_rng(3), dtype, chunk_size=1000),
+        matched)
+    assert not np.array_equal(
+        matching.match_image_values_and_noise_to_profile(img, profile, np.random.default_rng(4), dtype), matched)
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float64])
+def test_noise_follows_the_noise_curve(profile, dtype):
+    img = render(dtype, shape=(400, 400))
+    matched = matching.match_image_values_and_noise_to_profile(img, profile, np.random.default_rng(0), np.float32)
+    noise = matched - matching.match_histogram_to_profile(img, profile)
+    sigma = profile['noise_std'][matching.get_closest_indices(profile['noise_bins'], matched - noise)]
+    assert np.std(noise / sigma) == pytest.approx(1, abs=0.01)
+    assert np.mean(noise / sigma) == pytest.approx(0, abs=0.01)
+
+
+def write_image(filename, img):
+    with rasterio.open(filename, 'w', driver='GTiff', width=img.shape[1], height=img.shape[0], count=1,
+                       dtype=img.dtype) as f:
+        f.write(img, 1)
+    return filename
+
+
+def read_image(filename):
+    with rasterio.open(filename) as f:
+        return f.read(1)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16])
+@pytest.mark.parametrize('window_size', [64, 1000])
+def test_windowed_matching_is_the_in_memory_matching(tmp_path, profile, dtype, window_size):
+    img = render(dtype)
+    img_filename = write_image(str(tmp_path / 'render.tif'), img)
+    output_filename = str(tmp_path / 'matched.tif')
+
+    matching.match_image_values_and_noise_windowed(img_filename, noiseless(profile), output_filename,
+                                                   window_size=window_size)
+    np.testing.assert_array_equal(read_image(output_filename),
+                                  matching.match_image_values_and_noise_to_profile(img, noiseless(profile)))
+
+    # same noise distribution, reproducible with a seed
+    matching.match_image_values_and_noise_windowed(img_filename, profile, output_filename, np.random.default_rng(0),
+                                                   window_size=window_size)
+    windowed = read_image(output_filename)
+    in_memory = matching.match_image_values_and_noise_to_profile(img, profile, np.random.default_rng(0))
+    assert windowed.dtype == in_memory.dtype == np.float64
+    clean = matching.match_histogram_to_profile(img, profile)
+    assert np.std(windowed - clean) == pytest.approx(np.std(in_memory - clean), rel=0.05)
+    matching.match_image_values_and_noise_windowed(img_filename, profile, output_filename, np.random.default_rng(0),
+                                                   window_size=window_size)
+    np.testing.assert_array_equal(read_image(output_filename), windowed)
+
+
+def test_windowed_matching_needs_an_8_or_16_bit_image(tmp_path, profile):
+    img_filename = write_image(str(tmp_path / 'render.tif'), render(np.float32))
+    with pytest.raises(ValueError):
+        matching.match_image_values_and_noise_windowed(img_filename, profile, str(tmp_path / 'matched.tif'))
+    assert not (tmp_path / 'matched.tif').exists()
+
+
+def test_matching_files_by_windows_or_in_memory(tmp_path):
+    img_filename = write_image(str(tmp_path / 'render.tif'), render())
+    ref_filename = write_image(str(tmp_path / 'ref.tif'), reference())
+    outputs = {}
+    for window_size in (None, 50):
+        outputs[window_size] = str(tmp_path / f'matched_{window_size}.tif')
+        matching.match_image_values_and_noise_ex(img_filename, ref_filename, outputs[window_size], 5, seed=1,
+                                                 window_size=window_size)
+    windowed, in_memory = read_image(outputs[50]), read_image(outputs[None])
+    assert windowed.shape == in_memory.shape
+    assert abs(np.mean(windowed) - np.mean(in_memory)) < 1
+    assert np.std(windowed) == pytest.approx(np.std(in_memory), rel=0.01)
+    # the input is not modified
+    np.testing.assert_array_equal(read_image(img_filename), render())
+
+
+def test_windowed_matching_to_a_cog(tmp_path):
+    rpcm = pytest.importorskip('rpcm')
+    img_filename = write_image(str(tmp_path / 'render.tif'), render())
+    ref_filename = write_image(str(tmp_path / 'ref.tif'), reference())
+    rpc = rpcm.RPCModel({'LINE_OFF': 100, 'SAMP_OFF': 120, 'LAT_OFF': -34.49, 'LONG_OFF': -58.59, 'HEIGHT_OFF': 0,
+                         'LINE_SCALE': 100, 'SAMP_SCALE': 120, 'LAT_SCALE': 0.01, 'LONG_SCALE': 0.01, 'HEIGHT_SCALE': 100,
+                         'LINE_NUM_COEFF': ' '.join(['0', '0', '-1'] + ['0'] * 17), 'LINE_DEN_COEFF': ' '.join(['1'] + ['0'] * 19),
+                         'SAMP_NUM_COEFF': ' '.join(['0', '1'] + ['0'] * 18), 'SAMP_DEN_COEFF': ' '.join(['1'] + ['0'] * 19)})
+
+    outputs = {}
+    for cog in (False, True):
+        outputs[cog] = str(tmp_path / f'matched_{cog}.tif')
+        matching.match_image_values_and_noise_ex(img_filename, ref_filename, outputs[cog], 5, seed=1, window_size=64,
+                                                 cog=cog, rpc=rpc if cog else None)
+    np.testing.assert_array_equal(read_image(outputs[True]), read_image(outputs[False]))
+    with rasterio.open(outputs[True]) as f:
+        assert f.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert f.tags(ns='RPC')['LINE_OFF'].strip() == '100'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['matched_False.tif', 'matched_True.tif', 'ref.tif', 'render.tif']
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from noise_estimation import estimate_noise_parallel
+
+
+def noisy_ramp(shape=(300, 400), sigma=(2.0, 6.0), seed=0):
+    # smooth ramp of intensities with a noise that grows with the intensity
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    clean = 50 + 150 * x / shape[1] + 10 * np.sin(y / 20)
+    noise_std = sigma[0] + (sigma[1] - sigma[0]) * (clean - clean.min()) / np.ptp(clean)
+    return (clean + noise_std * rng.standard_normal(shape)).astype(np.float32)
+
+
+def test_noise_of_a_gaussian_noise_image():
+    img = 100 + 5 * np.random.default_rng(1).standard_normal((256, 256)).astype(np.float32)
+    bin_mean, bin_std = estimate_noise_parallel(img, num_bins=3, max_workers=1)
+    np.testing.assert_allclose(bin_mean, 100, atol=2)
+    np.testing.assert_allclose(bin_std, 5, rtol=0.15)
+
+
+def test_processes_and_executor_give_the_serial_result():
+    img = noisy_ramp()
+    expected = estimate_noise_parallel(img, num_bins=5, max_workers=1, blocks_per_task=10000)
+    for result in (estimate_noise_parallel(img, num_bins=5, max_workers=2, blocks_per_task=10000),
+                   estimate_noise_parallel(img, num_bins=5, blocks_per_task=10000,
+                                           executor=ThreadPoolExecutor(max_workers=3))):
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+
+
+def test_bins_without_low_variance_blocks_are_left_out():
+    # 26x23 = 598 blocks: two bins of 200 blocks (one block of lowest variance) and one of 198 (none)
+    img = noisy_ramp(shape=(30, 33))
+    bin_mean, bin_std = estimate_noise_parallel(img, num_bins=3, max_workers=1)
+    assert len(bin_mean) == len(bin_std) == 2
+    assert np.all(np.isfinite(bin_mean)) and np.all(np.isfinite(bin_std))
+
+    with pytest.raises(ValueError):
+        estimate_noise_parallel(img[:20, :20], num_bins=3, max_workers=1)
+
+
+@pytest.mark.parametrize('num_bins', [1, 3, 10])
+def test_same_noise_curve_as_ponomarenko(num_bins):
+    ponomarenko = pytest.importorskip('ponomarenko')
+    img = noisy_ramp(shape=(200, 250))
+    expected_mean, expected_std = ponomarenko.estimate_noise(img, num_bins=num_bins)
+    bin_mean, bin_std = estimate_noise_parallel(img, num_bins=num_bins, max_workers=2, blocks_per_task=20000)
+    np.testing.assert_allclose(bin_mean, expected_mean, rtol=1e-4)
+    np.testing.assert_allclose(bin_std, expected_std, rtol=1e-4)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('ponomarenko')
+pytest.importorskip('rpcm')
+rasterio = pytest.importorskip('rasterio')
+
+import reference_profile
+from reference_profile import ReferenceProfileStore, compute_reference_profile
+
+
+def write_image(filename, img):
+    with rasterio.open(filename, 'w', driver='GTiff', width=img.shape[1], height=img.shape[0], count=1,
+                       dtype=img.dtype) as f:
+        f.write(img, 1)
+    return filename
+
+
+def reference_image(seed=0, shape=(300, 300)):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return (1000 + 10 * x + 3 * rng.standard_normal(shape)).astype(np.uint16)
+
+
+def test_profile_is_the_cdf_of_match_histograms():
+    ref = reference_image()
+    profile = compute_reference_profile(ref, 5, noise_workers=1)
+    values, counts = np.unique(ref, return_counts=True)
+    np.testing.assert_array_equal(profile['values'], values)
+    np.testing.assert_allclose(profile['quantiles'], np.cumsum(counts) / ref.size)
+    assert len(profile['noise_bins']) == len(profile['noise_std']) == 5
+
+    # the CDF is subsampled, keeping its ends
+    small = compute_reference_profile(ref, 5, max_cdf_size=100, noise_workers=1)
+    assert len(small['values']) <= 100
+    assert small['values'][0] == values[0] and small['values'][-1] == values[-1]
+    assert small['quantiles'][-1] == 1
+
+
+def test_store_reads_each_reference_image_once(tmp_path, monkeypatch):
+    ref_filename = write_image(str(tmp_path / 'ref.tif'), reference_image())
+    reads = []
+    read_reference_image = reference_profile.read_reference_image
+    def counted(*args, **kwargs):
+        reads.append(args[0])
+        return read_reference_image(*args, **kwargs)
+    monkeypatch.setattr(reference_profile, 'read_reference_image', counted)
+
+    store = ReferenceProfileStore(str(tmp_path / 'store'), noise_workers=1)
+    profile = store.get(ref_filename, 5)
+    assert store.get(ref_filename, 5) is profile
+    assert len(reads) == 1
+
+    # another store on the same directory (e.g. another simulation) loads the stored profile
+    other = ReferenceProfileStore(str(tmp_path / 'store'), noise_workers=1).get(ref_filename, 5)
+    assert len(reads) == 1
+    for k in profile:
+        np.testing.assert_array_equal(other[k], profile[k])
+
+    # other number of bins, then other content
+    store.get(ref_filename, 3)
+    assert len(reads) == 2
+    write_image(ref_filename, reference_image(seed=1))
+    store.get(ref_filename, 5)
+    assert len(reads) == 3
+
+
+def test_large_reference_images_are_read_partially(tmp_path):
+    ref_filename = write_image(str(tmp_path / 'ref.tif'), reference_image(shape=(400, 500)))
+    cdf_img, noise_img = reference_profile.read_reference_image(ref_filename, max_pixels=20000, window_size=64)
+    assert cdf_img.size <= 20000
+    assert noise_img.size <= 20000 and noise_img.shape[0] % 64 == 0 and noise_img.shape[1] % 64 == 0
+
+    img, same = reference_profile.read_reference_image(ref_filename)
+    assert img is same and img.shape == (400, 500)
@@ -0,0 +1,104 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rpcfit')
+rpcm = pytest.importorskip('rpcm')
+
+import paffine
+import rpcfit_util
+from rpc_evaluation import RPCEvaluator, validate_rpc
+
+
+AOI = {'coordinates': [[[-58.58923437034032, -34.49059476958225], [-58.58923437034032, -34.4891885066768],
+                        [-58.58733243810684, -34.4891885066768], [-58.58733243810684, -34.49059476958225],
+                        [-58.58923437034032, -34.49059476958225]]], 'type': 'Polygon'}
+ALTITUDE_RANGE = [-20, 30]
+
+
+@pytest.fixture(scope='module')
+def fitted(tmp_path_factory):
+    # RPC of a camera fitted with rpcfit (projection and localization) and with the linear solver (projection)
+    P_affine, K, R, t = paffine.compute_P_affine(20, 30, None, (200, 200), 2)
+    tmp_path = tmp_path_factory.mktemp('rpcs')
+    filenames = {solver: str(tmp_path / f'{solver}.txt') for solver in ('rpcfit', 'linear')}
+    for solver, filename in filenames.items():
+        rpcfit_util.compute_rpcs_from_affine_cameras([P_affine], AOI, ALTITUDE_RANGE, [filename], solver=solver,
+                                                     horizontal_resolution=4, vertical_resolution=5,
+                                                     samples_train=5000, samples_test=1000)
+    return P_affine, {solver: rpcm.rpc_from_rpc_file(filename) for solver, filename in filenames.items()}
+
+
+def random_locs(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    lons, lats = np.array(AOI['coordinates'][0]).T
+    return (rng.uniform(lons.min(), lons.max(), n), rng.uniform(lats.min(), lats.max(), n),
+            rng.uniform(*ALTITUDE_RANGE, n))
+
+
+@pytest.mark.parametrize('solver', ['rpcfit', 'linear'])
+def test_projection_is_the_rpcm_projection(fitted, solver):
+    rpc = fitted[1][solver]
+    lon, lat, alt = random_locs()
+    col, row = RPCEvaluator(rpc, chunk_size=999).projection(lon, lat, alt)
+    expected_col, expected_row = rpc.projection(lon, lat, alt)
+    np.testing.assert_allclose(col, expected_col, rtol=0, atol=1e-8)
+    np.testing.assert_allclose(row, expected_row, rtol=0, atol=1e-8)
+
+
+def test_localization_is_the_rpcm_localization(fitted):
+    rpc = fitted[1]['rpcfit']
+    lon, lat, alt = random_locs()
+    col, row = rpc.projection(lon, lat, alt)
+    loc_lon, loc_lat = RPCEvaluator(rpc).localization(col, row, alt)
+    expected_lon, expected_lat = rpc.localization(col, row, alt)
+    np.testing.assert_allclose(loc_lon, expected_lon, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(loc_lat, expected_lat, rtol=0, atol=1e-12)
+
+
+def test_localization_inverts_the_projection_without_localization_coefficients(fitted):
+    rpc = fitted[1]['linear']
+    evaluator = RPCEvaluator(rpc)
+    assert evaluator.localization_coefficients is None
+    lon, lat, alt = random_locs()
+    loc_lon, loc_lat = evaluator.localization(*evaluator.projection(lon, lat, alt), alt)
+    # 1e-9 degrees ~ 0.1 mm
+    np.testing.assert_allclose(loc_lon, lon, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(loc_lat, lat, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('solver', ['rpcfit', 'linear'])
+def test_validation_of_a_fitted_rpc(fitted, solver):
+    P_affine, rpcs = fitted
+    report = validate_rpc(rpcs[solver], P_affine, AOI, ALTITUDE_RANGE, num_points=20000, chunk_size=3000)
+    assert report['num_points'] == 20000
+    assert report['rmse'] <= report['max_error'] < 1e-5
+    assert report['localization_max_error_meters'] < 1e-4
+    assert sum(s['num_points'] for s in report['altitude_slices']) == 20000
+    assert report['altitude_slices'][0]['altitude_range'] == [-20, -15]
+    assert report['altitude_slices'][-1]['altitude_range'] == [25, 30]
+
+
+def test_validation_measures_the_error_of_a_wrong_camera(fitted):
+    P_affine, rpcs = fitted
+    shifted = P_affine.copy()
+    shifted[0, 3] += 0.5
+    report = validate_rpc(rpcs['rpcfit'], shifted, AOI, ALTITUDE_RANGE, num_points=20000, localization=False)
+    assert report['rmse'] == pytest.approx(0.5, abs=1e-4)
+    assert report['max_error'] == pytest.approx(0.5, abs=1e-4)
+    assert 'localization_rmse_meters' not in report
+
+    # the points are seeded
+    assert validate_rpc(rpcs['rpcfit'], shifted, AOI, ALTITUDE_RANGE, num_points=20000, localization=False) == report
+
+
+def test_validation_report_next_to_the_rpc(tmp_path, fitted):
+    P_affine, rpcs = fitted
+    filename = str(tmp_path / 'rpc.txt')
+    rpcfit_util.compute_rpcs_from_affine_cameras([P_affine], AOI, ALTITUDE_RANGE, [filename], solver='linear',
+                                                 horizontal_resolution=4, vertical_resolution=5,
+                                                 samples_train=5000, samples_test=1000, validation_points=5000)
+    with open(rpcfit_util.get_fit_report_filename(filename)) as f:
+        report = json.load(f)
+    assert report['validation'] == validate_rpc(filename, P_affine, AOI, ALTITUDE_RANGE, num_points=5000)
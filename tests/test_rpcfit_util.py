@@ -0,0 +1,200 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rpcfit')
+rpcm = pytest.importorskip('rpcm')
+
+import paffine
+import rpcfit_util
+from file_cache import FileCache
+
+
+AOI = {'coordinates': [[[-58.58923437034032, -34.49059476958225], [-58.58923437034032, -34.4891885066768],
+                        [-58.58733243810684, -34.4891885066768], [-58.58733243810684, -34.49059476958225],
+                        [-58.58923437034032, -34.49059476958225]]], 'type': 'Polygon'}
+ALTITUDE_RANGE = [-20, 30]
+# small fits, the tests only compare them
+FIT = dict(horizontal_resolution=4, vertical_resolution=5, samples_train=5000, samples_test=10000)
+
+
+def camera(zenith, azimuth):
+    P_affine, K, R, t = paffine.compute_P_affine(zenith, azimuth, None, (200, 200), 2)
+    return P_affine
+
+
+def test_rpc_fit_cache_key():
+    P = camera(20, 30)
+    key = rpcfit_util.get_rpc_fit_cache_key(P, AOI, ALTITUDE_RANGE, solver='rpcfit')
+    assert rpcfit_util.get_rpc_fit_cache_key(P.copy(), AOI, list(ALTITUDE_RANGE), solver='rpcfit') == key
+    assert rpcfit_util.get_rpc_fit_cache_key(camera(20, 31), AOI, ALTITUDE_RANGE, solver='rpcfit') != key
+    assert rpcfit_util.get_rpc_fit_cache_key(P, AOI, [-20, 31], solver='rpcfit') != key
+    assert rpcfit_util.get_rpc_fit_cache_key(P, AOI, ALTITUDE_RANGE, [-58.588, -34.49, 0], solver='rpcfit') != key
+    assert rpcfit_util.get_rpc_fit_cache_key(P, AOI, ALTITUDE_RANGE, solver='linear') != key
+
+
+def test_cached_rpcs_are_not_fitted_again(tmp_path, monkeypatch):
+    rpc_cache = FileCache(str(tmp_path / 'cache'))
+    P_affines = [camera(20, 30), camera(10, 100)]
+    first = [str(tmp_path / f'first_{i}.txt') for i in range(2)]
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, first, rpc_cache=rpc_cache,
+                                                 solver='linear', **FIT)
+
+    def no_fit(*args, **kwargs):
+        raise AssertionError('the RPC is in the cache')
+    monkeypatch.setattr(rpcfit_util, 'prepare_rpc_fit_samples', no_fit)
+    second = [str(tmp_path / f'second_{i}.txt') for i in range(2)]
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, second, rpc_cache=rpc_cache,
+                                                 solver='linear', **FIT)
+    for a, b in zip(first, second):
+        with open(a) as fa, open(b) as fb:
+            assert fa.read() == fb.read()
+
+    # another fit parameter is another entry
+    with pytest.raises(AssertionError):
+        rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, second, rpc_cache=rpc_cache,
+                                                     solver='linear', **dict(FIT, samples_train=4000))
+
+
+def projection_errors(rpc_filename, P_affine):
+    # errors of an RPC as written, on random points of the VOI
+    samples = rpcfit_util.prepare_rpc_fit_samples(AOI, ALTITUDE_RANGE, samples_train=1, samples_test=20000)
+    return rpcfit_util.compute_rpc_projection_errors(rpcm.rpc_from_rpc_file(rpc_filename), P_affine,
+                                                     samples['locs_test'], samples['locs_enu_test'])
+
+
+def test_linear_and_fast_solvers_are_as_accurate_as_rpcfit(tmp_path):
+    P_affines = [camera(0, 0), camera(20, 30), camera(35, 250)]
+    max_errors = {}
+    for solver in ('rpcfit', 'linear', 'fast'):
+        filenames = [str(tmp_path / f'{solver}_{i}.txt') for i in range(len(P_affines))]
+        rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, filenames, solver=solver, **FIT)
+        max_errors[solver] = max(projection_errors(f, P)[1] for f, P in zip(filenames, P_affines))
+
+    # the cameras are affine, all the solvers are limited by the rounding of the coefficients in the files
+    assert max_errors['rpcfit'] < 1e-5
+    assert max_errors['linear'] < 1e-5
+    assert max_errors['fast'] < 1e-5
+
+
+def test_fast_solver_falls_back_to_rpcfit_above_max_error(tmp_path, monkeypatch):
+    fitted = []
+    fit_rpc_to_affine_camera = rpcfit_util.fit_rpc_to_affine_camera
+    def counted(P_affine, *args, **kwargs):
+        fitted.append(P_affine)
+        return fit_rpc_to_affine_camera(P_affine, *args, **kwargs)
+    monkeypatch.setattr(rpcfit_util, 'fit_rpc_to_affine_camera', counted)
+
+    P = camera(20, 30)
+    rpcfit_util.compute_rpcs_from_affine_cameras([P], AOI, ALTITUDE_RANGE, [str(tmp_path / 'a.txt')], solver='fast', **FIT)
+    assert len(fitted) == 0
+    rpcfit_util.compute_rpcs_from_affine_cameras([P], AOI, ALTITUDE_RANGE, [str(tmp_path / 'b.txt')], solver='fast', 
+                                                 max_error=0, **FIT)
+    assert len(fitted) == 1
+    assert projection_errors(str(tmp_path / 'b.txt'), P)[1] < 1e-3
+
+
+@pytest.mark.parametrize('solver', ['rpcfit', 'linear'])
+def test_adaptive_fits_grow_the_samples_until_the_target(tmp_path, solver):
+    P = camera(20, 30)
+    filename = str(tmp_path / 'rpc.txt')
+
+    # easy target: the first fit is enough
+    rpcfit_util.compute_rpcs_from_affine_cameras([P], AOI, ALTITUDE_RANGE, [filename], solver=solver, target_rmse=1e-2,
+                                                 initial_samples_train=100, **FIT)
+    with open(rpcfit_util.get_fit_report_filename(filename)) as f:
+        report = json.load(f)
+    assert report['samples_train'] == 100
+    assert report['target_met'] and report['rmse'] <= 1e-2
+    assert report['rmse'] == pytest.approx(projection_errors(filename, P)[0], rel=0.5)
+
+    # unreachable target: all the samples are used and the report says so
+    rpcfit_util.compute_rpcs_from_affine_cameras([P], AOI, ALTITUDE_RANGE, [filename], solver=solver, target_rmse=1e-30,
+                                                 initial_samples_train=100, **FIT)
+    with open(rpcfit_util.get_fit_report_filename(filename)) as f:
+        report = json.load(f)
+    assert report['samples_train'] == FIT['samples_train']
+    assert not report['target_met']
+
+
+def test_adaptive_fits_stop_at_the_first_sample_count_that_meets_the_target(monkeypatch):
+    # the errors only meet the target from 800 train samples
+    sizes = []
+    fit_linear_rpcs_to_affine_cameras = rpcfit_util.fit_linear_rpcs_to_affine_cameras
+    def fit(P_affines, samples):
+        sizes.append(len(samples['locs_train']))
+        return fit_linear_rpcs_to_affine_cameras(P_affines, samples)
+    monkeypatch.setattr(rpcfit_util, 'fit_linear_rpcs_to_affine_cameras', fit)
+    monkeypatch.setattr(rpcfit_util, 'compute_rpc_projection_errors', 
+                        lambda *args: (0.0, 0.0) if sizes[-1] >= 800 else (1.0, 1.0))
+
+    samples = rpcfit_util.prepare_rpc_fit_samples(AOI, ALTITUDE_RANGE, samples_train=4000, samples_test=5000)
+    results = rpcfit_util.fit_rpcs_to_affine_cameras_adaptive([camera(20, 30), camera(35, 250)], samples, 'linear',
+                                                              target_max_error=0.5, initial_samples_train=50)
+    assert sizes == [50, 200, 800]
+    for rpc, report in results:
+        assert report['samples_train'] == 800 and report['target_met']
+
+
+def test_order_cameras_by_proximity():
+    P_affines = [camera(20, 100), camera(20, 160), camera(20, 110), camera(20, 140)]
+    assert rpcfit_util.order_cameras_by_proximity(P_affines) == [0, 2, 3, 1]
+    assert rpcfit_util.order_cameras_by_proximity([]) == []
+
+
+def test_registry_returns_the_nearest_fit_of_the_same_voi():
+    registry = rpcfit_util.RPCFitRegistry(max_distance=0.05)
+    voi_key = rpcfit_util.RPCFitRegistry.voi_key(AOI, ALTITUDE_RANGE, solver='rpcfit')
+    registry.add(voi_key, camera(20, 30), 'rpc 20 30', {})
+    registry.add(voi_key, camera(20, 40), 'rpc 20 40', {})
+
+    assert registry.nearest(voi_key, camera(20, 31))[0] == 'rpc 20 30'
+    assert registry.nearest(voi_key, camera(20, 39))[0] == 'rpc 20 40'
+    assert registry.nearest(voi_key, camera(40, 200)) is None
+    assert registry.nearest(rpcfit_util.RPCFitRegistry.voi_key(AOI, [-20, 31], solver='rpcfit'), camera(20, 31)) is None
+
+
+def test_warm_started_fits_match_full_fits(tmp_path, monkeypatch):
+    full_fits = []
+    calibrate_rpc = rpcfit_util.rpc_fit.calibrate_rpc
+    def counted(*args, **kwargs):
+        full_fits.append(1)
+        return calibrate_rpc(*args, **kwargs)
+    monkeypatch.setattr(rpcfit_util.rpc_fit, 'calibrate_rpc', counted)
+
+    # sweep of close views: only the first one is fitted from scratch
+    P_affines = [camera(20, azimuth) for azimuth in (30, 30.5, 31, 31.5)]
+    warm = [str(tmp_path / f'warm_{i}.txt') for i in range(len(P_affines))]
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, warm, warm_start=True, **FIT)
+    assert len(full_fits) == 1
+
+    full = [str(tmp_path / f'full_{i}.txt') for i in range(len(P_affines))]
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, full, **FIT)
+    assert len(full_fits) == 1 + len(P_affines)
+    for w, f, P in zip(warm, full, P_affines):
+        assert projection_errors(w, P)[1] < 1e-5
+        assert projection_errors(w, P)[1] == pytest.approx(projection_errors(f, P)[1], abs=1e-6)
+
+
+def test_warm_started_fits_are_cached_apart_from_full_fits(tmp_path, monkeypatch):
+    rpc_cache = FileCache(str(tmp_path / 'cache'))
+    P_affines = [camera(20, 30), camera(20, 30.5)]
+    filenames = [str(tmp_path / f'{i}.txt') for i in range(len(P_affines))]
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, filenames, rpc_cache=rpc_cache,
+                                                 warm_start=True, **FIT)
+
+    fitted = []
+    fit_rpc_to_affine_camera = rpcfit_util.fit_rpc_to_affine_camera
+    def counted(P_affine, samples, warm_start=None, **kwargs):
+        fitted.append(warm_start is None)
+        return fit_rpc_to_affine_camera(P_affine, samples, warm_start, **kwargs)
+    monkeypatch.setattr(rpcfit_util, 'fit_rpc_to_affine_camera', counted)
+
+    # a full fit does not use the warm started rpc of the cache
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines[1:], AOI, ALTITUDE_RANGE, filenames[1:], rpc_cache=rpc_cache, **FIT)
+    assert fitted == [True]
+    # the warm started ones are in the cache
+    rpcfit_util.compute_rpcs_from_affine_cameras(P_affines, AOI, ALTITUDE_RANGE, filenames, rpc_cache=rpc_cache,
+                                                 warm_start=True, **FIT)
+    assert fitted == [True]
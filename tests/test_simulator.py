@@ -0,0 +1,306 @@
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rpcfit')
+pytest.importorskip('ponomarenko')
+rpcm = pytest.importorskip('rpcm')
+rasterio = pytest.importorskip('rasterio')
+
+import rpcfit_util
+from heightmap_renderer import HeightmapRenderer
+from location import Location
+from satellite import Satellite
+from simulator import Simulator
+
+
+def heightmap_renderer():
+    # flat ground with a box, 100 x 100 m around the origin of the location
+    heights = np.zeros((200, 200))
+    heights[80:120, 80:120] = 10.0
+    return HeightmapRenderer(heights, 0.5, origin_en=(-49.75, 49.75), image_xy_size=(80, 80))
+
+
+def new_simulator(base_dir, **options):
+    return Simulator(str(base_dir), Satellite(), location=Location(altitude_range=[-20, 30]),
+                     render_backend=heightmap_renderer(), rpc_solver='fast', rpc_validation_points=None, **options)
+
+
+def read_image(filename):
+    with rasterio.open(filename) as f:
+        return f.read(1)
+
+
+def write_target_image(filename):
+    img = (800 + 200 * np.random.default_rng(0).standard_normal((150, 150))).clip(0).astype(np.uint16)
+    with rasterio.open(filename, 'w', driver='GTiff', width=150, height=150, count=1, dtype=img.dtype) as f:
+        f.write(img, 1)
+    return filename
+
+
+@pytest.fixture
+def fits(monkeypatch):
+    # rpc filenames passed to each fit
+    fitted = []
+    compute_rpcs_from_affine_cameras = rpcfit_util.compute_rpcs_from_affine_cameras
+    def counted(P_affines, aoi, altitude_range, output_filenames, *args, **kwargs):
+        fitted.append([os.path.basename(f) for f in output_filenames])
+        return compute_rpcs_from_affine_cameras(P_affines, aoi, altitude_range, output_filenames, *args, **kwargs)
+    monkeypatch.setattr(rpcfit_util, 'compute_rpcs_from_affine_cameras', counted)
+    return fitted
+
+
+VIEWS = [(10, 0, 30, 100), (10, 0, 40, 100), (20, 45, 30, 100), (15, 300, 0, 0)]
+
+
+def assert_same_simulations(results, expected):
+    for (image_filename, rpcfit_filename, *error), (expected_image, expected_rpc, *_) in zip(results, expected):
+        assert error in ([], [None])
+        np.testing.assert_array_equal(read_image(image_filename), read_image(expected_image))
+        lon, lat, alt = -58.5883, -34.4899, np.array([-10.0, 0.0, 20.0])
+        np.testing.assert_allclose(rpcm.rpc_from_rpc_file(rpcfit_filename).projection(lon, lat, alt),
+                                   rpcm.rpc_from_rpc_file(expected_rpc).projection(lon, lat, alt), rtol=0, atol=1e-6)
+
+
+@pytest.fixture(scope='module')
+def single_views(tmp_path_factory):
+    # the views simulated one by one
+    sim = new_simulator(tmp_path_factory.mktemp('single') / 'sim')
+    return [sim.simulate_image_and_rpcfit(zenith, azimuth, None, sun_zenith, sun_azimuth)
+            for zenith, azimuth, sun_zenith, sun_azimuth in VIEWS]
+
+
+def test_batch_is_the_simulation_of_each_view(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    results = sim.simulate_batch(VIEWS, max_workers=3)
+    assert [os.path.basename(r[0]) for r in results] == [os.path.basename(r[0]) for r in single_views]
+    assert_same_simulations(results, single_views)
+    # the two sun positions of the first view share its rpc
+    assert sorted(sum(fits, [])) == sorted(set(os.path.basename(r[1]) for r in results)) and len(fits) == 3
+
+
+def test_batch_reports_the_failing_views_and_skips_the_existing_ones(tmp_path, fits):
+    sim = new_simulator(tmp_path / 'sim')
+    target = write_target_image(str(tmp_path / 'target.tif'))
+    views = [VIEWS[0] + (target,), VIEWS[1] + (str(tmp_path / 'missing.tif'),), VIEWS[2]]
+    results = sim.simulate_batch(views, max_workers=2)
+    assert results[0][2] is None and results[2][2] is None
+    assert results[1][2] is not None
+    assert read_image(results[0][0]).dtype == np.float64
+    assert len(fits) == 2
+
+    # only the failed view is simulated again, its rpc exists
+    mtimes = [os.stat(r[0]).st_mtime_ns for r in (results[0], results[2])]
+    views[1] = VIEWS[1] + (target,)
+    results = sim.simulate_batch(views, max_workers=2)
+    assert all(error is None for *_, error in results)
+    assert [os.stat(r[0]).st_mtime_ns for r in (results[0], results[2])] == mtimes
+    assert len(fits) == 2
+
+
+def test_single_session_batch_is_the_simulation_of_each_view(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    results = sim.simulate_batch_single_session(VIEWS, max_workers=2)
+    assert_same_simulations(results, single_views)
+    # the rpcs are fitted together, once each
+    assert len(fits) == 1 and sorted(fits[0]) == sorted(set(os.path.basename(r[1]) for r in results))
+
+    # an image is rendered again without fitting its rpc
+    os.remove(results[2][0])
+    results = sim.simulate_batch_single_session(VIEWS)
+    assert_same_simulations(results, single_views)
+    assert len(fits) == 1
+
+
+def test_sun_positions_of_a_view(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    results = sim.simulate_sun_positions(10, 0, sun_positions=[(30, 100), (40, 100)])
+    assert_same_simulations(results, single_views[:2])
+    assert len(fits) == 1 and results[0][1] == results[1][1]
+    assert not np.array_equal(read_image(results[0][0]), read_image(results[1][0]))
+
+    # sun at nadir by default
+    [(image_filename, rpcfit_filename)] = sim.simulate_sun_positions(10, 0)
+    assert image_filename == sim.get_view_filenames(10, 0, 0, 0)['image'] and os.path.isfile(image_filename)
+    assert len(fits) == 1
+
+    with pytest.raises(ValueError):
+        sim.simulate_sun_positions(10, 0, sun_positions=[])
+
+
+def fake_blender_tile_render(sim, W, H, failing_tile=None):
+    # renders the tile of the borders of the script: each pixel holds its position in the full frame
+    def run_blender(blender_command, image_filename):
+        args = blender_command.split()
+        with open(args[args.index('-P') + 1]) as f:
+            borders = dict(line.split(' = ') for line in f.read().splitlines() if 'border_m' in line)
+        border = lambda name, size: int(float(borders[f'bpy.context.scene.render.border_{name}']) * size)
+        x0, x1 = border('min_x', W), border('max_x', W)
+        y0, y1 = H - border('max_y', H), H - border('min_y', H)
+        if (x0, y0) == failing_tile:
+            raise RuntimeError('Blender failed')
+        rows, cols = np.mgrid[y0:y1, x0:x1]
+        with rasterio.open(image_filename, 'w', driver='GTiff', width=x1 - x0, height=y1 - y0, count=1,
+                           dtype=np.uint16) as f:
+            f.write((rows * W + cols).astype(np.uint16), 1)
+    sim.run_blender = run_blender
+
+
+def test_tiles_are_placed_in_the_full_frame(tmp_path):
+    from blender import Blender
+    (tmp_path / 'scene.blend').write_bytes(b'')
+    W, H = 120, 110
+    sim = Simulator(str(tmp_path / 'sim'), Satellite(), Blender(str(tmp_path / 'scene.blend'), (W, H)),
+                    Location(altitude_range=[-20, 30]), rpc_solver='fast', rpc_validation_points=None)
+    fake_blender_tile_render(sim, W, H)
+    image_filename, rpcfit_filename = sim.simulate_image_and_rpcfit_tiled(10, 0, tile_size=50, max_workers=3)
+    rows, cols = np.mgrid[:H, :W]
+    np.testing.assert_array_equal(read_image(image_filename), rows * W + cols)
+    assert os.path.isfile(rpcfit_filename)
+    assert not [f for f in os.listdir(sim.images_dir) if f.startswith('TILES_') or f.endswith('.tmp.tif')]
+
+    # a failed tile fails the image and its tiles are removed
+    fake_blender_tile_render(sim, W, H, failing_tile=(50, 50))
+    with pytest.raises(RuntimeError):
+        sim.simulate_image_and_rpcfit_tiled(12, 0, tile_size=50, max_workers=1)
+    assert os.listdir(sim.images_dir) == [os.path.basename(image_filename)]
+
+    with pytest.raises(ValueError):
+        new_simulator(tmp_path / 'backend').simulate_image_and_rpcfit_tiled(10, 0)
+
+
+def test_cameras_and_rpcs_of_several_views_are_fitted_together(tmp_path, fits):
+    sim = new_simulator(tmp_path / 'sim')
+    filenames = [sim.get_view_filenames(zenith, azimuth)['rpcfit'] for zenith, azimuth in [(10, 0), (20, 45), (10, 0)]]
+    cameras = sim.compute_view_cameras_and_rpcs([(10, 0, None), (20, 45, None), (10, 0, None)], filenames)
+    assert fits == [[os.path.basename(filenames[0]), os.path.basename(filenames[1])]]
+    for (P_affine, K, R), (zenith, azimuth) in zip(cameras, [(10, 0), (20, 45), (10, 0)]):
+        np.testing.assert_array_equal(P_affine, sim.compute_view_camera(zenith, azimuth)[0])
+
+    # a failing view does not fail the others
+    errors = {}
+    filenames[1] = sim.get_view_filenames(15, 300)['rpcfit']
+    cameras = sim.compute_view_cameras_and_rpcs([(10, 5, None), (15, 300, None), (12, 0, 1)],
+                                                [sim.get_view_filenames(10, 5)['rpcfit'], filenames[1], filenames[2]], errors)
+    assert list(errors) == [2] and isinstance(errors[2], ValueError) and cameras[2] is None
+    assert cameras[0] is not None and cameras[1] is not None and len(fits) == 2
+    with pytest.raises(ValueError):
+        sim.compute_view_cameras_and_rpcs([(12, 0, 1)], [filenames[2]])
+
+
+def test_a_failing_fit_only_fails_its_views_in_the_single_session_batch(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    # the rpc of the first view cannot be written
+    os.makedirs(sim.get_view_filenames(*VIEWS[0])['rpcfit'])
+    results = sim.simulate_batch_single_session(VIEWS)
+    assert len(fits) == 1
+    assert results[0][2] is not None and results[1][2] is not None
+    assert_same_simulations(results[2:], single_views[2:])
+
+
+def test_warm_started_fits_follow_the_proximity_of_the_views(tmp_path, fits):
+    sim = new_simulator(tmp_path / 'sim', warm_start_rpc_fits=True)
+    # azimuth sweep at zenith 20 given out of order, two sun positions for one of the views
+    views = [(20, 100, 0, 0), (20, 160, 0, 0), (20, 110, 0, 0), (20, 140, 0, 0), (20, 110, 30, 100)]
+    filenames = [sim.get_view_filenames(*view) for view in views]
+    assert sim.group_views_by_rpc(views, filenames, range(len(views))) == [[0], [2, 4], [3], [1]]
+
+    sim.simulate_batch_single_session(views)
+    assert fits == [[os.path.basename(filenames[i]['rpcfit']) for i in (0, 2, 3, 1)]]
+
+
+def test_pipeline_is_the_simulation_of_each_view(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    target = write_target_image(str(tmp_path / 'target.tif'))
+    views = VIEWS + [(20, 45, 40, 100, target), (12, 0, 30, 100, str(tmp_path / 'missing.tif'))]
+    results = sim.simulate_pipeline(views, fit_workers=2, render_workers=2, match_workers=2, queue_size=1)
+    assert_same_simulations(results[:4], single_views)
+    assert results[4][2] is None and read_image(results[4][0]).dtype == np.float64
+    assert results[5][2] is not None
+    # each rpc is fitted once
+    assert len(fits) == 4 and len(set(sum(fits, []))) == 4
+
+    os.remove(results[2][0])
+    results = sim.simulate_pipeline(views[:5])
+    assert_same_simulations(results[:4], single_views)
+    assert len(fits) == 4
+
+
+def test_async_batch_is_the_simulation_of_each_view(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    results = asyncio.run(sim.simulate_batch_async(VIEWS, max_concurrency=3))
+    assert_same_simulations(results, single_views)
+    assert len(fits) == 3 and len(set(sum(fits, []))) == 3
+
+    os.remove(results[1][0])
+    assert asyncio.run(sim.simulate_image_and_rpcfit_async(10, 0, None, 40, 100)) == results[1][:2]
+    assert_same_simulations(results, single_views)
+    assert len(fits) == 3
+
+
+def test_async_batch_reports_the_views_that_time_out(tmp_path, fits, single_views):
+    sim = new_simulator(tmp_path / 'sim')
+    render = sim.render_backend.render
+    def slow_render(R, K, R_sun, image_filename):
+        if image_filename == sim.get_view_filenames(*VIEWS[1])['image']:
+            time.sleep(2)
+        render(R, K, R_sun, image_filename)
+    sim.render_backend.render = slow_render
+    results = asyncio.run(sim.simulate_batch_async(VIEWS, timeout=1))
+    assert isinstance(results[1][2], asyncio.TimeoutError)
+    # the other view of the rpc is not cancelled
+    assert_same_simulations([results[0]] + results[2:], [single_views[0]] + single_views[2:])
+
+
+def test_cancelled_blender_is_killed(tmp_path):
+    sim = new_simulator(tmp_path / 'sim')
+    image_filename = str(tmp_path / 'image.tif')
+    t0 = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(sim.run_blender_async([sys.executable, '-c', 'import time; time.sleep(30)'], 
+                                                           image_filename), 0.5))
+    assert time.monotonic() - t0 < 10
+    with pytest.raises(RuntimeError):
+        asyncio.run(sim.run_blender_async([sys.executable, '-c', 'pass'], image_filename))
+
+
+def test_seeded_noise_does_not_depend_on_the_batch_mode(tmp_path):
+    target = write_target_image(str(tmp_path / 'target.tif'))
+    views = [view + (target,) for view in VIEWS]
+    images = {}
+    for mode in ('single', 'batch', 'pipeline'):
+        sim = new_simulator(tmp_path / mode, noise_seed=5, match_dtype=np.float32)
+        if mode == 'single':
+            results = [sim.simulate_image_and_rpcfit(zenith, azimuth, None, sun_zenith, sun_azimuth, target)
+                       for zenith, azimuth, sun_zenith, sun_azimuth, target in views]
+        elif mode == 'batch':
+            results = sim.simulate_batch(views, max_workers=3)
+        else:
+            results = sim.simulate_pipeline(views, match_workers=2)
+        images[mode] = [read_image(r[0]) for r in results]
+    for mode in ('batch', 'pipeline'):
+        for img, expected in zip(images[mode], images['single']):
+            assert img.dtype == np.float32
+            np.testing.assert_array_equal(img, expected)
+    # another seed gives another noise
+    sim = new_simulator(tmp_path / 'other_seed', noise_seed=6, match_dtype=np.float32)
+    image_filename, _ = sim.simulate_image_and_rpcfit(*VIEWS[0][:2], None, *VIEWS[0][2:], target)
+    assert not np.array_equal(read_image(image_filename), images['single'][0])
+
+
+def test_cog_output_embeds_the_rpc_of_the_view(tmp_path):
+    sim = new_simulator(tmp_path / 'sim', cog_output=True)
+    target = write_target_image(str(tmp_path / 'target.tif'))
+    for view in (VIEWS[0], VIEWS[1] + (target,)):
+        [(image_filename, rpcfit_filename, error)] = sim.simulate_batch([view])
+        assert error is None
+        with rasterio.open(image_filename) as f:
+            assert f.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+            rpc = rpcm.RPCModel(f.tags(ns='RPC'))
+        lon, lat, alt = -58.5883, -34.4899, np.array([-10.0, 0.0, 20.0])
+        np.testing.assert_allclose(rpc.projection(lon, lat, alt),
+                                   rpcm.rpc_from_rpc_file(rpcfit_filename).projection(lon, lat, alt), rtol=0, atol=1e-6)
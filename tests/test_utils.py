@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+
+rpcm = pytest.importorskip('rpcm')
+
+import rasterio
+
+import utils
+
+
+def test_transformers_are_cached():
+    assert utils.get_transformer(32721, 4326) is utils.get_transformer(32721, 4326)
+    assert utils.get_transformer(4326, 32721) is not utils.get_transformer(32721, 4326)
+
+
+def test_transform_coords_by_chunks():
+    rng = np.random.default_rng(0)
+    easts = rng.uniform(350000, 360000, (40, 25))
+    norths = rng.uniform(6180000, 6190000, (40, 25))
+    lons, lats = utils.transform_coords(32721, 4326, easts, norths)
+    assert lons.shape == lats.shape == (40, 25)
+
+    chunked = utils.transform_coords(32721, 4326, easts, norths, chunk_size=7)
+    np.testing.assert_array_equal(chunked[0], lons)
+    np.testing.assert_array_equal(chunked[1], lats)
+
+    # back to UTM
+    e, n = utils.transform_coords(4326, 32721, lons, lats)
+    np.testing.assert_allclose(e, easts, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(n, norths, rtol=0, atol=1e-6)
+
+    # scalars stay scalars
+    lon, lat = utils.transform_coords(32721, 4326, easts[0, 0], norths[0, 0])
+    assert np.ndim(lon) == 0 and lon == lons[0, 0] and lat == lats[0, 0]
+
+
+def test_utm_conversions_use_the_zone_of_the_points():
+    assert utils.utm_epsg_from_lonlat(-58.59, -34.49) == 32721
+    assert utils.utm_epsg_from_lonlat(2.35, 48.85) == 32631
+    easts, norths = utils.utm_from_lonlat([-58.59], [-34.49])
+    lons, lats = utils.transform_coords(32721, 4326, easts, norths)
+    np.testing.assert_allclose([lons[0], lats[0]], [-58.59, -34.49], rtol=0, atol=1e-9)
+
+
+def simple_rpc():
+    # col = 1000 * (lon + 58.59) / 0.01 + 500, row = -1000 * (lat + 34.49) / 0.01 + 500
+    coefficients = lambda k: ' '.join(['1' if i == k else '0' for i in range(20)])
+    return rpcm.RPCModel({'LINE_OFF': 500, 'SAMP_OFF': 500, 'LAT_OFF': -34.49, 'LONG_OFF': -58.59, 'HEIGHT_OFF': 0,
+                          'LINE_SCALE': 1000, 'SAMP_SCALE': 1000, 'LAT_SCALE': 0.01, 'LONG_SCALE': 0.01,
+                          'HEIGHT_SCALE': 100,
+                          'LINE_NUM_COEFF': coefficients(2).replace('1', '-1'), 'LINE_DEN_COEFF': coefficients(0),
+                          'SAMP_NUM_COEFF': coefficients(1), 'SAMP_DEN_COEFF': coefficients(0)})
+
+
+@pytest.mark.parametrize('from_file', [False, True])
+def test_write_cog(tmp_path, from_file):
+    img = np.random.default_rng(0).normal(100, 10, (1100, 1300)).astype(np.float32)
+    rpc = simple_rpc()
+    filename = str(tmp_path / 'image.tif')
+    if from_file:
+        # the file is rewritten in place
+        utils.writeGTIFF(img, filename)
+        utils.writeCOG(filename, filename, rpc)
+    else:
+        utils.writeCOG(img, filename, rpc)
+
+    with rasterio.open(filename) as f:
+        assert f.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert f.compression == rasterio.enums.Compression.deflate
+        assert f.block_shapes == [(512, 512)]
+        assert f.overviews(1) == [2, 4]
+        np.testing.assert_array_equal(f.read(1), img)
+        cog_rpc = rpcm.RPCModel(f.tags(ns='RPC'))
+    lon, lat = np.array([-58.595, -58.58]), np.array([-34.495, -34.485])
+    np.testing.assert_allclose(cog_rpc.projection(lon, lat, 0), rpc.projection(lon, lat, 0), rtol=0, atol=1e-6)
+    assert not (tmp_path / 'image.tif.tmp.tif').exists()
+
+
+def test_write_cog_of_a_multiband_array_without_rpc(tmp_path):
+    img = np.arange(3 * 50 * 60, dtype=np.uint16).reshape(50, 60, 3)
+    utils.writeCOG(img, str(tmp_path / 'image.tif'))
+    with rasterio.open(str(tmp_path / 'image.tif')) as f:
+        assert f.count == 3 and f.tags(ns='RPC') == {}
+        np.testing.assert_array_equal(f.read().transpose([1, 2, 0]), img)
+
+
+def write_raster(filename, img, **options):
+    img = img if img.ndim == 3 else img[:, :, np.newaxis]
+    with rasterio.open(filename, 'w', driver='GTiff', width=img.shape[1], height=img.shape[0], count=img.shape[2],
+                       dtype=img.dtype, **options) as f:
+        f.write(img.transpose([2, 0, 1]))
+    return filename
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.float32])
+def test_read_raster_keeps_the_type(tmp_path, dtype):
+    img = (np.arange(70 * 90).reshape(70, 90) % 200).astype(dtype)
+    filename = write_raster(str(tmp_path / 'image.tif'), img, compress='deflate')
+    im = utils.read_raster(filename)
+    assert im.dtype == dtype and im.shape == (70, 90, 1)
+    np.testing.assert_array_equal(im[:, :, 0], img)
+    assert utils.readGTIFF(filename).dtype == np.float64
+
+    np.testing.assert_array_equal(utils.read_raster(filename, band=1, window=((10, 30), (5, 50))), img[10:30, 5:50])
+    assert utils.read_raster(filename, band=1, out_shape=(35, 45)).shape == (35, 45)
+
+
+def test_memmap_of_uncompressed_stripped_images(tmp_path):
+    img = np.random.default_rng(0).integers(0, 60000, (300, 200, 2), dtype=np.uint16)
+    filename = write_raster(str(tmp_path / 'image.tif'), img, interleave='pixel', blockysize=16)
+    im = utils.memmap_raster(filename)
+    assert isinstance(im, np.memmap) and not im.flags.writeable
+    np.testing.assert_array_equal(im, img)
+
+    im = utils.read_raster(filename, band=2, window=((40, 90), (10, 30)), memmap=True)
+    assert isinstance(im, np.memmap)
+    np.testing.assert_array_equal(im, img[40:90, 10:30, 1])
+
+
+@pytest.mark.parametrize('options', [dict(compress='deflate'), dict(tiled=True, blockxsize=64, blockysize=64),
+                                     dict(interleave='band')])
+def test_no_memmap_of_other_layouts(tmp_path, options):
+    img = np.random.default_rng(0).integers(0, 60000, (300, 200, 2), dtype=np.uint16)
+    filename = write_raster(str(tmp_path / 'image.tif'), img, **options)
+    assert utils.memmap_raster(filename) is None
+    assert utils.memmap_raster(str(tmp_path / 'missing.tif')) is None
+
+    # read_raster falls back to a normal read
+    im = utils.read_raster(filename, band=1, window=((40, 90), (10, 30)), memmap=True)
+    assert not isinstance(im, np.memmap)
+    np.testing.assert_array_equal(im, img[40:90, 10:30, 0])
+
+
+def test_memmap_of_images_written_by_skimage(tmp_path):
+    io = pytest.importorskip('skimage.io')
+    img = np.random.default_rng(0).normal(0, 1, (120, 80)).astype(np.float32)
+    io.imsave(str(tmp_path / 'image.tif'), img)
+    im = utils.read_raster(str(tmp_path / 'image.tif'), band=1, memmap=True)
+    assert isinstance(im, np.memmap)
+    np.testing.assert_array_equal(im, img)
+
+
+def test_longlat_of_pixels_of_a_geotransform(tmp_path):
+    img = np.zeros((100, 120), dtype=np.uint8)
+    transform = rasterio.Affine(0.5, 0.1, 350000, 0.05, -0.5, 6180000)
+    filename = write_raster(str(tmp_path / 'image.tif'), img, crs='EPSG:32721', transform=transform)
+    x = np.array([0, 10.5, 119, 60])
+    y = np.array([0, 20.25, 99, 30])
+    lonlat = utils.gdal_get_longlat_of_pixel(filename, x, y, chunk_size=3)
+    assert lonlat.shape == (4, 3) and np.all(lonlat[:, 2] == 0)
+
+    lon, lat = utils.transform_coords(32721, 4326, 350000 + 0.5 * x + 0.1 * y, 6180000 + 0.05 * x - 0.5 * y)
+    np.testing.assert_allclose(lonlat[:, 0], lon, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(lonlat[:, 1], lat, rtol=0, atol=1e-12)
+
+
+def test_longlat_of_pixels_of_gcps(tmp_path):
+    from rasterio.control import GroundControlPoint
+    img = np.zeros((100, 120), dtype=np.uint8)
+    # gcps of the geotransform of the previous test
+    gcps = [GroundControlPoint(row, col, 350000 + 0.5 * col + 0.1 * row, 6180000 + 0.05 * col - 0.5 * row)
+            for row, col in ((0, 0), (0, 120), (100, 0), (100, 120))]
+    filename = write_raster(str(tmp_path / 'image.tif'), img, gcps=gcps, crs='EPSG:32721')
+    lonlat = utils.gdal_get_longlat_of_pixel(filename, [10.5, 60], [20.25, 30])
+    lon, lat = utils.transform_coords(32721, 4326, [350000 + 5.25 + 2.025, 350000 + 30 + 3],
+                                      [6180000 + 0.525 - 10.125, 6180000 + 3 - 15])
+    np.testing.assert_allclose(lonlat[:, 0], lon, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(lonlat[:, 1], lat, rtol=0, atol=1e-9)
+
+
+def test_longlat_of_pixels_of_an_rpc(tmp_path):
+    rpc = simple_rpc()
+    filename = str(tmp_path / 'image.tif')
+    utils.writeCOG(np.zeros((100, 120), dtype=np.uint8), filename, rpc)
+    lon, lat = np.array([-58.595, -58.58]), np.array([-34.495, -34.485])
+    col, row = rpc.projection(lon, lat, 0)
+    lonlat = utils.gdal_get_longlat_of_pixel(filename, col, row)
+    np.testing.assert_allclose(lonlat[:, 0], lon, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(lonlat[:, 1], lat, rtol=0, atol=1e-9)
+
+    with pytest.raises(ValueError):
+        utils.gdal_get_longlat_of_pixel(write_raster(str(tmp_path / 'plain.tif'), np.zeros((10, 10), np.uint8)), [0], [0])
@@ -34,11 +34,13 @@ sim = Simulator(simulation_base_dir,
                 satellite, blender, location)
 
 #%% GENERATE THE IMAGES -------------------------------------
-for i in range(len(ref_zenith_list)):
-  ref_image_filename, ref_rpc_filename = \
-    sim.simulate_image_and_rpcfit(ref_zenith_list[i],
-                                  ref_azimuth_list[i], 
-                                  None,
-                                  ref_sun_zenith_list[i],
-                                  ref_sun_azimuth_list[i]) 
+# The view is the same for the three images, so the camera and
+# the RPC are computed once and the images are rendered in a
+# single Blender session
+ref_image_and_rpc_filenames = \
+    sim.simulate_sun_positions(ref_zenith_list[0],
+                               ref_azimuth_list[0],
+                               None,
+                               list(zip(ref_sun_zenith_list,
+                                        ref_sun_azimuth_list)))
 
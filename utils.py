@@ -9,6 +9,7 @@ Copyright (C) 2018, Carlo de Franchis <carlo.de-franchis@ens-cachan.fr>
 """
 import os
 import datetime
+import functools
 import requests
 import subprocess
 import numpy as np
@@ -17,8 +18,7 @@ import pyproj
 import rasterio
 import geojson
 import bs4
-
-#import rpc_model
+import rpcm
 
 warnings.filterwarnings("ignore",
                         category=rasterio.errors.NotGeoreferencedWarning)
@@ -28,13 +28,68 @@ def readGTIFF(fname):
     """
     Reads an image file into a numpy array,
     returns the numpy array with dimensios (height, width, channels)
-    The returned numpy array is always of type numpy.float
-    """
-    # read the image into a np.array
-    with  rasterio.open(fname, 'r') as s:
-        # print('reading image of size: %s'%str(im.shape))
-        im = s.read()
-    return im.transpose([1,2,0]).astype(np.float)
+    The returned numpy array is always of type numpy.float64
+    (see read_raster to keep the type of the file)
+    """
+    return read_raster(fname).astype(np.float64)
+
+
+def read_raster(fname, band=None, window=None, out_shape=None, boundless=False, memmap=False):
+    """
+    Reads an image file into a numpy array of the type of the file, with
+    dimensions (height, width, channels), or (height, width) if a band is given.
+    window ((row_start, row_stop), (col_start, col_stop)) reads a window of the image
+    and out_shape (height, width) a decimated image (from the overviews of the file if
+    it has them). With memmap, uncompressed files are returned as read-only memory
+    maps, without copy (see memmap_raster), unless a decimated or boundless read
+    is requested.
+    """
+    if memmap and out_shape is None and not boundless:
+        im = memmap_raster(fname)
+        if im is not None:
+            if window is not None:
+                (row_start, row_stop), (col_start, col_stop) = window
+                im = im[max(row_start, 0):row_stop, max(col_start, 0):col_stop]
+            return im if band is None else im[:, :, band - 1]
+
+    if window is not None and not isinstance(window, rasterio.windows.Window):
+        window = rasterio.windows.Window.from_slices(*window, boundless=boundless)
+    with rasterio.open(fname, 'r') as s:
+        if out_shape is not None:
+            out_shape = tuple(out_shape) if band is not None else (s.count,) + tuple(out_shape)
+        im = s.read(band, window=window, out_shape=out_shape, boundless=boundless)
+    return im if band is not None else im.transpose([1,2,0])
+
+
+def memmap_raster(fname):
+    """
+    Read-only memory map (height, width, channels) of the pixels of an uncompressed,
+    stripped GeoTIFF whose strips are contiguous in the file (e.g. written by
+    skimage/tifffile or by Blender without compression).
+    Returns None if the file cannot be mapped.
+    """
+    if not os.path.isfile(fname):
+        return None
+    with rasterio.open(fname, 'r') as s:
+        if (s.driver != 'GTiff' or s.compression is not None or len(set(s.dtypes)) != 1
+                or s.block_shapes[0][1] != s.width or 'NBITS' in s.tags(1, ns='IMAGE_STRUCTURE')
+                or (s.count > 1 and s.interleaving != rasterio.enums.Interleaving.pixel)):
+            return None
+        dtype = np.dtype(s.dtypes[0])
+        shape = (s.height, s.width, s.count)
+        rows_per_strip = s.block_shapes[0][0]
+        strip_size = rows_per_strip * s.width * s.count * dtype.itemsize
+        offsets = [s.get_tag_item(f'BLOCK_OFFSET_0_{k}', 'TIFF', bidx=1)
+                   for k in range(-(-s.height // rows_per_strip))]
+    if None in offsets:
+        return None
+    offsets = [int(o) for o in offsets]
+    if any(o != offsets[0] + k * strip_size for k, o in enumerate(offsets)):
+        return None
+
+    with open(fname, 'rb') as f:
+        byte_order = '<' if f.read(2) == b'II' else '>'
+    return np.memmap(fname, dtype=dtype.newbyteorder(byte_order), mode='r', offset=offsets[0], shape=shape)
 
 
 def readGTIFFmeta(fname):
@@ -110,6 +165,47 @@ def writeGTIFF(im, fname, copy_metadata_from=None):
             d.write((im.transpose([2,0,1]).astype(d.profile['dtype'])))
 
 
+def writeCOG(im, fname, rpc=None, compress='DEFLATE', blocksize=512):
+    """
+    Writes a numpy array (height, width[, channels]) or copies an image file
+    to a Cloud Optimized GeoTIFF: tiled, compressed, with internal overviews
+    and the RPC model (rpcm.RPCModel) in the RPC metadata domain.
+    The COG is written in one pass by the GDAL COG driver, from an in-memory
+    dataset (arrays) or a VRT of the file (so fname can be the input file).
+    """
+    import uuid
+    import rasterio.shutil
+    from rasterio.io import MemoryFile
+
+    tmp_fname = fname + '.tmp.tif'
+    options = {'driver': 'COG', 'COMPRESS': compress, 'PREDICTOR': 'YES',
+               'BLOCKSIZE': blocksize, 'BIGTIFF': 'IF_SAFER'}
+
+    if isinstance(im, str):
+        # the file is read through a VRT with the RPC tags, not loaded
+        vrt = f'/vsimem/{uuid.uuid4().hex}.vrt'
+        rasterio.shutil.copy(im, vrt, driver='VRT')
+        try:
+            if rpc is not None:
+                with rasterio.open(vrt, 'r+') as d:
+                    d.update_tags(ns='RPC', **rpc.to_geotiff_dict())
+            rasterio.shutil.copy(vrt, tmp_fname, **options)
+        finally:
+            rasterio.shutil.delete(vrt)
+    else:
+        if len(im.shape) == 2:
+            im = im[:,:,np.newaxis]
+        with MemoryFile() as memfile:
+            with memfile.open(driver='GTiff', width=im.shape[1], height=im.shape[0], count=im.shape[2],
+                              dtype=im.dtype) as d:
+                d.write(im.transpose([2,0,1]))
+                if rpc is not None:
+                    d.update_tags(ns='RPC', **rpc.to_geotiff_dict())
+            rasterio.shutil.copy(memfile.name, tmp_fname, **options)
+
+    os.replace(tmp_fname, fname)
+
+
 def is_absolute(url):
     return bool(requests.utils.urlparse(url).netloc)
 
@@ -157,35 +253,53 @@ def acquisition_date(geotiff_path):
         return datetime.datetime.strptime(date_string, "%Y%m%d%H%M%S")
 
 
-def gdal_get_longlat_of_pixel(fname, x, y, verbose=True):
+def gdal_get_longlat_of_pixel(fname, x, y, verbose=True, chunk_size=1000000):
     """
     returns the longitude latitude and altitude (wrt the WGS84 reference
-    ellipsoid) for the points at pixel coordinates (x, y) of the image fname.
+    ellipsoid) for the points at pixel coordinates (x, y) of the image fname,
+    as a (N, 3) np.array of rows (lon, lat, 0).
     The CRS of the input GeoTIFF is determined from the metadata in the file.
-
+    The points are transformed in process, as gdaltransform -t_srs "+proj=longlat"
+    would: with the geotransform of the image (or the affine transform of its
+    GCPs, or its RPC at altitude 0 if it has neither) and a cached transformer
+    applied in chunks of chunk_size points.
+    verbose is kept for compatibility (there is no command to print).
     """
-    import subprocess
+    from rasterio.transform import from_gcps
 
-    # add vsicurl prefix if needed
-    env = os.environ.copy()
+    # vsicurl is used by rasterio for urls
+    env = {}
     if fname.startswith(('http://', 'https://')):
         env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = fname[-3:]
-        fname = '/vsicurl/{}'.format(fname)
-
-    # form the query string for gdaltransform
-    q = b''
-    for (xi,yi) in zip(x,y):
-        q = q + b'%d %d\n'%(xi,yi)
-    # call gdaltransform, "+proj=longlat" uses the WGS84 ellipsoid
-    #    echo '0 0' | gdaltransform -t_srs "+proj=longlat" inputimage.tif
-    cmdlist = ['gdaltransform', '-t_srs', "+proj=longlat", fname]
-    if verbose:
-        print ('RUN: ' +  ' '.join(cmdlist) + ' [x y from stdin]')
-    p = subprocess.Popen(cmdlist,
-                         stdin=subprocess.PIPE,stdout=subprocess.PIPE)
-    out = (p.communicate(q)[0]).decode()
-    listeout =  [ list(map(float, x.split())) for x in out.splitlines()]
-    return listeout
+
+    with rasterio.Env(**env), rasterio.open(fname, 'r') as src:
+        transform, crs = src.transform, src.crs
+        gcps, gcps_crs = src.gcps
+        rpc_dict = src.tags(ns='RPC')
+
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    out = np.zeros((len(x), 3))
+
+    if crs is None and gcps:
+        transform, crs = from_gcps(gcps), gcps_crs
+    if crs is None:
+        if not rpc_dict:
+            raise ValueError(f'gdal_get_longlat_of_pixel: {fname} is not georeferenced')
+        rpc = rpcm.RPCModel(rpc_dict)
+        for i in range(0, len(x), chunk_size):
+            xi, yi = x[i:i+chunk_size], y[i:i+chunk_size]
+            out[i:i+chunk_size, 0], out[i:i+chunk_size, 1] = rpc.localization(xi, yi, np.zeros(len(xi)))
+        return out
+
+    # pixel (column, row) to the CRS of the image, then to longitude, latitude
+    a, b, c, d, e, f = transform.a, transform.b, transform.c, transform.d, transform.e, transform.f
+    for i in range(0, len(x), chunk_size):
+        xi, yi = x[i:i+chunk_size], y[i:i+chunk_size]
+        out[i:i+chunk_size, 0], out[i:i+chunk_size, 1] = transform_coords(crs.to_wkt(), 4326,
+                                                                          a * xi + b * yi + c,
+                                                                          d * xi + e * yi + f)
+    return out
 
 
 def lon_lat_image_footprint(image, z=0):
@@ -203,10 +317,9 @@ def lon_lat_image_footprint(image, z=0):
     rpc = rpc_from_geotiff(image)
     with rasterio.open(image, 'r') as src:
         h, w = src.shape
-    coords = []
-    for x, y, z in zip([0, w, w, 0], [0, 0, h, h], [z, z, z, z]):
-        lon, lat = rpc.localization(x, y, z)
-        coords.append([lon, lat])
+    # the four corners in one vectorized call
+    lons, lats = rpc.localization(np.array([0, w, w, 0]), np.array([0, 0, h, h]), np.full(4, z))
+    coords = [[lon, lat] for lon, lat in zip(np.asarray(lons).tolist(), np.asarray(lats).tolist())]
     return geojson.Polygon([coords])
 
 
@@ -224,19 +337,19 @@ def gdal_resample_image_to_longlat(fname, outfname, verbose=True):
     return os.system(cmd)
 
 
-# def rpc_from_geotiff(geotiff_path):
-#     """
-#     Read the RPC coefficients from a GeoTIFF file and return a rpc_model object.
-#
-#     Args:
-#         geotiff_path (str): path or url to a GeoTIFF file
-#
-#     Returns:
-#         instance of the rpc_model.RPCModel class
-#     """
-#     with rasterio.open(geotiff_path, 'r') as src:
-#         rpc_dict = src.tags(ns='RPC')
-#     return rpc_model.RPCModel(rpc_dict)
+def rpc_from_geotiff(geotiff_path):
+    """
+    Read the RPC coefficients from a GeoTIFF file and return a rpcm.RPCModel object.
+
+    Args:
+        geotiff_path (str): path or url to a GeoTIFF file
+
+    Returns:
+        instance of the rpcm.RPCModel class
+    """
+    with rasterio.open(geotiff_path, 'r') as src:
+        rpc_dict = src.tags(ns='RPC')
+    return rpcm.RPCModel(rpc_dict)
 
 
 def bounding_box2D(pts):
@@ -329,7 +442,7 @@ def bounding_box_of_projected_aoi(rpc, aoi, z=0, homography=None):
     Return the x, y, w, h pixel bounding box of a projected AOI.
 
     Args:
-        rpc (rpc_model.RPCModel): RPC camera model
+        rpc (rpcm.RPCModel): RPC camera model
         aoi (geojson.Polygon): GeoJSON polygon representing the AOI
         z (float): altitude of the AOI with respect to the WGS84 ellipsoid
         homography (2D array, optional): matrix of shape (3, 3) representing an
@@ -365,27 +478,71 @@ def crop_aoi(geotiff, aoi, z=0):
             of the crop.
     """
     x, y, w, h = bounding_box_of_projected_aoi(rpc_from_geotiff(geotiff), aoi, z)
-    with rasterio.open(geotiff, 'r') as src:
-        crop = src.read(window=((y, y + h), (x, x + w)), boundless=True).squeeze()
+    crop = read_raster(geotiff, window=((y, y + h), (x, x + w)), boundless=True).squeeze()
     return crop, x, y
 
 
-def utm_from_latlon(lats, lons):
+@functools.lru_cache(maxsize=32)
+def get_transformer(src_crs, dst_crs):
     """
-    Fast function to convert latitudes, longitudes to UTM coordinates.
+    Reusable coordinate transformer between two CRS. The transformers are
+    kept in a registry (least recently used are evicted) so they are built
+    once and shared by all the conversions (pyproj transformers are thread-safe).
+
+    Args:
+        src_crs, dst_crs: CRS accepted by pyproj (EPSG code, PROJ string...)
+
+    Returns:
+        pyproj.Transformer with (x, y) = (lon, lat) / (easting, northing) axis order
+    """
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def transform_coords(src_crs, dst_crs, x, y, chunk_size=1000000):
+    """
+    Converts arrays of coordinates between two CRS with a transformer of the
+    registry. The arrays are converted in chunks so the memory used by PROJ
+    stays bounded.
+
+    Args:
+        src_crs, dst_crs: CRS accepted by pyproj (EPSG code, PROJ string...)
+        x, y (array_like): coordinates in src_crs (lon, lat for geographic CRS)
+        chunk_size (int): number of points converted in each call
+
+    Returns:
+        x, y (np.arrays with the shape of the inputs): coordinates in dst_crs
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    shape = x.shape
+    x = x.ravel()
+    y = y.ravel()
+    out_x = np.empty_like(x)
+    out_y = np.empty_like(y)
+    for i in range(0, len(x), chunk_size):
+        out_x[i:i+chunk_size], out_y[i:i+chunk_size] = transformer.transform(x[i:i+chunk_size], y[i:i+chunk_size])
+    return out_x.reshape(shape)[()], out_y.reshape(shape)[()]
+
+
+def utm_epsg_from_lonlat(lon, lat):
+    """
+    EPSG code of the WGS84 UTM zone of a point (326xx north, 327xx south).
     """
     import utm
-    import pyproj
-    n = utm.latlon_to_zone_number(lats[0], lons[0])
-    l = utm.latitude_to_zone_letter(lats[0])
-    proj_src = pyproj.Proj('+proj=latlong')
+    n = utm.latlon_to_zone_number(lat, lon)
+    return (32600 if lat >= 0 else 32700) + n
 
-    srs = '+proj=utm +zone={}{}'.format(n, l)
-    if l < 'N':  # latitude bands in the southern hemisphere range from 'C' to 'M'
-        srs += ' +south'
-    proj_dst = pyproj.Proj(srs)
 
-    return pyproj.transform(proj_src, proj_dst, lons, lats)
+def utm_from_latlon(lats, lons):
+    """
+    Fast function to convert latitudes, longitudes to UTM coordinates.
+    The UTM zone is the zone of the first point.
+    """
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    epsg = utm_epsg_from_lonlat(lons.flat[0], lats.flat[0])
+    return transform_coords(4326, epsg, lons, lats)
 
 
 def utm_from_lonlat(lons, lats):
@@ -404,15 +561,11 @@ def pyproj_lonlat_to_utm(lon, lat, epsg=None):
 
 
 def pyproj_lonlat_to_epsg(lon, lat, epsg):
-    in_proj = pyproj.Proj(init='epsg:4326')
-    out_proj = pyproj.Proj(init='epsg:{}'.format(epsg))
-    return pyproj.transform(in_proj, out_proj, lon, lat)
+    return transform_coords(4326, int(epsg), lon, lat)
 
 
 def pyproj_epsg_to_lonlat(x, y, epsg):
-    in_proj = pyproj.Proj(init='epsg:{}'.format(epsg))
-    out_proj = pyproj.Proj(init='epsg:4326')
-    return pyproj.transform(in_proj, out_proj, x, y)
+    return transform_coords(int(epsg), 4326, x, y)
 
 
 def utm_bounding_box_from_lonlat_aoi(aoi):
@@ -429,9 +582,7 @@ def utm_bounding_box_from_lonlat_aoi(aoi):
     """
     lons, lats  = np.array(aoi['coordinates'][0]).T
     east, north = utm_from_lonlat(lons, lats)
-    pts = list(zip(east, north))
-    emin, nmin, deltae, deltan = bounding_box2D(pts)
-    return emin, emin+deltae, nmin, nmin+deltan
+    return np.min(east), np.max(east), np.min(north), np.max(north)
 
 
 def simple_equalization_8bit(im, percentiles=5):